@@ -0,0 +1,160 @@
+"""
+Priority admission control of the requests that miss the caches.
+
+Cached transcriptions are served to every client without limit. Requests that have to go upstream and
+transcribe a page are classified by priority: crawlers, known by their User-Agent, and clients sending
+many requests are given a few concurrent slots shared by every worker of the host, held as leases of the
+page cache (see app.cache), once the host is busy with ADMISSION_LOAD_THRESHOLD misses. When they are
+all taken, the request is shed with a 503 and a Retry-After, so the workers stay available to the
+readers. An optional bounded queue delays it instead, for up to ADMISSION_QUEUE_TIMEOUT, while holding
+a worker. On an idle host every request goes upstream.
+"""
+import os
+import re
+import threading
+import time
+
+from cachetools import LRUCache
+
+from app import metrics
+from app.cache import page_cache
+
+DISABLE_ADMISSION_CONTROL = bool(os.getenv("DISABLE_ADMISSION_CONTROL"))
+ADMISSION_BOT_USER_AGENTS = re.compile(os.getenv(
+    "ADMISSION_BOT_USER_AGENTS",
+    r"bot|crawl|spider|slurp|archiver|facebookexternalhit|curl|wget|python-|scrapy|httpclient|headless|^$"),
+    re.IGNORECASE)
+# Clients over this many requests per ADMISSION_CLIENT_WINDOW to a worker process are "heavy"
+ADMISSION_CLIENT_REQUESTS = int(os.getenv("ADMISSION_CLIENT_REQUESTS", 60))
+ADMISSION_CLIENT_WINDOW = float(os.getenv("ADMISSION_CLIENT_WINDOW", 60))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", 5))
+ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", 30))
+# Misses in flight on the host, of any priority, over which the limits below apply. Defaults to half the uwsgi
+# processes (uwsgi.ini), the other half stays available to the readers. 0 applies the limits always.
+ADMISSION_LOAD_THRESHOLD = int(os.getenv("ADMISSION_LOAD_THRESHOLD", max(1, ((os.cpu_count() or 1) + 1) // 2)))
+# A slot outlives a worker killed in the middle of a request for no more than this.
+ADMISSION_LEASE_SECONDS = float(os.getenv("ADMISSION_LEASE_SECONDS", 60))
+ADMISSION_POLL_INTERVAL = 0.05
+ADMISSION_CLIENTS = 10000
+
+HUMAN = "human"
+HEAVY = "heavy"
+BOT = "bot"
+
+# Concurrent misses and queued requests of each priority on the host. A concurrency of 0 is unlimited, a
+# queue of 0 sheds the requests over the concurrency at once.
+# A queued request waits in a uwsgi worker: the running and queued requests of the limited priorities
+# together must stay below the uwsgi processes (uwsgi.ini), or they can still take every worker.
+LIMITS = {
+    HUMAN: (int(os.getenv("ADMISSION_HUMAN_CONCURRENCY", 0)), int(os.getenv("ADMISSION_HUMAN_QUEUE", 0))),
+    HEAVY: (int(os.getenv("ADMISSION_HEAVY_CONCURRENCY", 1)), int(os.getenv("ADMISSION_HEAVY_QUEUE", 0))),
+    BOT: (int(os.getenv("ADMISSION_BOT_CONCURRENCY", 1)), int(os.getenv("ADMISSION_BOT_QUEUE", 0))),
+}
+UNLIMITED = ()
+IN_FLIGHT = "admission:in-flight:"
+
+_lock = threading.Lock()
+# Client address -> (start of its current window, requests in it)
+_clients = LRUCache(maxsize=ADMISSION_CLIENTS)
+_queued = {}
+
+
+def classify(user_agent, client):
+    """
+    :param user_agent: User-Agent header, may be None
+    :param client: client address, may be None
+    :return: HUMAN, HEAVY or BOT
+    """
+    if ADMISSION_BOT_USER_AGENTS.search(user_agent or ""):
+        return BOT
+    if client is None or ADMISSION_CLIENT_REQUESTS <= 0:
+        return HUMAN
+    now = time.time()
+    with _lock:
+        start, count = _clients.get(client, (now, 0))
+        if now - start >= ADMISSION_CLIENT_WINDOW:
+            start, count = now, 0
+        _clients[client] = (start, count + 1)
+    return HEAVY if count + 1 > ADMISSION_CLIENT_REQUESTS else HUMAN
+
+
+def take_slot(priority, kind, size):
+    """
+    :param priority: request priority
+    :param kind: "run" or "queue"
+    :param size: number of slots
+    :return: name of the lease taken or None if every slot is taken
+    """
+    for i in range(size):
+        name = f"admission:{priority}:{kind}:{i}"
+        if page_cache.acquire_lease(name, ADMISSION_LEASE_SECONDS):
+            return name
+    return None
+
+
+def acquire(priority):
+    """
+    Wait for a slot to go upstream, when the host is loaded.
+    :param priority: request priority, see classify()
+    :return: slot to release(), a tuple of lease names, or None if the request is shed
+    """
+    if DISABLE_ADMISSION_CONTROL:
+        return UNLIMITED
+    # Every miss is counted in the load of the host, one lease per request
+    in_flight = f"{IN_FLIGHT}{os.getpid()}:{threading.get_ident()}"
+    page_cache.acquire_lease(in_flight, ADMISSION_LEASE_SECONDS)
+    concurrency, queue = LIMITS[priority]
+    if concurrency <= 0:
+        return (in_flight,)
+    if 0 < ADMISSION_LOAD_THRESHOLD and page_cache.count_leases(IN_FLIGHT) <= ADMISSION_LOAD_THRESHOLD:
+        metrics.incr("admission_requests_total", priority=priority, result="admitted")
+        return (in_flight,)
+    slot = take_limited_slot(priority, concurrency, queue)
+    if slot is None:
+        page_cache.release_lease(in_flight)
+        return None
+    return (in_flight, slot)
+
+
+def take_limited_slot(priority, concurrency, queue):
+    """
+    :param priority: request priority
+    :param concurrency: slots of the priority
+    :param queue: queued requests of the priority
+    :return: name of the slot lease taken, or None if the request is shed
+    """
+    slot = take_slot(priority, "run", concurrency)
+    if slot is not None:
+        metrics.incr("admission_requests_total", priority=priority, result="admitted")
+        return slot
+
+    queued = take_slot(priority, "queue", queue)
+    if queued is None:
+        metrics.incr("admission_requests_total", priority=priority, result="shed")
+        return None
+    report_queued(priority, 1)
+    deadline = time.time() + ADMISSION_QUEUE_TIMEOUT
+    try:
+        with metrics.stage("admission"):
+            while slot is None and time.time() < deadline:
+                time.sleep(ADMISSION_POLL_INTERVAL)
+                slot = take_slot(priority, "run", concurrency)
+    finally:
+        page_cache.release_lease(queued)
+        report_queued(priority, -1)
+    metrics.incr("admission_requests_total", priority=priority, result="shed" if slot is None else "delayed")
+    return slot
+
+
+def release(slot):
+    """
+    :param slot: slot returned by acquire()
+    """
+    for name in slot:
+        page_cache.release_lease(name)
+
+
+def report_queued(priority, change):
+    with _lock:
+        _queued[priority] = _queued.get(priority, 0) + change
+        metrics.gauge("admission_queue_depth", _queued[priority], priority=priority)
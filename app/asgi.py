@@ -0,0 +1,317 @@
+"""
+Asynchronous (ASGI) serving mode.
+
+Upstream fetches wait on the event loop, so a single process keeps many of them in flight, while the
+CPU bound transcription runs in an executor through the same pipeline used by the Flask app: the
+stored pages and JSON responses are served fresh or stale while they are refreshed in the background,
+see app.revalidate, or when the upstream fails, and client validators are revalidated upstream and
+answered with 304 Not Modified. Run it with any ASGI server instead of the app.wsgi entry point:
+
+    uvicorn app.asgi:app --workers 4
+
+Not supported in this mode: coalescing of the concurrent misses (app.coalesce), admission control
+(app.admission), streamed responses (STREAM_HTML and the asset passthrough and disk cache of
+app.assets, bodies are read whole), and the Server-Timing header and request metrics.
+"""
+import asyncio
+import mimetypes
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from http.cookies import CookieError, SimpleCookie
+from urllib.parse import parse_qsl
+
+import httpx
+from werkzeug.http import parse_date, parse_etags, unquote_etag
+
+from app import json_api, metrics, proxy, revalidate, variants
+from app.compression import negotiate
+from app.http_cache import CACHE_CONTROL, output_etag, upstream_if_none_match
+from app.proxy import PreparedContent, content_kind, flask_app, prepare_content
+from app.upstream import (ROOT_DOMAIN, UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_POOL_SIZE, UPSTREAM_READ_TIMEOUT,
+                          UPSTREAM_RETRIES, upstream_accept_encoding)
+
+TRANSCRIPTION_THREADS = int(os.getenv("TRANSCRIPTION_THREADS", 4))
+
+executor = ThreadPoolExecutor(max_workers=TRANSCRIPTION_THREADS)
+_client = None
+
+
+def get_client():
+    """
+    Async keep-alive client to the upstream, one per worker process.
+    :return: httpx.AsyncClient
+    """
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            timeout=httpx.Timeout(UPSTREAM_READ_TIMEOUT, connect=UPSTREAM_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=UPSTREAM_POOL_SIZE, max_keepalive_connections=UPSTREAM_POOL_SIZE),
+            transport=httpx.AsyncHTTPTransport(retries=UPSTREAM_RETRIES),
+            # As the requests session of the Flask app
+            follow_redirects=True)
+    return _client
+
+
+async def send_response(send, status, body, headers=()):
+    """
+    :param send: ASGI send callable
+    :param status: HTTP status code
+    :param body: response body as bytes
+    :param headers: list of (name, value) string pairs
+    """
+    raw_headers = [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers]
+    await send({"type": "http.response.start", "status": status, "headers": raw_headers})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def read_body(receive):
+    body = b""
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get("body", b"")
+        more_body = message.get("more_body", False)
+    return body
+
+
+async def send_static(send, static_folder, filename):
+    path = os.path.realpath(os.path.join(static_folder, filename))
+    if not path.startswith(os.path.realpath(static_folder) + os.sep) or not os.path.isfile(path):
+        await send_response(send, 404, b"Not Found")
+        return
+    with open(path, "rb") as f:
+        body = f.read()
+    content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    await send_response(send, 200, body, [("Content-Type", content_type)])
+
+
+def request_cookies(headers):
+    cookies = SimpleCookie()
+    try:
+        cookies.load(headers.get("cookie", ""))
+    except CookieError:
+        return {}
+    return {name: morsel.value for name, morsel in cookies.items()}
+
+
+async def get_request(scope, receive, send):
+    """
+    Async counterpart of app.proxy.get_request.
+    """
+    url_path = scope["path"].lstrip("/")
+    headers = {name.decode("latin-1").lower(): value.decode("latin-1") for name, value in scope["headers"]}
+
+    # See DISALLOW_ROBOTS in app.proxy.get_request
+    if url_path == "robots.txt" and os.getenv("DISALLOW_ROBOTS"):
+        await send_static(send, flask_app.static_folder, "robots.txt")
+        return
+    if url_path.startswith("static/"):
+        await send_static(send, flask_app.static_folder, url_path[len("static/"):])
+        return
+    # See app.proxy.get_metrics
+    if url_path == "metrics" and not metrics.DISABLE_METRICS:
+        await send_response(send, 200, metrics.render().encode("utf-8"),
+                            [("Content-Type", "text/plain; version=0.0.4; charset=utf-8")])
+        return
+
+    target_url = ROOT_DOMAIN + url_path
+    http_method = "POST" if scope["method"] == "POST" else "GET"
+
+    user_agent = headers.get("user-agent", "")
+    upstream_headers = {"User-Agent": user_agent,
+                        "Accept-Encoding": upstream_accept_encoding(headers.get("accept-encoding"))}
+
+    # See app.variants
+    query_string = scope["query_string"].decode("utf-8")
+    vaf, vvf, chosen = variants.request_variant(dict(parse_qsl(query_string)), request_cookies(headers))
+    query_string = variants.strip_variant_params(query_string)
+
+    body = await read_body(receive)
+    content = None
+    if query_string:
+        target_url = f"{target_url}?{query_string}"
+    elif body:
+        content = body
+        upstream_headers["Content-Type"] = headers.get("content-type", "application/x-www-form-urlencoded")
+
+    response_headers = [("User-Agent", user_agent), ("Vary", "Cookie")]
+    if chosen:
+        for name, value in variants.variant_cookies(vaf, vvf):
+            cookie = f"{name}={value}; Max-Age={variants.VARIANT_COOKIE_MAX_AGE}; Path=/"
+            response_headers.append(("Set-Cookie", cookie))
+
+    loop = asyncio.get_event_loop()
+    stored = None
+    if http_method == "GET":
+        # Revalidate the client copy upstream, see app.proxy.proxy_request
+        if_none_match = upstream_if_none_match(headers.get("if-none-match"), vaf, vvf)
+        if if_none_match:
+            upstream_headers["If-None-Match"] = if_none_match
+        if headers.get("if-modified-since"):
+            upstream_headers["If-Modified-Since"] = headers["if-modified-since"]
+
+        stored = await loop.run_in_executor(
+            executor, proxy.stored_prepared_content, proxy.normalize_url(target_url), vaf, vvf)
+        if stored is not None and stored[1] in (revalidate.FRESH, revalidate.STALE):
+            prepared, freshness = stored
+            if freshness == revalidate.STALE:
+                refresh_headers = {name: upstream_headers[name] for name in ("User-Agent", "Accept-Encoding")}
+                revalidate.refresh(f"{target_url}\x00{vaf}{vvf}",
+                                   partial(proxy.refresh_upstream, target_url, refresh_headers, url_path,
+                                           vaf=vaf, vvf=vvf))
+            metrics.incr("cached_responses_total", freshness=freshness)
+            await send_prepared(send, prepared, headers, response_headers, http_method, vaf, vvf)
+            return
+
+    try:
+        resp = await get_client().request(http_method, target_url, headers=upstream_headers, content=content)
+    except httpx.HTTPError as e:
+        print(f"Error requesting {target_url}: {repr(e)}")
+        if stored is not None:
+            await send_stale(send, stored[0], headers, response_headers, http_method, vaf, vvf)
+        elif isinstance(e, httpx.TimeoutException):
+            await send_response(send, 504, b"Upstream timeout")
+        else:
+            await send_response(send, 502, b"Upstream error")
+        return
+
+    if resp.status_code >= 500 and stored is not None:
+        await send_stale(send, stored[0], headers, response_headers, http_method, vaf, vvf)
+        return
+
+    if resp.status_code == 304:
+        prepared = PreparedContent(304, proxy.upstream_headers(resp), None)
+    else:
+        prepared = await loop.run_in_executor(executor, partial(prepare_response, resp, target_url, url_path, vaf, vvf))
+    await send_prepared(send, prepared, headers, response_headers, http_method, vaf, vvf)
+
+
+def prepare_response(resp, target_url, url_path, vaf, vvf):
+    """
+    Transcribe an upstream response, as app.proxy.prepare_upstream does.
+    :param resp: upstream httpx response, read whole
+    :param target_url: absolute upstream url
+    :param url_path: requested path
+    :param vaf: vaf configuration for andaluh-py
+    :param vvf: vvf configuration for andaluh-py
+    :return: PreparedContent
+    """
+    if resp.request.method == "GET" and resp.headers.get("Content-Type") == proxy.WKP_CT_HTML:
+        # Also compressed, as cached in the page cache
+        encoded = proxy.transcribe_html_encoded(resp, url_path, vaf=vaf, vvf=vvf)
+    else:
+        encoded = {"identity": prepare_content(resp, url_path, vaf=vaf, vvf=vvf)}
+    prepared = PreparedContent(resp.status_code, proxy.upstream_headers(resp), encoded)
+
+    api = json_api.match(target_url) if resp.request.method == "GET" and resp.status_code == 200 else None
+    if api is not None and resp.headers.get("Content-Type", "").startswith("application/json"):
+        json_api.cache_response(api, (proxy.normalize_url(target_url), vaf, vvf), prepared)
+    return prepared
+
+
+async def send_prepared(send, prepared, request_headers, response_headers, http_method, vaf, vvf):
+    """
+    Send a transcribed response, compressed as the client prefers when possible, or a 304 Not Modified
+    when the client copy is still valid, as app.proxy.prepared_response does.
+    :param send: ASGI send callable
+    :param prepared: PreparedContent
+    :param request_headers: client headers, with lowercase names
+    :param response_headers: list of (name, value) pairs of the response, besides the content ones
+    :param http_method: request method
+    :param vaf: vaf configuration for andaluh-py
+    :param vvf: vvf configuration for andaluh-py
+    """
+    if prepared.status_code == 304:
+        validators = response_validators(prepared.headers, http_method, 304, None, vaf, vvf)
+        await send_response(send, 304, b"", response_headers + validators)
+        return
+
+    encoding = negotiate(request_headers.get("accept-encoding"), prepared.encoded)
+    headers = list(response_headers)
+    if len(prepared.encoded) > 1:
+        headers.append(("Vary", "Accept-Encoding"))
+    if encoding != "identity":
+        headers.append(("Content-Encoding", encoding))
+    validators = response_validators(prepared.headers, http_method, prepared.status_code,
+                                     prepared.encoded["identity"], vaf, vvf, encoded=encoding != "identity")
+    if prepared.status_code == 200 and not_modified(request_headers, validators):
+        await send_response(send, 304, b"", headers + [validator for validator in validators
+                                                       if validator[0] != "Content-Type"])
+        return
+    await send_response(send, prepared.status_code, prepared.encoded[encoding], headers + validators)
+
+
+async def send_stale(send, prepared, request_headers, response_headers, http_method, vaf, vvf):
+    """
+    Send a cached response too old to be served, but the upstream failed, see app.proxy.stale_response
+    """
+    metrics.incr("cached_responses_total", freshness=revalidate.STALE_IF_ERROR)
+    response_headers = response_headers + [("Warning", '111 - "Revalidation Failed"')]
+    await send_prepared(send, prepared, request_headers, response_headers, http_method, vaf, vvf)
+
+
+def not_modified(request_headers, validators):
+    """
+    :param request_headers: client headers, with lowercase names
+    :param validators: list of (name, value) returned by response_validators()
+    :return: True if the client copy is still valid
+    """
+    validators = dict(validators)
+    if "if-none-match" in request_headers:
+        if "ETag" not in validators:
+            return False
+        opaque, _ = unquote_etag(validators["ETag"])
+        return parse_etags(request_headers["if-none-match"]).contains_weak(opaque)
+    last_modified = parse_date(validators.get("Last-Modified"))
+    since = parse_date(request_headers.get("if-modified-since"))
+    return last_modified is not None and since is not None and last_modified <= since
+
+
+def response_validators(headers, http_method, status_code, content, vaf, vvf, encoded=False):
+    """
+    Content-Type and the cache validators of a transcribed response, as app.proxy.add_cache_validators sets them.
+    :param headers: upstream headers, see app.proxy.upstream_headers()
+    :param http_method: request method
+    :param status_code: upstream status code
+    :param content: transcribed bytes, None for a 304 Not Modified
+    :param vaf: vaf configuration for andaluh-py
+    :param vvf: vvf configuration for andaluh-py
+    :param encoded: the body is sent compressed, its ETag is weak
+    :return: list of (name, value)
+    """
+    validators = [("Content-Type", headers["Content-Type"])] if "Content-Type" in headers else []
+    if http_method != "GET" or status_code not in (200, 304):
+        return validators
+    etag = output_etag(headers.get("ETag"), content, vaf, vvf)
+    if etag is not None:
+        opaque, weak = etag
+        validators.append(("ETag", f'{"W/" if weak or encoded else ""}"{opaque}"'))
+    if "Last-Modified" in headers:
+        validators.append(("Last-Modified", headers["Last-Modified"]))
+    kind = content_kind(headers.get("Content-Type"))
+    # Upstream 304 responses usually come without Content-Type, and pages are the usual case.
+    if kind is None and status_code == 304:
+        kind = "html"
+    cache_control = CACHE_CONTROL.get(kind) or headers.get("Cache-Control")
+    if cache_control:
+        validators.append(("Cache-Control", cache_control))
+    return validators
+
+
+async def app(scope, receive, send):
+    """
+    ASGI application.
+    """
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if _client is not None:
+                    await _client.aclose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    elif scope["type"] == "http":
+        await get_request(scope, receive, send)
@@ -0,0 +1,312 @@
+"""
+Streamed passthrough of the upstream responses that are not transcribed: images, fonts, scripts and
+stylesheets.
+
+Binary bodies are relayed as they arrive, still compressed, without being buffered. Text bodies are
+decoded and go through the url(/static rewrite of the stylesheets chunk by chunk. With ASSET_CACHE_DIR
+set, the relayed bodies are also kept on disk for as long as their upstream Cache-Control allows, within
+ASSET_CACHE_MAX_BYTES: every ASSET_CACHE_SWEEP_SECONDS, a background thread of one of the workers removes
+the expired entries and the least recently read ones over the budget.
+"""
+import fcntl
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+
+from app import metrics
+from app.compression import negotiate
+
+ASSET_CACHE_DIR = os.getenv("ASSET_CACHE_DIR")
+ASSET_CHUNK_BYTES = int(os.getenv("ASSET_CHUNK_BYTES", 64 * 1024))
+ASSET_CACHE_MAX_BYTES = int(os.getenv("ASSET_CACHE_MAX_BYTES", 1024 * 1024 * 1024))
+ASSET_CACHE_SWEEP_SECONDS = float(os.getenv("ASSET_CACHE_SWEEP_SECONDS", 300))
+# Left by a worker killed while writing an entry
+ASSET_TEMP_FILE_SECONDS = 3600
+
+# Headers of a relayed response, besides the ones of app.proxy.UPSTREAM_HEADERS
+RAW_HEADERS = ["Content-Length", "Content-Encoding"]
+TEXT_CONTENT_TYPES = re.compile(r"text/|application/(?:x-)?(?:javascript|json|xml)|[^;]*\+(?:json|xml)")
+UNCACHEABLE = re.compile(r"no-store|no-cache|private", re.IGNORECASE)
+MAX_AGE = re.compile(r"(?:s-maxage|max-age)=(\d+)", re.IGNORECASE)
+# Content codings of the bodies kept as the upstream sent them, besides the decoded ones
+STORED_ENCODINGS = ("br", "gzip", "deflate")
+# Its modification time is the last sweep of the host
+SWEEP_FILE = ".sweep"
+
+_sweep_lock = threading.Lock()
+
+
+def is_text(content_type):
+    return bool(TEXT_CONTENT_TYPES.match(content_type or ""))
+
+
+def accepts(accept_encoding, encoding):
+    """
+    :param accept_encoding: client Accept-Encoding header, may be None
+    :param encoding: Content-Encoding of a body, None if it is not encoded
+    :return: True if the client can take the body as it is
+    """
+    return encoding in (None, "identity") or negotiate(accept_encoding, (encoding,)) == encoding
+
+
+def rewrite_stream(chunks, old, new):
+    """
+    bytes.replace() on a stream, also replacing the occurrences split across chunks.
+    :param chunks: iterable of byte chunks
+    :param old: bytes to replace, that can't overlap itself
+    :param new: replacement
+    :return: generator of rewritten byte chunks
+    """
+    pending = b""
+    for chunk in chunks:
+        data = pending + chunk if pending else chunk
+        # Keep the end of the chunk that may be the start of an occurrence
+        keep = next((size for size in range(min(len(old) - 1, len(data)), 0, -1) if data.endswith(old[:size])), 0)
+        pending = data[len(data) - keep:] if keep else b""
+        data = data[:len(data) - keep] if keep else data
+        if data:
+            yield data.replace(old, new)
+    if pending:
+        yield pending
+
+
+def cache_path(url, encoding):
+    """
+    :param url: absolute upstream url
+    :param encoding: Content-Encoding of the stored body, "identity" when decoded
+    :return: body file of the cache entry, its metadata is in the same path plus .json
+    """
+    digest = hashlib.sha1(f"{url}\x00{encoding}".encode("utf-8")).hexdigest()
+    return os.path.join(ASSET_CACHE_DIR, digest[:2], digest)
+
+
+def stored_encoding(headers):
+    return headers.get("Content-Encoding") or "identity"
+
+
+def max_age(headers):
+    """
+    :param headers: upstream response headers
+    :return: seconds the response can be cached, 0 if it can't
+    """
+    cache_control = headers.get("Cache-Control") or ""
+    match = MAX_AGE.search(cache_control)
+    if UNCACHEABLE.search(cache_control) or match is None:
+        return 0
+    return int(match.group(1))
+
+
+def cached(url, accept_encoding):
+    """
+    :param url: absolute upstream url
+    :param accept_encoding: client Accept-Encoding header, may be None
+    :return: (headers, open body file) or None
+    """
+    if not ASSET_CACHE_DIR:
+        return None
+    # The same url may be stored both as the upstream sent it and decoded, for the clients that can't take it
+    for encoding in [encoding for encoding in STORED_ENCODINGS if accepts(accept_encoding, encoding)] + ["identity"]:
+        entry = read_entry(url, encoding)
+        if entry is not None:
+            metrics.incr("asset_cache_requests_total", result="hit")
+            return entry
+    return None
+
+
+def read_entry(url, encoding):
+    """
+    :return: (headers, open body file) of the entry of the url stored with that encoding, or None
+    """
+    path = cache_path(url, encoding)
+    try:
+        with open(path + ".json", encoding="utf-8") as f:
+            entry = json.load(f)
+        if entry["expires"] < time.time():
+            os.remove(path + ".json")
+            os.remove(path)
+            return None
+        body = open(path, "rb")
+        # The modification time of the body is its last read, for the least recently used order of sweep()
+        os.utime(path)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Error reading asset cache entry of {url}: {repr(e)}")
+        return None
+    return entry["headers"], body
+
+
+def read_chunks(f):
+    with f:
+        for chunk in iter(lambda: f.read(ASSET_CHUNK_BYTES), b""):
+            yield chunk
+
+
+def relay(resp, url, headers, decode=False, rewrite=None):
+    """
+    Relay the body of an upstream response, requested with stream=True, and keep it in the asset cache.
+    :param resp: upstream response
+    :param url: absolute upstream url, the cache key with the Content-Encoding of the headers
+    :param headers: headers of the relayed response, stored with the body
+    :param decode: relay the body decoded instead of as it was sent
+    :param rewrite: function rewriting the decoded body chunks
+    :return: generator of byte chunks
+    """
+    if decode or rewrite is not None:
+        chunks = resp.iter_content(ASSET_CHUNK_BYTES)
+        if rewrite is not None:
+            chunks = rewrite(chunks)
+    else:
+        chunks = resp.raw.stream(ASSET_CHUNK_BYTES, decode_content=False)
+
+    seconds = max_age(resp.headers) if ASSET_CACHE_DIR and resp.status_code == 200 else 0
+    path = cache_path(url, stored_encoding(headers)) if seconds else None
+    f = open_entry(path, url) if seconds else None
+    if seconds:
+        metrics.incr("asset_cache_requests_total", result="miss")
+    try:
+        for chunk in chunks:
+            if f is not None:
+                try:
+                    f.write(chunk)
+                except OSError as e:
+                    print(f"Error writing asset cache entry of {url}: {repr(e)}")
+                    discard_entry(f)
+                    f = None
+            yield chunk
+        if f is not None:
+            store_entry(f, path, url, headers, seconds)
+            f = None
+    finally:
+        resp.close()
+        if f is not None:
+            discard_entry(f)
+
+
+def open_entry(path, url):
+    """
+    :param path: body file of the entry, see cache_path()
+    :param url: absolute upstream url
+    :return: temporary file of a new cache entry, None if it can't be created
+    """
+    try:
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        return tempfile.NamedTemporaryFile(dir=directory, delete=False)
+    except OSError as e:
+        print(f"Error creating asset cache entry of {url}: {repr(e)}")
+        return None
+
+
+def store_entry(f, path, url, headers, seconds):
+    try:
+        f.close()
+        with open(f.name + ".json", "w", encoding="utf-8") as meta:
+            json.dump({"headers": headers, "expires": time.time() + seconds}, meta)
+        # The body first, an entry is complete once its metadata is in place
+        os.replace(f.name, path)
+        os.replace(f.name + ".json", path + ".json")
+    except OSError as e:
+        print(f"Error writing asset cache entry of {url}: {repr(e)}")
+        discard_entry(f)
+        return
+    maybe_sweep()
+
+
+def discard_entry(f):
+    f.close()
+    for name in (f.name, f.name + ".json"):
+        try:
+            os.remove(name)
+        except OSError:
+            pass
+
+
+def maybe_sweep():
+    """
+    Start a sweep() in a background thread when the last one of the host is older than ASSET_CACHE_SWEEP_SECONDS.
+    """
+    try:
+        last = os.stat(os.path.join(ASSET_CACHE_DIR, SWEEP_FILE)).st_mtime
+    except FileNotFoundError:
+        last = 0
+    except OSError as e:
+        print(f"Error reading asset cache sweep time: {repr(e)}")
+        return
+    if time.time() - last >= ASSET_CACHE_SWEEP_SECONDS and _sweep_lock.acquire(blocking=False):
+        threading.Thread(target=locked_sweep, daemon=True).start()
+
+
+def locked_sweep():
+    try:
+        with open(os.path.join(ASSET_CACHE_DIR, SWEEP_FILE), "a") as f:
+            # One worker of the host sweeps, the others skip it
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            os.utime(f.name)
+            sweep(ASSET_CACHE_DIR, ASSET_CACHE_MAX_BYTES)
+    except Exception as e:
+        print(f"Error sweeping asset cache {ASSET_CACHE_DIR}: {repr(e)}")
+    finally:
+        _sweep_lock.release()
+
+
+def sweep(directory, max_bytes):
+    """
+    Remove the expired entries of the asset cache, then the least recently read ones until it fits the byte budget.
+    :param directory: asset cache directory
+    :param max_bytes: byte budget of the bodies and their metadata
+    """
+    now = time.time()
+    entries = []
+    total = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                if name.startswith("tmp"):
+                    if now - os.stat(path).st_mtime >= ASSET_TEMP_FILE_SECONDS:
+                        os.remove(path)
+                    continue
+                if not name.endswith(".json") or root == directory:
+                    continue
+                path = path[:-len(".json")]
+                with open(path + ".json", encoding="utf-8") as f:
+                    expires = json.load(f)["expires"]
+                if expires < now:
+                    remove_entry(path)
+                    continue
+                body = os.stat(path)
+                size = body.st_size + os.stat(path + ".json").st_size
+            except FileNotFoundError:
+                # Removed or replaced meanwhile
+                continue
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Error reading asset cache entry {path}: {repr(e)}")
+                continue
+            entries.append((body.st_mtime, size, path))
+            total += size
+
+    evicted = 0
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        remove_entry(path)
+        total -= size
+        evicted += 1
+    metrics.incr("asset_cache_evictions_total", evicted)
+
+
+def remove_entry(path):
+    # The metadata first, an entry without it is never read
+    for name in (path + ".json", path):
+        try:
+            os.remove(name)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,124 @@
+"""
+Incremental transcription of the new revisions of a page.
+
+An edit usually changes a paragraph or two of an article. The text nodes of a page are grouped by
+their closest block element (paragraph, list item, heading, table cell...), and the page cache keeps,
+for the last transcribed revision of each page and variant, the transcriptions of its blocks by a hash
+of their text. When a new revision comes, the blocks found in that map are spliced back as they are,
+and only the new or changed ones are transcribed.
+"""
+import hashlib
+import json
+import os
+
+from app import metrics
+from app.cache import page_cache
+
+DISABLE_INCREMENTAL_TRANSCRIPTION = bool(os.getenv("DISABLE_INCREMENTAL_TRANSCRIPTION"))
+
+BLOCK_ELEMENTS = frozenset(("title", "body", "div", "section", "p", "li", "dt", "dd", "h1", "h2", "h3", "h4", "h5",
+                            "h6", "td", "th", "caption", "figcaption", "blockquote", "pre"))
+# Revision and variant suffix of the block maps in the page cache, never those of a page
+BLOCKS_REVISION = "blocks"
+BLOCK_SEPARATOR = "\x1e"
+
+
+class BlockTranscriptions:
+    """
+    Transcriptions of the blocks of a page, by hash of their text: those of the previous revision,
+    looked up, and those of the page being transcribed, stored for the next revision.
+    """
+
+    def __init__(self, previous=None):
+        """
+        :param previous: dict of block hash -> list of transcriptions of its text nodes
+        """
+        self.previous = previous or {}
+        self.current = {}
+
+
+def block_of(node):
+    """
+    :param node: NavigableString
+    :return: closest ancestor in BLOCK_ELEMENTS, or the parent of the node
+    """
+    parent = node.parent
+    while parent is not None and parent.name not in BLOCK_ELEMENTS:
+        parent = parent.parent
+    return parent if parent is not None else node.parent
+
+
+def block_hash(texts):
+    return hashlib.sha1(BLOCK_SEPARATOR.join(texts).encode("utf-8")).hexdigest()
+
+
+def transcribe_blocks(nodes, transcribe_texts, blocks):
+    """
+    Transcribe the text nodes of a page, reusing the transcriptions of the unchanged blocks.
+    :param nodes: list of NavigableString
+    :param transcribe_texts: function transcribing a list of texts to the variant
+    :param blocks: BlockTranscriptions, its current map is filled with the blocks of the page
+    :return: list of transcriptions, in the same order as the nodes
+    """
+    # Text node indexes of each block, blocks in the order of their first text
+    grouped = {}
+    for i, node in enumerate(nodes):
+        grouped.setdefault(id(block_of(node)), []).append(i)
+
+    texts = [str(node) for node in nodes]
+    hashes = []
+    pending = []
+    for indexes in grouped.values():
+        block_texts = [texts[i] for i in indexes]
+        digest = block_hash(block_texts)
+        hashes.append(digest)
+        if digest in blocks.current:
+            continue
+        previous = blocks.previous.get(digest)
+        if previous is not None and len(previous) == len(indexes):
+            blocks.current[digest] = previous
+        else:
+            blocks.current[digest] = None
+            pending.append((digest, block_texts))
+    metrics.incr("block_transcriptions_total", len(hashes) - len(pending), result="reused")
+    metrics.incr("block_transcriptions_total", len(pending), result="transcribed")
+
+    # One call for all the changed blocks, so they are still transcribed in batches
+    transcribed = iter(transcribe_texts([text for _, block_texts in pending for text in block_texts]))
+    for digest, block_texts in pending:
+        blocks.current[digest] = [next(transcribed) for _ in block_texts]
+
+    transcriptions = [None] * len(nodes)
+    for indexes, digest in zip(grouped.values(), hashes):
+        for i, transcription in zip(indexes, blocks.current[digest]):
+            transcriptions[i] = transcription
+    return transcriptions
+
+
+def blocks_key(url, vaf, vvf):
+    return page_cache.key(url, BLOCKS_REVISION, vaf, vvf)
+
+
+def load(url, vaf, vvf):
+    """
+    :param url: upstream url of the page
+    :param vaf: vaf configuration for andaluh-py
+    :param vvf: vvf configuration for andaluh-py
+    :return: BlockTranscriptions with the blocks of the last revision transcribed, or None if disabled
+    """
+    if DISABLE_INCREMENTAL_TRANSCRIPTION or not page_cache.enabled:
+        return None
+    cached = page_cache.get(blocks_key(url, vaf, vvf))
+    return BlockTranscriptions(json.loads(cached["identity"]) if cached is not None else None)
+
+
+def store(url, vaf, vvf, blocks):
+    """
+    Keep the blocks of the page just transcribed for its next revision.
+    :param blocks: BlockTranscriptions returned by load()
+    """
+    if blocks is None or not blocks.current:
+        return
+    content = json.dumps(blocks.current, ensure_ascii=False).encode("utf-8")
+    page_cache.set(blocks_key(url, vaf, vvf), {"identity": content}, path=url, variant=vaf + vvf + BLOCKS_REVISION,
+                   revision=BLOCKS_REVISION, content_type="application/json")
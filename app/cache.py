@@ -0,0 +1,379 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from cachetools import LRUCache
+
+from app import metrics
+from app.memcache import page_memory_cache
+
+PAGE_CACHE_PATH = os.getenv("PAGE_CACHE_PATH", "/tmp/andaluh-wiki-cache.sqlite3")
+PAGE_CACHE_MAX_BYTES = int(os.getenv("PAGE_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+# Store built by app.warmup, copied into an empty page cache on startup
+PAGE_CACHE_SEED = os.getenv("PAGE_CACHE_SEED")
+# Latest page of each path and variant known to a worker, whose content is looked up in its memory cache
+PAGE_INDEX_ENTRIES = int(os.getenv("PAGE_INDEX_ENTRIES", 10000))
+
+WKP_REVISION_ID = re.compile(rb'"wgRevisionId":(\d+)')
+
+# Bump it on any change of SCHEMA, the cache is dropped and created again.
+SCHEMA_VERSION = 4
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pages (
+    key TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    variant TEXT NOT NULL,
+    revision TEXT NOT NULL,
+    content_type TEXT,
+    status INTEGER NOT NULL,
+    body BLOB NOT NULL,
+    gzip BLOB,
+    br BLOB,
+    headers TEXT,
+    size INTEGER NOT NULL,
+    -- Last time the upstream confirmed the revision, see get()
+    created REAL NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS pages_accessed ON pages (accessed);
+CREATE INDEX IF NOT EXISTS pages_path ON pages (path, variant, created);
+CREATE TABLE IF NOT EXISTS leases (
+    name TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires REAL NOT NULL
+);
+"""
+
+
+def upstream_revision(resp):
+    """
+    Best effort identifier of the upstream revision a response belongs to.
+    Uses the HTTP validators when present, then the MediaWiki revision id embedded in the page.
+    :param resp: upstream response
+    :return: revision identifier as a string
+    """
+    etag = resp.headers.get("ETag")
+    if etag:
+        return etag
+
+    last_modified = resp.headers.get("Last-Modified")
+    if last_modified:
+        return last_modified
+
+    return content_revision(resp.content) or "sha1:" + hashlib.sha1(resp.content).hexdigest()
+
+
+def content_revision(content):
+    """
+    :param content: MediaWiki page as bytes
+    :return: revision identifier of the MediaWiki revision embedded in the page, or None
+    """
+    revision_id = WKP_REVISION_ID.search(content)
+    if revision_id is not None:
+        return "rev:" + revision_id.group(1).decode("ascii")
+    return None
+
+
+class SharedPageCache:
+    """
+    Host-wide cache of transcribed pages backed by a SQLite file, shared by every worker process.
+    Entries are evicted in least recently used order once the byte budget is exceeded.
+    The pages read or stored by a worker are also kept in its memory, see app.memcache, with an index of
+    the latest one of each path and variant for latest().
+    """
+
+    def __init__(self, path=PAGE_CACHE_PATH, max_bytes=PAGE_CACHE_MAX_BYTES, seed=PAGE_CACHE_SEED):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.seed = seed
+        self._local = threading.local()
+        # (path, variant) -> (key, upstream headers, upstream status code, timestamp stored or validated)
+        self._index = LRUCache(maxsize=PAGE_INDEX_ENTRIES)
+        # key -> (path, variant) of the index entries, to update them when a page is validated
+        self._indexed_keys = LRUCache(maxsize=PAGE_INDEX_ENTRIES)
+        self._index_lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    @staticmethod
+    def key(path, revision, vaf, vvf):
+        """
+        Cache key for a transcribed page.
+        :param path: requested path, including the query string
+        :param revision: upstream revision, see upstream_revision()
+        :param vaf: vaf configuration for andaluh-py
+        :param vvf: vvf configuration for andaluh-py
+        :return: cache key
+        """
+        raw = "\x00".join((path, revision, vaf, vvf))
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    def _connection(self):
+        # Connections must not cross a fork (uwsgi master -> workers) nor be shared between threads.
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            if conn.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+                conn.execute("DROP TABLE IF EXISTS pages")
+                conn.execute("DROP TABLE IF EXISTS leases")
+                conn.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+            conn.executescript(SCHEMA)
+            self._seed(conn)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _seed(self, conn):
+        # Every worker may try, the first one fills the cache and the others find it not empty.
+        if not self.seed or not os.path.exists(self.seed) or os.path.abspath(self.seed) == os.path.abspath(self.path):
+            return
+        if conn.execute("SELECT 1 FROM pages LIMIT 1").fetchone() is not None:
+            return
+        conn.execute("ATTACH DATABASE ? AS seed", (self.seed,))
+        try:
+            if conn.execute("PRAGMA seed.user_version").fetchone()[0] != SCHEMA_VERSION:
+                print(f"Ignoring page cache seed {self.seed}, built for another schema version")
+                return
+            conn.execute("INSERT OR IGNORE INTO pages SELECT * FROM seed.pages")
+            self._evict(conn)
+        finally:
+            conn.execute("DETACH DATABASE seed")
+
+    def get(self, key, validated=False):
+        """
+        :param key: cache key
+        :param validated: the upstream just answered with the revision of the key, the entry is as
+            recent as a newly stored one for latest()
+        :return: dict of content encoding -> bytes, with at least "identity", or None
+        """
+        if not self.enabled:
+            return None
+        encoded = page_memory_cache.get(key)
+        try:
+            conn = self._connection()
+            if encoded is None:
+                row = conn.execute("SELECT body, gzip, br FROM pages WHERE key = ?", (key,)).fetchone()
+                metrics.incr("page_cache_requests_total", result="miss" if row is None else "hit")
+                if row is None:
+                    return None
+                encoded = self._encoded(row)
+                page_memory_cache.set(key, encoded)
+            elif not validated:
+                # The least recently used order of the host is left to the SQLite hits
+                return encoded
+            now = time.time()
+            if validated:
+                conn.execute("UPDATE pages SET accessed = ?, created = ? WHERE key = ?", (now, now, key))
+                self._index_validated(key, now)
+            else:
+                conn.execute("UPDATE pages SET accessed = ? WHERE key = ?", (now, key))
+            return encoded
+        except sqlite3.Error as e:
+            print(f"Error reading shared page cache {self.path}: {repr(e)}")
+            return encoded
+
+    def latest(self, path, variant, since, memory_since=None):
+        """
+        Most recent page stored for a path, whatever its revision.
+        :param path: upstream url of the page
+        :param variant: vaf and vvf of the transcription
+        :param since: only pages stored or validated at or after this timestamp are returned
+        :param memory_since: the page known to this worker is returned from its memory if it was stored or
+            validated at or after this timestamp, default since. Other workers may have stored a newer
+            revision or validated it since, the page store is read otherwise.
+        :return: (dict of content encoding -> bytes, dict of upstream headers, upstream status code,
+            timestamp it was stored or validated) or None
+        """
+        if not self.enabled:
+            return None
+        memory_since = since if memory_since is None else max(since, memory_since)
+        with self._index_lock:
+            indexed = self._index.get((path, variant))
+        if indexed is not None and indexed[3] >= memory_since:
+            key, headers, status, created = indexed
+            encoded = page_memory_cache.get(key)
+            if encoded is not None:
+                return encoded, headers, status, created
+        try:
+            row = self._connection().execute(
+                "SELECT key, body, gzip, br, headers, status, created FROM pages "
+                "WHERE path = ? AND variant = ? AND created >= ? "
+                "ORDER BY created DESC LIMIT 1", (path, variant, since)).fetchone()
+        except sqlite3.Error as e:
+            print(f"Error reading shared page cache {self.path}: {repr(e)}")
+            return None
+        if row is None:
+            return None
+        key, status, created = row[0], row[5], row[6]
+        encoded = self._encoded(row[1:4])
+        headers = json.loads(row[4] or "{}")
+        page_memory_cache.set(key, encoded)
+        self._index_page(path, variant, key, headers, status, created)
+        return encoded, headers, status, created
+
+    def _index_page(self, path, variant, key, headers, status, created):
+        with self._index_lock:
+            indexed = self._index.get((path, variant))
+            if indexed is None or indexed[3] <= created:
+                self._index[(path, variant)] = (key, headers, status, created)
+                self._indexed_keys[key] = (path, variant)
+
+    def _index_validated(self, key, validated):
+        with self._index_lock:
+            index_key = self._indexed_keys.get(key)
+            indexed = self._index.get(index_key) if index_key is not None else None
+            if indexed is not None and indexed[0] == key:
+                self._index[index_key] = (key, indexed[1], indexed[2], validated)
+
+    def hottest(self, limit):
+        """
+        Most recently read pages, e.g. to load them in memory on startup.
+        :param limit: maximum pages
+        :return: list of (cache key, dict of content encoding -> bytes), most recent first
+        """
+        if not self.enabled:
+            return []
+        try:
+            rows = self._connection().execute(
+                "SELECT key, body, gzip, br FROM pages ORDER BY accessed DESC LIMIT ?", (limit,)).fetchall()
+        except sqlite3.Error as e:
+            print(f"Error reading shared page cache {self.path}: {repr(e)}")
+            return []
+        return [(row[0], self._encoded(row[1:])) for row in rows]
+
+    @staticmethod
+    def _encoded(row):
+        encoded = {"identity": bytes(row[0])}
+        for encoding, blob in (("gzip", row[1]), ("br", row[2])):
+            if blob is not None:
+                encoded[encoding] = bytes(blob)
+        return encoded
+
+    def set(self, key, encoded, path="", variant="", revision="", content_type=None, headers=None, status=200):
+        """
+        Store a transcribed page and evict the least recently used entries over the byte budget.
+        :param key: cache key
+        :param encoded: dict of content encoding -> bytes, with at least "identity"
+        :param headers: upstream headers of the page, see latest()
+        :param status: upstream status code of the page
+        """
+        size = sum(len(blob) for blob in encoded.values())
+        if not self.enabled or size > self.max_bytes:
+            return
+        page_memory_cache.set(key, encoded)
+        now = time.time()
+        if path:
+            self._index_page(path, variant, key, headers or {}, status, now)
+        try:
+            conn = self._connection()
+            conn.execute(
+                "INSERT OR REPLACE INTO pages (key, path, variant, revision, content_type, status, body, gzip, br, "
+                "headers, size, created, accessed) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, path, variant, revision, content_type, status, encoded["identity"], encoded.get("gzip"),
+                 encoded.get("br"), json.dumps(headers or {}), size, now, now))
+            self._evict(conn)
+        except sqlite3.Error as e:
+            print(f"Error writing shared page cache {self.path}: {repr(e)}")
+
+    def _evict(self, conn):
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        excess = total - self.max_bytes
+        freed = 0
+        victims = []
+        for key, size in conn.execute("SELECT key, size FROM pages ORDER BY accessed"):
+            victims.append((key,))
+            freed += size
+            if freed >= excess:
+                break
+        conn.executemany("DELETE FROM pages WHERE key = ?", victims)
+
+    def acquire_lease(self, name, seconds):
+        """
+        Take a lease shared by every worker process, such as the right to fetch and transcribe a page.
+        Fails open: without a cache file every caller gets the lease.
+        :param name: lease name
+        :param seconds: the lease expires after this time even if it is never released
+        :return: True if the lease was acquired
+        """
+        if not self.enabled:
+            return True
+        now = time.time()
+        try:
+            conn = self._connection()
+            conn.execute("DELETE FROM leases WHERE name = ? AND expires < ?", (name, now))
+            cursor = conn.execute("INSERT OR IGNORE INTO leases (name, owner, expires) VALUES (?, ?, ?)",
+                                  (name, self._owner(), now + seconds))
+            return cursor.rowcount == 1
+        except sqlite3.Error as e:
+            print(f"Error acquiring lease {name}: {repr(e)}")
+            return True
+
+    def lease_held(self, name):
+        """
+        :param name: lease name
+        :return: True while another caller holds the lease
+        """
+        if not self.enabled:
+            return False
+        try:
+            row = self._connection().execute(
+                "SELECT 1 FROM leases WHERE name = ? AND expires >= ?", (name, time.time())).fetchone()
+            return row is not None
+        except sqlite3.Error as e:
+            print(f"Error reading lease {name}: {repr(e)}")
+            return False
+
+    def count_leases(self, prefix):
+        """
+        :param prefix: start of the lease names
+        :return: number of unexpired leases whose name starts with prefix, 0 without a cache file
+        """
+        if not self.enabled:
+            return 0
+        try:
+            return self._connection().execute(
+                "SELECT COUNT(*) FROM leases WHERE substr(name, 1, ?) = ? AND expires >= ?",
+                (len(prefix), prefix, time.time())).fetchone()[0]
+        except sqlite3.Error as e:
+            print(f"Error counting leases {prefix}: {repr(e)}")
+            return 0
+
+    def release_lease(self, name):
+        """
+        :param name: lease name, only released if it is held by this thread
+        """
+        if not self.enabled:
+            return
+        try:
+            self._connection().execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, self._owner()))
+        except sqlite3.Error as e:
+            print(f"Error releasing lease {name}: {repr(e)}")
+
+    def close(self):
+        """
+        Close the connection of this thread, before forking: a SQLite connection open across a fork may
+        corrupt the database when the parent uses it again or exits. The next call opens a new one.
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            return
+        self._local.conn = None
+        if self._local.pid == os.getpid():
+            conn.close()
+
+    @staticmethod
+    def _owner():
+        return f"{os.getpid()}:{threading.get_ident()}"
+
+
+page_cache = SharedPageCache()
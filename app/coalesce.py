@@ -0,0 +1,105 @@
+"""
+Single-flight execution of concurrent misses on the same page.
+
+When an article trends, many clients ask for it at the same time. The first request of a worker
+process fetches and transcribes it, while the other requests of that process wait for its result.
+Across processes, the leaders hold a lease of the shared page cache and the leaders of the other
+processes wait for it to be released, then take the page the first one stored in the cache.
+"""
+import os
+import threading
+import time
+
+from app import metrics
+from app.cache import page_cache
+
+# Seconds a request waits for another one working on the same page. 0 disables coalescing.
+COALESCE_WAIT_TIMEOUT = float(os.getenv("COALESCE_WAIT_TIMEOUT", 10))
+# A lease outlives a worker killed in the middle of a request for no more than this.
+COALESCE_LEASE_SECONDS = float(os.getenv("COALESCE_LEASE_SECONDS", 30))
+COALESCE_POLL_INTERVAL = 0.05
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+class Flight:
+    """
+    Work in progress for a key in this worker process.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+
+def single_flight(key, work, shared_result=None, shareable=None):
+    """
+    Run work() once for all the concurrent callers with the same key.
+    Callers that wait longer than COALESCE_WAIT_TIMEOUT, or whose leader got no result, run work()
+    themselves.
+    :param key: string identifying the work
+    :param work: callable producing the result. None results are not shared.
+    :param shared_result: callable taking a timestamp and returning the result stored since then by
+        the leader of another process, or None. Without it there is no coordination across processes.
+    :param shareable: callable telling if a result can be shared. Streamed bodies, read once, can't.
+    :return: result of work()
+    """
+    if COALESCE_WAIT_TIMEOUT <= 0:
+        return work()
+
+    with _flights_lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = Flight()
+
+    if not leader:
+        with metrics.stage("coalesce"):
+            done = flight.done.wait(COALESCE_WAIT_TIMEOUT)
+        if done and flight.result is not None:
+            metrics.incr("coalesced_requests_total", scope="worker")
+            return flight.result
+        metrics.incr("coalesce_fallbacks_total")
+        return work()
+
+    try:
+        result = lead(key, work, shared_result)
+        if shareable is None or shareable(result):
+            flight.result = result
+        return result
+    finally:
+        with _flights_lock:
+            del _flights[key]
+        flight.done.set()
+
+
+def lead(key, work, shared_result):
+    """
+    Run work() on behalf of this worker process, unless another process is already on it.
+    :param key: string identifying the work
+    :param work: callable producing the result
+    :param shared_result: see single_flight()
+    :return: result of work()
+    """
+    if shared_result is None:
+        return work()
+
+    if page_cache.acquire_lease(key, COALESCE_LEASE_SECONDS):
+        try:
+            return work()
+        finally:
+            page_cache.release_lease(key)
+
+    started = time.time()
+    deadline = started + COALESCE_WAIT_TIMEOUT
+    with metrics.stage("coalesce"):
+        while page_cache.lease_held(key) and time.time() < deadline:
+            time.sleep(COALESCE_POLL_INTERVAL)
+
+    result = shared_result(started)
+    if result is not None:
+        metrics.incr("coalesced_requests_total", scope="host")
+        return result
+    metrics.incr("coalesce_fallbacks_total")
+    return work()
@@ -0,0 +1,76 @@
+import os
+import time
+import zlib
+
+from app import metrics
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", 6))
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", 6))
+
+# Preferred first
+ENCODINGS = ("br", "gzip") if brotli is not None else ("gzip",)
+
+
+def gzip_compress(data):
+    # Fixed header (no mtime) so the same page always compresses to the same bytes.
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def compress(data, encoding):
+    """
+    Compress data and record the compression ratio and CPU time.
+    :param data: bytes to compress
+    :param encoding: "gzip" or "br"
+    :return: compressed bytes
+    """
+    start = time.process_time()
+    if encoding == "br":
+        compressed = brotli.compress(data, quality=BROTLI_QUALITY)
+    else:
+        compressed = gzip_compress(data)
+    metrics.incr("compression_seconds_total", time.process_time() - start, encoding=encoding)
+    metrics.incr("compression_input_bytes_total", len(data), encoding=encoding)
+    metrics.incr("compression_output_bytes_total", len(compressed), encoding=encoding)
+    return compressed
+
+
+def compress_all(data):
+    """
+    :param data: bytes to compress
+    :return: dict of content encoding -> bytes, including the uncompressed "identity" encoding
+    """
+    encoded = {"identity": data}
+    with metrics.stage("compress"):
+        for encoding in ENCODINGS:
+            encoded[encoding] = compress(data, encoding)
+    return encoded
+
+
+def negotiate(accept_encoding, available):
+    """
+    Choose the content encoding of a response.
+    :param accept_encoding: client Accept-Encoding header, may be None
+    :param available: encodings at hand
+    :return: chosen encoding, "identity" when no compressed one is acceptable
+    """
+    accepted = {}
+    for item in (accept_encoding or "").split(","):
+        coding, _, params = item.strip().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[coding.strip().lower()] = quality
+
+    for encoding in ENCODINGS:
+        if encoding in available and accepted.get(encoding, accepted.get("*", 0)) > 0:
+            return encoding
+    return "identity"
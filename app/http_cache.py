@@ -0,0 +1,62 @@
+"""
+HTTP cache validators for transcribed responses.
+
+Our ETags are the upstream ETag plus a tag of the vaf/vvf variant and of the transcription pipeline,
+so a client validator can be mapped back to the upstream one and revalidated there.
+"""
+import hashlib
+import os
+import re
+
+# Bump it whenever a change in the proxy changes the transcribed output.
+TRANSCRIPTION_VERSION = "1"
+
+CACHE_CONTROL = {
+    "html": os.getenv("CACHE_CONTROL_HTML", "public, max-age=60"),
+    "summary": os.getenv("CACHE_CONTROL_SUMMARY", "public, max-age=300"),
+    "css": os.getenv("CACHE_CONTROL_CSS", "public, max-age=3600"),
+}
+
+ETAG_RE = re.compile(r'(W/)?"([^"]*)"')
+
+
+def variant_tag(vaf, vvf):
+    """
+    :param vaf: vaf configuration for andaluh-py
+    :param vvf: vvf configuration for andaluh-py
+    :return: short ascii tag of the variant and transcription pipeline version
+    """
+    return hashlib.sha1(f"{vaf}{vvf}{TRANSCRIPTION_VERSION}".encode("utf-8")).hexdigest()[:8]
+
+
+def output_etag(upstream_etag, content, vaf, vvf):
+    """
+    ETag of a transcribed response.
+    :param upstream_etag: upstream ETag header, may be None
+    :param content: transcribed bytes, hashed when there is no upstream ETag. May be None.
+    :param vaf: vaf configuration for andaluh-py
+    :param vvf: vvf configuration for andaluh-py
+    :return: (opaque tag, weak) or None
+    """
+    match = ETAG_RE.match(upstream_etag or "")
+    if match:
+        return f"{match.group(2)}.{variant_tag(vaf, vvf)}", bool(match.group(1))
+    if content is not None:
+        return hashlib.sha1(content).hexdigest(), False
+    return None
+
+
+def upstream_if_none_match(if_none_match, vaf, vvf):
+    """
+    Translate the client If-None-Match header to upstream ETags.
+    :param if_none_match: client If-None-Match header, may be None
+    :param vaf: vaf configuration for andaluh-py
+    :param vvf: vvf configuration for andaluh-py
+    :return: If-None-Match header for the upstream or None
+    """
+    suffix = "." + variant_tag(vaf, vvf)
+    etags = []
+    for weak, opaque in ETAG_RE.findall(if_none_match or ""):
+        if opaque.endswith(suffix):
+            etags.append(f'{weak}"{opaque[:-len(suffix)]}"')
+    return ", ".join(etags) or None
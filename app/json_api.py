@@ -0,0 +1,214 @@
+"""
+Transcription of the JSON APIs of MediaWiki.
+
+Each API is registered with the paths of its fields to transcribe, so supporting a new endpoint is
+one register() call. Responses are cached for a short time, and every transcribed field value is
+cached for longer: successive search-as-you-type queries return mostly the same titles, which are
+then transcribed once.
+"""
+import os
+import re
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+
+from cachetools import LRUCache
+
+from app import metrics, revalidate
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+    import json
+
+JSON_API_TTL = int(os.getenv("JSON_API_TTL", 60))
+JSON_API_STALE_TTL = int(os.getenv("JSON_API_STALE_TTL", 300))
+JSON_API_STALE_IF_ERROR_TTL = int(os.getenv("JSON_API_STALE_IF_ERROR_TTL", 3600))
+JSON_API_CACHE_SIZE = int(os.getenv("JSON_API_CACHE_SIZE", 1000))
+JSON_FIELD_CACHE_SIZE = int(os.getenv("JSON_FIELD_CACHE_SIZE", 50000))
+
+# Markup and character references are kept as they are in html fields
+HTML_MARKUP = re.compile(r"(<[^>]*>|&#?\w+;)")
+
+# Field path segment matching every item of a list or every value of an object
+ANY = "*"
+
+
+class JsonApi:
+    """
+    JSON endpoint whose responses are transcribed.
+    """
+
+    def __init__(self, name, path, fields, html_fields=(), params=None, ttl=JSON_API_TTL, stale_ttl=JSON_API_STALE_TTL,
+                 stale_if_error_ttl=JSON_API_STALE_IF_ERROR_TTL):
+        """
+        :param name: API name, used in metrics
+        :param path: regular expression matching the start of the request path, without the leading slash
+        :param fields: paths of the text fields, dot separated keys or list indexes, * for any of them
+        :param html_fields: paths of the fields holding html fragments
+        :param params: query parameters the request must have, as {name: value}
+        :param ttl: seconds the transcribed responses are fresh, 0 to not cache them
+        :param stale_ttl: seconds the transcribed responses are served stale after that, see app.revalidate
+        :param stale_if_error_ttl: seconds they are served after that when the upstream fails
+        """
+        self.name = name
+        self.path = re.compile(path)
+        self.fields = [(compile_field(field), False) for field in fields] + \
+                      [(compile_field(field), True) for field in html_fields]
+        self.params = params or {}
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.stale_if_error_ttl = stale_if_error_ttl
+        self.cache = LRUCache(maxsize=JSON_API_CACHE_SIZE) if ttl > 0 else None
+
+    def matches(self, path, params):
+        return bool(self.path.match(path)) and all(params.get(name) == [value] for name, value in self.params.items())
+
+
+def compile_field(field):
+    return tuple(int(segment) if segment.isdigit() else segment for segment in field.split("."))
+
+
+JSON_APIS = []
+_lock = threading.Lock()
+field_cache = LRUCache(maxsize=JSON_FIELD_CACHE_SIZE)
+
+
+def register(name, path, fields, **options):
+    """
+    Register a JSON API to transcribe, see JsonApi.
+    """
+    JSON_APIS.append(JsonApi(name, path, fields, **options))
+
+
+register("summary", r"api/rest_v1/page/summary/",
+         fields=["title", "description", "extract"], html_fields=["displaytitle", "extract_html"])
+# [query, [titles], [descriptions], [urls]]
+register("opensearch", r"w/api\.php$", params={"action": "opensearch"}, fields=["1.*", "2.*"])
+register("rest_search", r"w/rest\.php/v1/search/(page|title)$",
+         fields=["pages.*.title", "pages.*.matched_title", "pages.*.description"], html_fields=["pages.*.excerpt"])
+
+
+def match(url):
+    """
+    :param url: upstream url, including the query string
+    :return: JsonApi or None
+    """
+    parts = urlsplit(url)
+    path = parts.path.lstrip("/")
+    params = parse_qs(parts.query)
+    for api in JSON_APIS:
+        if api.matches(path, params):
+            return api
+    return None
+
+
+def loads(content):
+    return orjson.loads(content) if orjson is not None else json.loads(content)
+
+
+def dumps(data):
+    if orjson is not None:
+        return orjson.dumps(data)
+    # Compact as orjson, the bytes are the same whichever is installed
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def cached_response(api, key):
+    """
+    :param api: JsonApi
+    :param key: hashable cache key, including the url and the variant
+    :return: (cached value, seconds since it was cached) or None once it is too old to be served
+    """
+    if api.cache is None:
+        return None
+    with _lock:
+        entry = api.cache.get(key)
+    max_age = revalidate.max_age(api.ttl, api.stale_ttl, api.stale_if_error_ttl)
+    if entry is not None and time.time() - entry[1] >= max_age:
+        entry = None
+    metrics.incr("json_api_cache_requests_total", api=api.name, result="miss" if entry is None else "hit")
+    if entry is None:
+        return None
+    value, cached = entry
+    return value, time.time() - cached
+
+
+def cache_response(api, key, value):
+    if api.cache is not None:
+        with _lock:
+            api.cache[key] = (value, time.time())
+
+
+def field_values(data, field):
+    """
+    :param data: decoded JSON
+    :param field: compiled field path
+    :return: list of (container, key) holding a string at that path
+    """
+    found = []
+    pending = [(data, 0)]
+    while pending:
+        value, depth = pending.pop()
+        segment = field[depth]
+        if segment == ANY:
+            keys = range(len(value)) if isinstance(value, list) else value.keys() if isinstance(value, dict) else ()
+        elif isinstance(value, dict) and segment in value or \
+                isinstance(value, list) and isinstance(segment, int) and segment < len(value):
+            keys = (segment,)
+        else:
+            keys = ()
+        for key in keys:
+            if depth + 1 == len(field):
+                if isinstance(value[key], str):
+                    found.append((value, key))
+            else:
+                pending.append((value[key], depth + 1))
+    return found
+
+
+def transcribe_json(content, api, transcribe_texts, variant):
+    """
+    Transcribe the registered fields of a JSON response.
+    :param content: response body
+    :param api: JsonApi matching the response
+    :param transcribe_texts: function transcribing a list of texts to the variant
+    :param variant: vaf and vvf, part of the field cache keys
+    :return: transcribed body
+    """
+    try:
+        data = loads(content)
+    except ValueError as e:
+        print(f"Error decoding {api.name} JSON response: {repr(e)}")
+        return content
+
+    # Text pieces of every field, html fields split around their markup
+    fields = []
+    texts = []
+    for field, is_html in api.fields:
+        for container, key in field_values(data, field):
+            pieces = HTML_MARKUP.split(container[key]) if is_html else [container[key]]
+            fields.append((container, key, pieces))
+            texts.extend(pieces[::2] if is_html else pieces)
+
+    transcriptions = dict.fromkeys(text for text in texts if text and not text.isspace())
+    pending = []
+    with _lock:
+        for text in transcriptions:
+            transcriptions[text] = field_cache.get((text, variant))
+            if transcriptions[text] is None:
+                pending.append(text)
+    metrics.incr("json_field_cache_requests_total", len(transcriptions) - len(pending), result="hit")
+    metrics.incr("json_field_cache_requests_total", len(pending), result="miss")
+    if pending:
+        # Transcribed outside the lock, taken by every cache lookup
+        transcribed = transcribe_texts(pending)
+        with _lock:
+            for text, transcription in zip(pending, transcribed):
+                transcriptions[text] = field_cache[(text, variant)] = transcription
+
+    for container, key, pieces in fields:
+        pieces[::2] = [transcriptions.get(piece) or piece for piece in pieces[::2]]
+        container[key] = "".join(pieces)
+    return dumps(data)
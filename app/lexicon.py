@@ -0,0 +1,242 @@
+"""
+Precomputed word -> EPA transcription lexicons.
+
+Every andaluh-py rule works inside a single word, except the escaping of links and the
+/l/ -> /r/ rotation between words. So a text without escaped tokens transcribes exactly
+as its words transcribed one by one, followed by andaluh's own word interaction rules.
+The lexicon stores those per word transcriptions, one file per vaf/vvf variant, as sorted
+arrays in a memory-mapped file shared by every worker process on the host.
+
+Usage:
+    python -m app.lexicon build words.txt --output lexicon/ [--variants ç:h,s:j]
+    python -m app.lexicon verify corpus.txt --lexicon lexicon/ [--variants ç:h]
+"""
+import argparse
+import mmap
+import os
+import re
+import struct
+import sys
+from functools import lru_cache
+
+import andaluh
+from andaluh.lib import to_ignore_re, word_interaction_rules
+
+LEXICON_DIR = os.getenv("LEXICON_DIR")
+LEXICON_MAGIC = b"EPALEX01"
+LEXICON_HEADER = struct.Struct("<8sI")
+DEFAULT_VARIANTS = "ç:h"
+
+WORD_RE = re.compile(r"(\w+)", re.UNICODE)
+
+
+def lexicon_filename(vaf, vvf):
+    return f"epa-{vaf}{vvf}.lex"
+
+
+def write_lexicon(path, entries):
+    """
+    Write a lexicon file.
+    :param path: output file path
+    :param entries: dict of word -> transcription
+    """
+    keys = sorted(word.encode("utf-8") for word in entries)
+    values = [entries[key.decode("utf-8")].encode("utf-8") for key in keys]
+
+    with open(path, "wb") as f:
+        f.write(LEXICON_HEADER.pack(LEXICON_MAGIC, len(keys)))
+        for blobs in (keys, values):
+            offset = 0
+            offsets = [offset]
+            for blob in blobs:
+                offset += len(blob)
+                offsets.append(offset)
+            f.write(struct.pack(f"<{len(offsets)}I", *offsets))
+        for blobs in (keys, values):
+            for blob in blobs:
+                f.write(blob)
+
+
+class Lexicon:
+    """
+    Read-only, memory-mapped lexicon of a single vaf/vvf variant.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.count = LEXICON_HEADER.unpack_from(self._mm, 0)
+        if magic != LEXICON_MAGIC or sys.byteorder != "little":
+            raise ValueError(f"{path} is not a lexicon file readable on this host")
+
+        view = memoryview(self._mm)
+        table_size = 4 * (self.count + 1)
+        start = LEXICON_HEADER.size
+        self._key_offsets = view[start:start + table_size].cast("I")
+        self._value_offsets = view[start + table_size:start + 2 * table_size].cast("I")
+        self._keys_start = start + 2 * table_size
+        self._values_start = self._keys_start + self._key_offsets[self.count]
+        self.get = lru_cache(maxsize=65536)(self._get)
+
+    def _key(self, i):
+        return self._mm[self._keys_start + self._key_offsets[i]:self._keys_start + self._key_offsets[i + 1]]
+
+    def _get(self, word):
+        """
+        :param word: word to look up
+        :return: transcription or None when the word is not in the lexicon
+        """
+        key = word.encode("utf-8")
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count and self._key(lo) == key:
+            start = self._values_start + self._value_offsets[lo]
+            end = self._values_start + self._value_offsets[lo + 1]
+            return self._mm[start:end].decode("utf-8")
+        return None
+
+
+_lexicons = {}
+
+
+def get_lexicon(vaf, vvf, directory=None):
+    """
+    Lexicon for a variant, opened once per process.
+    :param vaf: vaf configuration for andaluh-py
+    :param vvf: vvf configuration for andaluh-py
+    :param directory: lexicons directory, LEXICON_DIR by default
+    :return: Lexicon or None if there is no lexicon for the variant
+    """
+    directory = directory or LEXICON_DIR
+    if not directory:
+        return None
+    path = os.path.join(directory, lexicon_filename(vaf, vvf))
+    if path not in _lexicons:
+        try:
+            _lexicons[path] = Lexicon(path)
+        except (OSError, ValueError) as e:
+            print(f"Lexicon {path} not available: {repr(e)}")
+            _lexicons[path] = None
+    return _lexicons[path]
+
+
+def split_words(text):
+    """
+    Split a text in words, when it can be transcribed word by word.
+    :param text: input text
+    :return: list alternating separators (even indexes) and words (odd indexes), or None if the
+             text contains tokens escaped by andaluh-py (links, mentions, hashtags, roman numerals)
+    """
+    if to_ignore_re.search(text):
+        return None
+    return WORD_RE.split(text)
+
+
+def assemble(parts):
+    """
+    Join the transcribed words of a text and apply the rules between words.
+    :param parts: output of split_words() with the words already transcribed
+    :return: transcription
+    """
+    return word_interaction_rules("".join(parts))
+
+
+def parse_variants(variants):
+    return [tuple(variant.split(":")) for variant in variants.split(",")]
+
+
+def read_words(path):
+    """
+    Read a word list: one word per line, optionally followed by a frequency or other columns.
+    """
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            fields = line.split()
+            if fields:
+                yield fields[0]
+
+
+def build(args):
+    words = set()
+    for word in read_words(args.words):
+        for form in (word.lower(), word.title()):
+            if WORD_RE.fullmatch(form) and split_words(form) is not None:
+                words.add(form)
+
+    os.makedirs(args.output, exist_ok=True)
+    for vaf, vvf in parse_variants(args.variants):
+        entries = {word: andaluh.epa(word, vaf=vaf, vvf=vvf, escape_links=True) for word in words}
+        path = os.path.join(args.output, lexicon_filename(vaf, vvf))
+        write_lexicon(path, entries)
+        print(f"{path}: {len(entries)} words")
+
+
+def transcribe_with_lexicon(text, lexicon, vaf, vvf):
+    parts = split_words(text)
+    if parts is None:
+        return andaluh.epa(text, vaf=vaf, vvf=vvf, escape_links=True)
+    for i in range(1, len(parts), 2):
+        transcription = lexicon.get(parts[i])
+        if transcription is None:
+            transcription = andaluh.epa(parts[i], vaf=vaf, vvf=vvf, escape_links=True)
+        parts[i] = transcription
+    return assemble(parts)
+
+
+def verify(args):
+    """
+    Check that transcribing with the lexicon gives byte for byte the rule engine output.
+    """
+    with open(args.corpus, encoding="utf-8") as f:
+        texts = [line.rstrip("\n") for line in f if line.strip()]
+
+    mismatches = 0
+    for vaf, vvf in parse_variants(args.variants):
+        lexicon = get_lexicon(vaf, vvf, args.lexicon)
+        if lexicon is None:
+            print(f"No lexicon for vaf={vaf} vvf={vvf} in {args.lexicon}")
+            return 1
+        for text in texts:
+            if split_words(text) is None:
+                continue
+            expected = andaluh.epa(text, vaf=vaf, vvf=vvf, escape_links=True)
+            actual = transcribe_with_lexicon(text, lexicon, vaf, vvf)
+            if actual != expected:
+                mismatches += 1
+                print(f"vaf={vaf} vvf={vvf} mismatch:\n  text:     {text}\n  epa:      {expected}\n"
+                      f"  lexicon:  {actual}")
+        print(f"vaf={vaf} vvf={vvf}: {len(texts)} texts checked")
+    return 1 if mismatches else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m app.lexicon", description="EPA lexicon tools")
+    subparsers = parser.add_subparsers(dest="command")
+
+    build_parser = subparsers.add_parser("build", help="build lexicon files from a word list")
+    build_parser.add_argument("words", help="word list, one word per line")
+    build_parser.add_argument("--output", default=LEXICON_DIR or "lexicon", help="output directory")
+    build_parser.add_argument("--variants", default=DEFAULT_VARIANTS, help="comma separated vaf:vvf pairs")
+
+    verify_parser = subparsers.add_parser("verify", help="compare lexicon and rule engine transcriptions")
+    verify_parser.add_argument("corpus", help="text file, one text per line")
+    verify_parser.add_argument("--lexicon", default=LEXICON_DIR or "lexicon", help="lexicon directory")
+    verify_parser.add_argument("--variants", default=DEFAULT_VARIANTS, help="comma separated vaf:vvf pairs")
+
+    args = parser.parse_args(argv)
+    if args.command == "build":
+        build(args)
+        return 0
+    if args.command == "verify":
+        return verify(args)
+    parser.error("a command is required")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,148 @@
+"""
+In-memory caches of each worker process, bounded by the bytes they hold instead of their entries.
+
+Transcribed text fragments and pages have their own cache, so the many small fragments don't evict
+the few large pages. Large values can be packed when they are stored, e.g. compressed, and unpacked
+on each hit. Occupancy and evictions are exported as metrics to tune the budgets.
+"""
+import os
+import sys
+import threading
+import zlib
+
+from cachetools import LFUCache, LRUCache
+
+from app import metrics
+
+FRAGMENT_CACHE_MAX_BYTES = int(os.getenv("FRAGMENT_CACHE_MAX_BYTES", 16 * 1024 * 1024))
+PAGE_MEMORY_CACHE_MAX_BYTES = int(os.getenv("PAGE_MEMORY_CACHE_MAX_BYTES", 32 * 1024 * 1024))
+# Pages at least this large are kept compressed
+PAGE_MEMORY_COMPRESS_BYTES = int(os.getenv("PAGE_MEMORY_COMPRESS_BYTES", 16 * 1024))
+# "lru" or "lfu"
+MEMORY_CACHE_POLICY = os.getenv("MEMORY_CACHE_POLICY", "lru")
+
+POLICIES = {"lru": LRUCache, "lfu": LFUCache}
+
+
+class MemoryCache:
+    """
+    Thread-safe cache limited by the total size of its entries, evicted in MEMORY_CACHE_POLICY order.
+    """
+
+    def __init__(self, name, max_bytes, sizeof, pack=None, unpack=None, policy=MEMORY_CACHE_POLICY):
+        """
+        :param name: cache name, used in metrics
+        :param max_bytes: byte budget, 0 disables the cache
+        :param sizeof: function returning the bytes taken by a key and its packed value
+        :param pack: function turning a value into the stored one, e.g. compressing it
+        :param unpack: inverse of pack
+        :param policy: eviction policy, a key of POLICIES
+        """
+        self.name = name
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.pack = pack
+        self.unpack = unpack
+        self._lock = threading.Lock()
+        cache_class = POLICIES[policy]
+        cache = self
+
+        class Cache(cache_class):
+            def popitem(self):
+                key, value = super().popitem()
+                metrics.incr("memory_cache_evictions_total", cache=cache.name)
+                return key, value
+
+        # Entries are (packed value, size)
+        self._cache = Cache(maxsize=max(max_bytes, 1), getsizeof=lambda entry: entry[1])
+
+    def get(self, key):
+        """
+        :param key: hashable key
+        :return: value or None
+        """
+        if self.max_bytes <= 0:
+            return None
+        with self._lock:
+            entry = self._cache.get(key)
+        metrics.incr("memory_cache_requests_total", cache=self.name, result="miss" if entry is None else "hit")
+        if entry is None:
+            return None
+        return self.unpack(entry[0]) if self.unpack is not None else entry[0]
+
+    def set(self, key, value):
+        """
+        Store a value, evicting other entries over the byte budget. Values larger than the budget
+        are not stored.
+        :param key: hashable key
+        :param value: value
+        """
+        if self.max_bytes <= 0:
+            return
+        packed = self.pack(value) if self.pack is not None else value
+        size = self.sizeof(key, packed)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._cache[key] = (packed, size)
+            self.report()
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self.report()
+
+    def report(self):
+        """
+        Export the occupancy of the cache.
+        """
+        metrics.gauge("memory_cache_bytes", self._cache.currsize, cache=self.name)
+        metrics.gauge("memory_cache_entries", len(self._cache), cache=self.name)
+
+
+def fragment_sizeof(key, value):
+    """
+    :param key: (text, vaf, vvf)
+    :param value: transcription
+    :return: approximate bytes taken by the entry
+    """
+    return sys.getsizeof(key[0]) + sys.getsizeof(value)
+
+
+def page_sizeof(key, packed):
+    return len(key) + sum(len(blob) for blob in packed.values())
+
+
+def pack_page(encoded):
+    """
+    Keep a large page compressed: without its identity body when it also has a gzip one, which is
+    decompressed on each hit, else deflated.
+    :param encoded: dict of content encoding -> bytes, with at least "identity"
+    :return: packed dict
+    """
+    if len(encoded["identity"]) < PAGE_MEMORY_COMPRESS_BYTES:
+        return encoded
+    packed = {encoding: blob for encoding, blob in encoded.items() if encoding != "identity"}
+    if "gzip" not in packed:
+        packed["deflate"] = zlib.compress(encoded["identity"], 1)
+    return packed
+
+
+def unpack_page(packed):
+    """
+    :param packed: see pack_page()
+    :return: dict of content encoding -> bytes, with at least "identity"
+    """
+    if "identity" in packed:
+        return packed
+    encoded = dict(packed)
+    if "deflate" in encoded:
+        encoded["identity"] = zlib.decompress(encoded.pop("deflate"))
+    else:
+        encoded["identity"] = zlib.decompress(encoded["gzip"], 16 + zlib.MAX_WBITS)
+    return encoded
+
+
+fragment_cache = MemoryCache("fragments", FRAGMENT_CACHE_MAX_BYTES, fragment_sizeof)
+page_memory_cache = MemoryCache("pages", PAGE_MEMORY_CACHE_MAX_BYTES, page_sizeof, pack=pack_page,
+                                unpack=unpack_page)
@@ -0,0 +1,313 @@
+"""
+Low overhead counters and timings of the proxy.
+
+Each worker process keeps its counters in memory and writes a snapshot of them to a file of
+METRICS_DIR, at most once every METRICS_FLUSH_SECONDS, so /metrics can add up the counters of every
+uwsgi worker of the host. The stages of the current request are also reported in its Server-Timing
+header.
+"""
+import fcntl
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+DISABLE_METRICS = bool(os.getenv("DISABLE_METRICS"))
+METRICS_DIR = os.getenv("METRICS_DIR", os.path.join(tempfile.gettempdir(), "andaluh-wiki-metrics"))
+METRICS_FLUSH_SECONDS = float(os.getenv("METRICS_FLUSH_SECONDS", 1))
+
+# Upper bounds, in seconds, of the histogram buckets
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+HISTOGRAMS = {"request_duration_seconds", "stage_duration_seconds"}
+# Current values instead of running totals, only added up over the live worker processes
+GAUGES = {"memory_cache_bytes", "memory_cache_entries", "admission_queue_depth"}
+# Counters of the finished worker processes, and the files they were folded from
+FINISHED_FILE = "finished.json"
+LOCK_FILE = "aggregate.lock"
+
+_lock = threading.Lock()
+_counters = {}
+_flushed = 0
+# (pid, metrics file) of this process
+_process = None
+_request = threading.local()
+
+
+def incr(name, value=1, **labels):
+    """
+    Increase a counter of this worker process.
+    :param name: metric name
+    :param value: increment
+    :param labels: metric labels
+    """
+    if DISABLE_METRICS:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def gauge(name, value, **labels):
+    """
+    Set a gauge of this worker process.
+    :param name: metric name, one of GAUGES
+    :param value: current value
+    :param labels: metric labels
+    """
+    if DISABLE_METRICS:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = value
+
+
+def observe(name, seconds, **labels):
+    """
+    Add a duration to a histogram of this worker process, made of cumulative bucket, sum and count counters.
+    :param name: histogram name, one of HISTOGRAMS
+    :param seconds: observed duration
+    :param labels: metric labels
+    """
+    if DISABLE_METRICS:
+        return
+    labels = tuple(sorted(labels.items()))
+    with _lock:
+        for bucket in DURATION_BUCKETS + (float("inf"),):
+            # Empty buckets are kept, every bucket of a histogram is exported
+            key = (name + "_bucket", tuple(sorted(labels + (("le", format_bound(bucket)),))))
+            _counters[key] = _counters.get(key, 0) + (seconds <= bucket)
+        for suffix, value in (("_sum", seconds), ("_count", 1)):
+            key = (name + suffix, labels)
+            _counters[key] = _counters.get(key, 0) + value
+
+
+def format_bound(bucket):
+    return "+Inf" if bucket == float("inf") else repr(bucket)
+
+
+def counters():
+    """
+    :return: copy of the counters of this worker process, as {(name, labels): value}
+    """
+    with _lock:
+        return dict(_counters)
+
+
+def reset():
+    """
+    Drop the counters of this process, e.g. those of the warm-up before the uwsgi master forks the workers.
+    """
+    with _lock:
+        _counters.clear()
+
+
+def start_request():
+    """
+    Start collecting the stage timings of the request handled by this thread.
+    """
+    _request.start = time.perf_counter()
+    _request.stages = {}
+
+
+@contextmanager
+def stage(name):
+    """
+    Time a stage of the request handled by this thread, e.g. with stage("fetch"): ...
+    :param name: stage name
+    """
+    if DISABLE_METRICS:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        observe("stage_duration_seconds", elapsed, stage=name)
+        stages = getattr(_request, "stages", None)
+        if stages is not None:
+            stages[name] = stages.get(name, 0) + elapsed
+
+
+def finish_request():
+    """
+    Stop collecting the stage timings of the request handled by this thread.
+    :return: (request duration in seconds, Server-Timing header value), or (None, None) if not collecting
+    """
+    stages = getattr(_request, "stages", None)
+    if DISABLE_METRICS or stages is None:
+        return None, None
+    elapsed = time.perf_counter() - _request.start
+    _request.stages = None
+    timings = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in stages.items()]
+    timings.append(f"total;dur={elapsed * 1000:.1f}")
+    return elapsed, ", ".join(timings)
+
+
+def flush(force=False):
+    """
+    Write the counters of this worker process to its file of METRICS_DIR.
+    :param force: write even if the previous snapshot is recent
+    """
+    global _flushed
+    if DISABLE_METRICS or (not force and time.time() - _flushed < METRICS_FLUSH_SECONDS):
+        return
+    _flushed = time.time()
+    snapshot = [[name, labels, value] for (name, labels), value in counters().items()]
+    try:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        path = os.path.join(METRICS_DIR, process_filename())
+        with open(path + ".tmp", "w") as f:
+            json.dump(snapshot, f)
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        print(f"Error writing metrics to {METRICS_DIR}: {repr(e)}")
+
+
+def process_filename():
+    """
+    :return: metrics file of this process, named by its pid and start time so a worker reusing the pid of
+        a finished one never overwrites its counters
+    """
+    global _process
+    pid = os.getpid()
+    # Set again in every process forked after it was first set, e.g. by the uwsgi master
+    if _process is None or _process[0] != pid:
+        _process = (pid, f"{pid}-{int(time.time() * 1000000)}.json")
+    return _process[1]
+
+
+def parse_filename(filename):
+    """
+    :param filename: metrics file of a process
+    :return: (pid, start time), or None if it isn't one
+    """
+    pid, _, start = filename[:-len(".json")].partition("-")
+    if not filename.endswith(".json") or not pid.isdigit() or not (start.isdigit() or start == ""):
+        return None
+    # Files named by the pid alone were written before the start time was added
+    return int(pid), int(start or 0)
+
+
+def read_snapshot(filename):
+    with open(os.path.join(METRICS_DIR, filename)) as f:
+        return json.load(f)
+
+
+def add_snapshot(total, snapshot, gauges=True):
+    for name, labels, value in snapshot:
+        if name in GAUGES and not gauges:
+            continue
+        key = (name, tuple(tuple(label) for label in labels))
+        total[key] = total.get(key, 0) + value
+
+
+def aggregate():
+    """
+    Add up the counters of every worker process of the host. The counters of the finished ones are folded
+    into FINISHED_FILE and their files removed, so counters never go down when a worker is recycled and the
+    files don't pile up. Gauges are only added up over the live ones.
+    :return: {(name, labels): value}
+    """
+    flush(force=True)
+    total = {}
+    try:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        lock = open(os.path.join(METRICS_DIR, LOCK_FILE), "w")
+    except OSError as e:
+        print(f"Error opening metrics lock in {METRICS_DIR}: {repr(e)}")
+        return total
+    with lock:
+        # A single worker reads and folds the files at a time, nothing is added up twice
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            finished = read_snapshot(FINISHED_FILE)
+        except FileNotFoundError:
+            finished = {"files": [], "counters": []}
+        except (OSError, ValueError) as e:
+            print(f"Error reading metrics file {FINISHED_FILE}: {repr(e)}")
+            return total
+
+        processes = {}
+        for filename in os.listdir(METRICS_DIR):
+            process = parse_filename(filename)
+            if process is not None:
+                processes[filename] = process
+        # The live process of a pid is the one started last
+        latest = {}
+        for pid, start in processes.values():
+            latest[pid] = max(start, latest.get(pid, start))
+
+        folded = set(finished["files"]) & set(processes)
+        finished_counters = {}
+        add_snapshot(finished_counters, finished["counters"])
+        for filename, (pid, start) in sorted(processes.items()):
+            if filename in folded:
+                # Folded by an aggregate() interrupted before removing it
+                continue
+            try:
+                snapshot = read_snapshot(filename)
+            except (OSError, ValueError) as e:
+                print(f"Error reading metrics file {filename}: {repr(e)}")
+                continue
+            if start == latest[pid] and process_alive(pid):
+                add_snapshot(total, snapshot)
+            else:
+                add_snapshot(finished_counters, snapshot, gauges=False)
+                folded.add(filename)
+
+        if folded - set(finished["files"]):
+            finished = {"files": sorted(folded),
+                        "counters": [[name, labels, value] for (name, labels), value in finished_counters.items()]}
+            try:
+                path = os.path.join(METRICS_DIR, FINISHED_FILE)
+                with open(path + ".tmp", "w") as f:
+                    json.dump(finished, f)
+                os.replace(path + ".tmp", path)
+            except OSError as e:
+                print(f"Error writing metrics to {METRICS_DIR}: {repr(e)}")
+                return total
+        for filename in folded:
+            try:
+                os.remove(os.path.join(METRICS_DIR, filename))
+            except FileNotFoundError:
+                pass
+    for key, value in finished_counters.items():
+        total[key] = total.get(key, 0) + value
+    return total
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def render():
+    """
+    :return: counters of every worker process in Prometheus text format
+    """
+    lines = []
+    typed = set()
+    for (name, labels), value in sorted(aggregate().items()):
+        family = name
+        for suffix in ("_bucket", "_sum", "_count"):
+            if name.endswith(suffix) and name[:-len(suffix)] in HISTOGRAMS:
+                family = name[:-len(suffix)]
+        if family not in typed:
+            typed.add(family)
+            kind = "histogram" if family in HISTOGRAMS else "gauge" if family in GAUGES else "counter"
+            lines.append(f"# TYPE {family} {kind}")
+        label_text = ",".join(f'{key}="{escape_label(value)}"' for key, value in labels)
+        lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
@@ -0,0 +1,49 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# Transcribe the text of large pages on a pool of processes. Each uwsgi worker owns its own pool.
+PARALLEL_TRANSCRIPTION = bool(os.getenv("PARALLEL_TRANSCRIPTION"))
+PARALLEL_POOL_SIZE = int(os.getenv("PARALLEL_POOL_SIZE", os.cpu_count() or 1))
+# Pages with less text than this are transcribed inline, the pool round-trip is not worth it.
+PARALLEL_MIN_CHARS = int(os.getenv("PARALLEL_MIN_CHARS", 100000))
+
+_pool = None
+_pool_pid = None
+
+
+def get_pool():
+    """
+    Persistent process pool, created on first use in each worker process.
+    :return: ProcessPoolExecutor
+    """
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        _pool = ProcessPoolExecutor(max_workers=PARALLEL_POOL_SIZE)
+        _pool_pid = os.getpid()
+    return _pool
+
+
+def should_parallelize(texts):
+    """
+    :param texts: list of texts to transcribe
+    :return: True if the texts are worth sending to the process pool
+    """
+    return PARALLEL_TRANSCRIPTION and PARALLEL_POOL_SIZE > 1 and sum(map(len, texts)) >= PARALLEL_MIN_CHARS
+
+
+def map_chunks(func, chunks):
+    """
+    Apply func to every chunk on the process pool, falling back to the current process if the pool broke.
+    :param func: picklable function taking a chunk and returning a list
+    :param chunks: list of chunks
+    :return: concatenation of the lists returned by func, in order
+    """
+    global _pool
+    try:
+        results = list(get_pool().map(func, chunks))
+    except BrokenProcessPool as e:
+        print(f"Transcription process pool broken, transcribing inline: {repr(e)}")
+        _pool = None
+        results = [func(chunk) for chunk in chunks]
+    return [item for result in results for item in result]
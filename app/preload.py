@@ -0,0 +1,98 @@
+"""
+Warm-up of a process before it serves its first request.
+
+uwsgi imports app.wsgi in its master process and then forks the workers, so what is loaded here is
+loaded once and shared by every worker through copy-on-write: the modules, the regular expressions
+compiled by andaluh-py, BeautifulSoup and lxml on first use, the lexicons and, with
+PRELOAD_HOT_PAGES, the most recently read pages of the page cache. A Zappa/Lambda container pays it
+at cold start instead of on the first request of a user.
+"""
+import os
+import time
+
+from app import metrics
+
+DISABLE_PRELOAD = bool(os.getenv("DISABLE_PRELOAD"))
+# Most recently read pages of the page cache loaded in memory, see app.memcache
+PRELOAD_HOT_PAGES = int(os.getenv("PRELOAD_HOT_PAGES", 0))
+
+# Exercises the parsing, rewrite and transcription paths of a page and of a JSON API response
+SAMPLE_PAGE = """<!DOCTYPE html>
+<html lang="es"><head><title>Sevilla - Wikipedia, la enciclopedia libre</title></head>
+<body><div id="content"><h1>Sevilla</h1><p>Sevilla es una ciudad y municipio de España, capital de la
+provincia homónima y de la comunidad autónoma de Andalucía. Tiene 684 234 habitantes, según el
+<a href="/wiki/Instituto_Nacional_de_Estad%C3%ADstica">INE</a> (2021), y es la cuarta ciudad más poblada
+del país. Jerez, Huelva y Cádiz quedan al sur; el río Guadalquivir la cruza de norte a sur.</p>
+<ul><li>Xilófono, chiquillo, llave, psicología, exhausto</li></ul>
+<a href="/static/favicon.ico">icono</a></div></body></html>"""
+SAMPLE_SUMMARY_URL = "api/rest_v1/page/summary/Sevilla"
+SAMPLE_SUMMARY = ('{"title": "Sevilla", "description": "ciudad de España", '
+                  '"extract": "Sevilla es una ciudad de España.", "extract_html": "<p><b>Sevilla</b> es una ciudad.</p>"}')
+
+
+def warm_up():
+    """
+    Load and exercise the transcription pipeline once.
+    :return: dict of phase -> seconds
+    """
+    from app import json_api, proxy, variants
+    from app.compression import compress_all
+    from app.lexicon import get_lexicon
+
+    timings = {}
+    start = time.perf_counter()
+    # The pages are transcribed to the neutral form and rendered to the default variant
+    page = proxy.neutral_html(SAMPLE_PAGE, "wiki/Sevilla")
+    html = proxy.render_html(page, vaf=variants.DEFAULT_VAF, vvf=variants.DEFAULT_VVF)
+    compress_all(html.encode("utf-8"))
+    proxy.transcribe_html(SAMPLE_PAGE, "wiki/Sevilla", vaf=variants.DEFAULT_VAF, vvf=variants.DEFAULT_VVF)
+    api = json_api.match(proxy.ROOT_DOMAIN + SAMPLE_SUMMARY_URL)
+    json_api.transcribe_json(SAMPLE_SUMMARY.encode("utf-8"), api, proxy.transcribe_batch, "warm-up")
+    get_lexicon(variants.DEFAULT_VAF, variants.DEFAULT_VVF)
+    timings["exercise"] = time.perf_counter() - start
+
+    if PRELOAD_HOT_PAGES > 0:
+        start = time.perf_counter()
+        load_hot_pages(PRELOAD_HOT_PAGES)
+        timings["hot_pages"] = time.perf_counter() - start
+
+    # Nothing done here is a request: the counters inherited by the workers start at zero
+    metrics.reset()
+    from app.memcache import fragment_cache, page_memory_cache
+    fragment_cache.report()
+    page_memory_cache.report()
+    # uwsgi forks the workers next, they open their own connection
+    from app.cache import page_cache
+    page_cache.close()
+    return timings
+
+
+def load_hot_pages(count):
+    """
+    Load the most recently read pages of the page cache in the memory cache of this process.
+    :param count: maximum pages, also limited by the memory cache byte budget
+    """
+    from app.cache import page_cache
+    from app.memcache import page_memory_cache
+
+    # Least recent first, so the hottest pages are the last ones evicted
+    for key, encoded in reversed(page_cache.hottest(count)):
+        page_memory_cache.set(key, encoded)
+
+
+def preload():
+    """
+    Warm up the process unless DISABLE_PRELOAD is set, and report how long it took.
+    """
+    if DISABLE_PRELOAD:
+        return
+    try:
+        timings = warm_up()
+    except Exception as e:
+        # A failed warm-up only leaves the first requests slower
+        print(f"Error warming up: {repr(e)}")
+        from app.cache import page_cache
+        page_cache.close()
+        return
+    print("Warm-up " + ", ".join(f"{phase} {seconds * 1000:.0f} ms" for phase, seconds in timings.items()),
+          flush=True)
@@ -3,34 +3,113 @@ import requests
 from bs4 import BeautifulSoup, Comment
 from bs4.element import NavigableString
 from flask import Flask, request, Response, send_from_directory
+from requests.structures import CaseInsensitiveDict
 
 import andaluh
 import json
 import re
+import time
+import uuid
+from functools import partial
+from html import escape
 
-from cachetools import cached, TTLCache
+from cachetools.keys import hashkey
 
+from app import admission, assets, blocks, json_api, metrics, revalidate, variants
+from app.cache import content_revision, page_cache, upstream_revision
+from app.coalesce import single_flight
+from app.compression import compress_all, negotiate
+from app.http_cache import CACHE_CONTROL, output_etag, upstream_if_none_match
+from app.lexicon import assemble, get_lexicon, split_words
+from app.memcache import fragment_cache
+from app.parallel import PARALLEL_POOL_SIZE, map_chunks, should_parallelize
+from app.rewrite import INSERT_WP_ES_LINK, REMOVE, REWRITE_RULES, STATIC_HREF, matching_rules
 from app.templates import HEAD, BODY, GA_TRACKING_HEADER, WP_ES_LINK
+from app.upstream import ROOT_DOMAIN, fetch, is_timeout, upstream_accept_encoding
+from app.variants import NEUTRAL_VAF, NEUTRAL_VVF
 
-ROOT_DOMAIN = "https://es.wikipedia.org/"
-WKP_CT_SUMMARY_API = r'application\/json; charset=utf-8; profile="https:\/\/www\.mediawiki\.org\/wiki\/Specs\/Summary\/\d+(?:\.\d+)+"'
+WKP_CT_SUMMARY_API = re.compile(
+    r'application\/json; charset=utf-8; profile="https:\/\/www\.mediawiki\.org\/wiki\/Specs\/Summary\/\d+(?:\.\d+)+"')
 WKP_CT_HTML = 'text/html; charset=UTF-8'
-WKP_SUMMARY_API_KEYS_2_TRANSC = ["title", "displaytitle", "description", "extract", "extract_html"]
 NOT_TRANSCRIBABLE_ELEMENTS = ["style", "script"]
 WKP_TITLE = "AndaluWiki, la Wikipedia n'Andalûh"
 WKP_CSS_STATIC = b"url(/static"
 WKP_CSS_STATIC_GITHUB = b"url(https://raw.githubusercontent.com/andalugeeks/andaluh-wiki/master/app/static"
 WKP_HTML_STATIC_GITHUB = "https://raw.githubusercontent.com/andalugeeks/andaluh-wiki/master/app/static"
+# Record separator between batched text fragments. Not a word character, so no andaluh-py rule spans it.
+TRANSCRIPTION_SEPARATOR_MARK = "\x1e"
+TRANSCRIPTION_SEPARATOR = "\n" + TRANSCRIPTION_SEPARATOR_MARK + "\n"
+TRANSCRIPTION_BATCH_CHARS = int(os.getenv("TRANSCRIPTION_BATCH_CHARS", 20000))
+# Rewrite html pages while they are received from upstream, see app.stream
+STREAM_HTML = bool(os.getenv("STREAM_HTML"))
+# Upstream headers kept with a transcribed response, enough to build its own headers.
+UPSTREAM_HEADERS = ["Content-Type", "ETag", "Last-Modified", "Cache-Control"]
+GA_TRACK_UA = os.getenv('GA_TRACK_UA')
+# Template fragments are spliced in the serialized page in place of comments starting with this mark.
+FRAGMENT_MARK = f"andaluh-wiki-{uuid.uuid4().hex}:"
+# Characters of the article path escaped or parsed by BeautifulSoup in the WP_ES_LINK href
+WP_ES_LINK_UNSAFE_PATH = re.compile(r'[&<>"\']')
 
 flask_app = Flask(__name__)
 
-cache = TTLCache(maxsize=500, ttl=60)
+
+class PreparedContent:
+    """
+    Transcribed response detached from the upstream connection, so it can be shared by coalesced requests.
+    """
+
+    def __init__(self, status_code, headers, encoded, stream=None, close=None):
+        """
+        :param status_code: upstream status code
+        :param headers: upstream headers, see UPSTREAM_HEADERS
+        :param encoded: dict of content encoding -> transcribed content, None for 304 Not Modified or streams
+        :param stream: generator of the body chunks of a content relayed as it is, see app.assets
+        :param close: callable releasing the source of the stream, also when it is not read
+        """
+        self.status_code = status_code
+        self.headers = CaseInsensitiveDict(headers)
+        self.encoded = encoded
+        self.stream = stream
+        self.close = close
+
+
+def upstream_headers(resp):
+    """
+    :param resp: upstream response
+    :return: dict with the UPSTREAM_HEADERS present in the response
+    """
+    return {name: resp.headers[name] for name in UPSTREAM_HEADERS if name in resp.headers}
+
+
+def requested_url(resp):
+    """
+    :param resp: upstream response
+    :return: url the response was requested with, before any redirect, the path of its cache entries as
+        looked up by normalize_url()
+    """
+    history = getattr(resp, "history", None)
+    return str(history[0].url if history else resp.url)
 
 
-@cached(cache)
 def transcribe(text, vaf='ç', vvf='h'):
     """
-    Transcribe input text.
+    Transcribe input text, through the fragments cache.
+    :param text: input text
+    :param vaf: vaf configuration for andaluh-py
+    :param vvf: vvf configuration for andaluh-py
+    :return:
+    """
+    key = hashkey(text, vaf, vvf)
+    transcription = fragment_cache.get(key)
+    if transcription is None:
+        transcription = transcribe_batch([text], vaf=vaf, vvf=vvf)[0]
+        fragment_cache.set(key, transcription)
+    return transcription
+
+
+def transcribe_text(text, vaf='ç', vvf='h'):
+    """
+    Transcribe input text, bypassing the fragments cache.
     :param text: input text
     :param vaf: vaf configuration for andaluh-py
     :param vvf: vvf configuration for andaluh-py
@@ -44,143 +123,826 @@ def transcribe(text, vaf='ç', vvf='h'):
     return transcription
 
 
-def transcribe_elem_text(elem, vaf, vvf):
+def transcribe_batch(texts, vaf='ç', vvf='h'):
+    """
+    Transcribe many text fragments at once.
+    Words found in the lexicon of the variant (see app.lexicon) are not transcribed again. The
+    unknown words and the texts that can't be transcribed word by word go to andaluh-py in batches.
+    :param texts: list of input texts
+    :param vaf: vaf configuration for andaluh-py
+    :param vvf: vvf configuration for andaluh-py
+    :return: list of transcriptions, in the same order
     """
+    lexicon = get_lexicon(vaf, vvf)
+    if lexicon is None:
+        return transcribe_rules(texts, vaf=vaf, vvf=vvf)
 
-    :param elem: BS4 element to transcribe
+    split_texts = [split_words(text) for text in texts]
+    unknown_words = {}
+    for parts in split_texts:
+        if parts is not None:
+            for word in parts[1::2]:
+                if lexicon.get(word) is None:
+                    unknown_words[word] = None
+
+    pending = list(unknown_words) + [text for text, parts in zip(texts, split_texts) if parts is None]
+    pending_transcriptions = iter(transcribe_rules(pending, vaf=vaf, vvf=vvf))
+    for word in unknown_words:
+        unknown_words[word] = next(pending_transcriptions)
+
+    transcriptions = []
+    for parts in split_texts:
+        if parts is None:
+            transcriptions.append(next(pending_transcriptions))
+            continue
+        for i in range(1, len(parts), 2):
+            transcription = lexicon.get(parts[i])
+            parts[i] = unknown_words[parts[i]] if transcription is None else transcription
+        transcriptions.append(assemble(parts))
+    return transcriptions
+
+
+def transcribe_texts(texts, vaf='ç', vvf='h'):
+    """
+    Transcribe the texts of a page, spread over the process pool when the page is large enough.
+    The result is the same as transcribe_batch(), every text is transcribed independently of the others.
+    :param texts: list of input texts
     :param vaf: vaf configuration for andaluh-py
     :param vvf: vvf configuration for andaluh-py
-    :return:
+    :return: list of transcriptions, in the same order
+    """
+    if not should_parallelize(texts):
+        return transcribe_batch(texts, vaf=vaf, vvf=vvf)
+
+    chunk_chars = max(TRANSCRIPTION_BATCH_CHARS, sum(map(len, texts)) // (PARALLEL_POOL_SIZE * 2))
+    chunks = split_in_chunks(texts, chunk_chars)
+    return map_chunks(partial(transcribe_batch, vaf=vaf, vvf=vvf), chunks)
+
+
+def transcribe_rules(texts, vaf='ç', vvf='h'):
+    """
+    Transcribe many text fragments with a few andaluh-py calls instead of one call per fragment.
+    Fragments are joined with TRANSCRIPTION_SEPARATOR, which andaluh-py leaves untouched and no
+    transcription rule can match across, so every fragment is transcribed as if it was alone.
+    :param texts: list of input texts
+    :param vaf: vaf configuration for andaluh-py
+    :param vvf: vvf configuration for andaluh-py
+    :return: list of transcriptions, in the same order
+    """
+    transcriptions = []
+    for chunk in split_in_chunks(texts, TRANSCRIPTION_BATCH_CHARS):
+        transcriptions.extend(transcribe_chunk(chunk, vaf=vaf, vvf=vvf))
+    return transcriptions
+
+
+def split_in_chunks(texts, max_chars):
+    """
+    Group consecutive texts in chunks of about max_chars characters.
+    :param texts: list of input texts
+    :param max_chars: soft limit of characters per chunk
+    :return: list of lists of texts
+    """
+    chunks = []
+    chunk = []
+    chunk_chars = 0
+    for text in texts:
+        if chunk and chunk_chars + len(text) > max_chars:
+            chunks.append(chunk)
+            chunk = []
+            chunk_chars = 0
+        chunk.append(text)
+        chunk_chars += len(text)
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def transcribe_chunk(texts, vaf='ç', vvf='h'):
+    """
+    Transcribe a chunk of texts with a single andaluh-py call.
+    Falls back to one call per text when the chunk can't be safely joined or split back.
+    :param texts: list of input texts
+    :param vaf: vaf configuration for andaluh-py
+    :param vvf: vvf configuration for andaluh-py
+    :return: list of transcriptions, in the same order
+    """
+    if len(texts) > 1 and not any(TRANSCRIPTION_SEPARATOR_MARK in text for text in texts):
+        try:
+            joined = andaluh.epa(TRANSCRIPTION_SEPARATOR.join(texts), vaf=vaf, vvf=vvf, escape_links=True)
+            transcriptions = joined.split(TRANSCRIPTION_SEPARATOR)
+            if len(transcriptions) == len(texts):
+                return transcriptions
+        except Exception as e:
+            print(f"Error in andaluh package when trying to transcript a batch of {len(texts)} texts: {repr(e)}")
+
+    return [transcribe_text(text, vaf=vaf, vvf=vvf) for text in texts]
+
+
+def walk_page(soup):
+    """
+    Single traversal of a page, in document order, collecting the transcribable text nodes of the
+    body and the elements matched by the rewrite rules of app.rewrite
+    Rules only match outside the elements removed by previous rules, as if they were applied one after
+    the other, and the text of removed elements is not collected.
+    :param soup: BS4 document
+    :return: (list of NavigableString, list of (action, element) in rule order)
+    """
+    nodes = []
+    matches = []
+    done_rules = set()
+    no_removal = len(REWRITE_RULES)
+    stack = []
+    # (children iterator, is a tag, collect text, index of the first rule removing an ancestor)
+    frames = [(iter(soup.contents), False, False, no_removal)]
+    while frames:
+        children, is_tag, collect, removed_by = frames[-1]
+        elem = next(children, None)
+        if elem is None:
+            frames.pop()
+            if is_tag:
+                stack.pop()
+            continue
+
+        if isinstance(elem, NavigableString):
+            # Whitespace only strings are left as they are by andaluh-py.
+            if collect and not isinstance(elem, Comment) and not elem.isspace():
+                nodes.append(elem)
+            continue
+
+        stack.append((elem.name, elem.get("id"), frozenset(elem.get("class") or ())))
+        elem_removed_by = removed_by
+        for i, action, first in matching_rules(stack):
+            if first and i in done_rules:
+                continue
+            if action == REMOVE:
+                if i >= removed_by:
+                    continue
+                elem_removed_by = min(elem_removed_by, i)
+            if first:
+                done_rules.add(i)
+            matches.append((i, action, elem))
+
+        elem_collect = (collect or elem.name == "body") and elem.name not in NOT_TRANSCRIBABLE_ELEMENTS
+        frames.append((iter(elem.contents), True, elem_collect and elem_removed_by == no_removal, elem_removed_by))
+
+    matches.sort(key=lambda match: match[0])
+    return nodes, [(action, elem) for _, action, elem in matches]
+
+
+def transcribe_nodes(nodes, vaf, vvf, page_blocks=None):
+    """
+    Transcribe text nodes in place.
+    :param nodes: list of NavigableString
+    :param vaf: vaf configuration for andaluh-py
+    :param vvf: vvf configuration for andaluh-py
+    :param page_blocks: app.blocks.BlockTranscriptions of the page, to only transcribe its changed blocks
     """
-    if elem.name in NOT_TRANSCRIBABLE_ELEMENTS:
-        return
+    if page_blocks is not None:
+        transcriptions = blocks.transcribe_blocks(nodes, partial(transcribe_texts, vaf=vaf, vvf=vvf), page_blocks)
+    else:
+        transcriptions = transcribe_texts([str(node) for node in nodes], vaf=vaf, vvf=vvf)
+    for node, transcription in zip(nodes, transcriptions):
+        node.replaceWith(transcription)
+
+
+def apply_rewrite(action, elem, url_path):
+    """
+    :param action: action of a rule of app.rewrite
+    :param elem: BS4 element matched by the rule
+    :param url_path: requested path
+    """
+    if action == REMOVE:
+        elem.replaceWith('')
+    elif action == INSERT_WP_ES_LINK:
+        if WP_ES_LINK_UNSAFE_PATH.search(url_path):
+            wp_es_link_filled = WP_ES_LINK.replace("[ARTICLE_PATH]", url_path)
+            wp_es_link_tag = BeautifulSoup(wp_es_link_filled, "html.parser")
+            elem.insert(0, wp_es_link_tag)
+        else:
+            elem.insert(0, Comment(FRAGMENT_MARK + "WP_ES_LINK"))
+    elif action == STATIC_HREF:
+        elem['href'] = elem['href'] \
+            .replace("/static", WKP_HTML_STATIC_GITHUB)
+
+
+def prepare_fragment(html, features="html.parser"):
+    """
+    Parse and serialize a template fragment once, as it would be serialized inside a page.
+    :param html: template html
+    :param features: BeautifulSoup parser
+    :return: serialized html
+    """
+    fragment = BeautifulSoup(html, features)
+    # Links of the fragments are rewritten as the links of the page
+    for action, elem in walk_page(fragment)[1]:
+        if action == STATIC_HREF:
+            apply_rewrite(action, elem, "")
+    return str(fragment)
+
+
+HEAD_FRAGMENT = prepare_fragment(HEAD)
+# Google Analytics tracking ID (if present) goes after HEAD, as last head element
+if GA_TRACK_UA:
+    HEAD_FRAGMENT += prepare_fragment(GA_TRACKING_HEADER.replace("{GA_TRACK_UA}", GA_TRACK_UA), "lxml")
+BODY_FRAGMENT = prepare_fragment(BODY)
+WP_ES_LINK_FRAGMENT = prepare_fragment(WP_ES_LINK.replace("[ARTICLE_PATH]", FRAGMENT_MARK)).split(FRAGMENT_MARK)
 
-    if isinstance(elem, NavigableString) and hasattr(elem, "string") and not isinstance(elem.string, Comment) \
-            and elem.string != "\n":
-        elem.string.replaceWith(transcribe(elem.string, vaf=vaf, vvf=vvf))
 
-    if hasattr(elem, "children"):
-        for ch in elem.children:
-            if not isinstance(ch, Comment):
-                transcribe_elem_text(ch, vaf, vvf)
+def splice_fragments(html, url_path):
+    """
+    Replace the fragment placeholders of a serialized page with the template fragments.
+    :param html: serialized page
+    :param url_path: requested path
+    :return: html
+    """
+    wp_es_link = url_path.join(WP_ES_LINK_FRAGMENT)
+    for name, fragment in (("HEAD", HEAD_FRAGMENT), ("BODY", BODY_FRAGMENT), ("WP_ES_LINK", wp_es_link)):
+        html = html.replace(f"<!--{FRAGMENT_MARK}{name}-->", fragment, 1)
+    return html
 
 
-@cached(cache)
-def transcribe_html(html_content, url_path, vaf="ç", vvf="h"):
+def transcribe_html(html_content, url_path, vaf="ç", vvf="h", page_blocks=None):
     """
     Transcribe a whole html page
     :param html_content: html content
     :param vaf: vaf configuration for andaluh-py
     :param vvf: vvf configuration for andaluh-py
+    :param page_blocks: app.blocks.BlockTranscriptions of the page, see transcribe_nodes()
     :return:
     """
-    soup = BeautifulSoup(html_content, "lxml")
+    with metrics.stage("parse"):
+        soup = BeautifulSoup(html_content, "lxml")
+
+    soup.head.append(Comment(FRAGMENT_MARK + "HEAD"))
+
+    with metrics.stage("transcribe"):
+        if soup.head.title.string == 'Wikipedia, la enciclopedia libre':
+            soup.head.title.string = WKP_TITLE
+        else:
+            title_es = soup.head.title.string.split(" - Wikipedia, la enciclopedia libre")[0]
+            title_and = transcribe(title_es, vaf=vaf, vvf=vvf)
+            soup.head.title.string = title_and + ' - ' + WKP_TITLE
 
-    head_tag = BeautifulSoup(HEAD, "html.parser")
-    soup.head.insert(len(soup.head.contents), head_tag)
+    with metrics.stage("walk"):
+        nodes, rewrites = walk_page(soup)
+    with metrics.stage("transcribe"):
+        transcribe_nodes(nodes, vaf=vaf, vvf=vvf, page_blocks=page_blocks)
 
-    # Appending Google Analytics tracking ID (if present) as last head element
-    if os.getenv('GA_TRACK_UA'):
-        ga_ua_html = GA_TRACKING_HEADER.replace("{GA_TRACK_UA}", os.getenv('GA_TRACK_UA'))
-        ga_ua_tag = BeautifulSoup(ga_ua_html)
-        soup.head.insert(len(soup.head.contents), ga_ua_tag)
+    soup.body.append(Comment(FRAGMENT_MARK + "BODY"))
 
+    # Link insertion, removals and link rewrites, see app.rewrite
+    with metrics.stage("rewrite"):
+        for action, elem in rewrites:
+            apply_rewrite(action, elem, url_path)
+
+    # Template fragments are parsed and serialized once, see prepare_fragment()
+    with metrics.stage("serialize"):
+        return splice_fragments(str(soup), url_path)
+
+
+def neutral_html(html_content, url_path, page_blocks=None):
+    """
+    Transcribe a whole html page to its variant-neutral form, see app.variants
+    The texts whose neutral form can't be rendered are left out and transcribed for each variant.
+    :param html_content: html content, without the placeholder letters of app.variants
+    :param url_path: requested path, without the placeholder letters of app.variants
+    :param page_blocks: app.blocks.BlockTranscriptions of the neutral form of the page, see transcribe_nodes()
+    :return: dict with the "texts" left out and the html "parts" around them
+    """
+    with metrics.stage("parse"):
+        soup = BeautifulSoup(html_content, "lxml")
+
+    soup.head.append(Comment(FRAGMENT_MARK + "HEAD"))
+
+    nodes = []
     if soup.head.title.string == 'Wikipedia, la enciclopedia libre':
         soup.head.title.string = WKP_TITLE
     else:
-        title_es = soup.head.title.string.split(" - Wikipedia, la enciclopedia libre")[0]
-        title_and = transcribe(title_es)
-        soup.head.title.string = title_and + ' - ' + WKP_TITLE
-
-    transcribe_elem_text(soup.body, vaf=vaf, vvf=vvf)
-
-    body_tag = BeautifulSoup(BODY, "html.parser")
-    soup.body.insert(len(soup.body.contents), body_tag)
-
-    # Adding Spanish Wikipedia link to "Languages" side menu
-    list_lang_links = soup.select_one("nav#p-lang ul.vector-menu-content-list")
-    if list_lang_links is not None:
-        wp_es_link_filled = WP_ES_LINK.replace("[ARTICLE_PATH]", url_path)
-        wp_es_link_tag = BeautifulSoup(wp_es_link_filled, "html.parser")
-        list_lang_links.insert(0, wp_es_link_tag)
-
-    # The next removal sections are included to comply with Wikimedia Trademark Policy.
-    # Check https://foundation.wikimedia.org/wiki/Trademark_policy
-
-    # Remove footer. Contains Wikipedia T&C's.
-    footer = soup.select_one("footer")
-    if footer is not None:
-        footer.replaceWith('')
-
-    footer_mobile_menu = soup.select_one("div.toggle-list__list ul.hlist")
-    if footer_mobile_menu is not None:
-        footer_mobile_menu.replaceWith('')
-
-    # Remove Wikipedia welcome and  notices. Contains Wikipedia trade marks and contact information.
-    welcome = soup.select_one("div.main-top")
-    if welcome is not None:
-        welcome.replaceWith('')
-
-    cnotice = soup.select_one("div.cnotice")
-    if cnotice is not None:
-        cnotice.replaceWith('')
-
-    siteNotice = soup.select_one("div#siteNotice")
-    if siteNotice is not None:
-        siteNotice.replaceWith('')
-
-    # Removing Wikipedia personal account login and contributions sections.
-    personal = soup.select_one("nav#p-personal ul.vector-menu-content-list")
-    if personal is not None:
-        personal.replaceWith('')
-
-    personal_mobile = soup.select_one("div.toggle-list__list ul#p-personal")
-    if personal_mobile is not None:
-        personal_mobile.replaceWith('')
-
-    # The next sections are to remove wikipedia edit and source code.
-    # Which are not relevant for this proxy project.
-
-    # Removing View Source Code button.
-    source = soup.select_one("nav#p-views li#ca-viewsource")
-    if source is not None:
-        source.replaceWith('')
-
-    # Removing Edit page button.
-    edit = soup.select_one("nav#p-views li#ca-edit")
-    if edit is not None:
-        edit.replaceWith('')
-
-    # Redirecting static files to GitHub
-    for link in soup.findAll('link'):
-        link['href'] = link['href'] \
-            .replace("/static", WKP_HTML_STATIC_GITHUB)
+        soup.head.title.string = soup.head.title.string.split(" - Wikipedia, la enciclopedia libre")[0]
+        nodes.append(soup.head.title.string)
+        soup.head.title.append(' - ' + WKP_TITLE)
+
+    with metrics.stage("walk"):
+        page_nodes, rewrites = walk_page(soup)
+        nodes.extend(page_nodes)
+    with metrics.stage("transcribe"):
+        texts = [str(node) for node in nodes]
+        if page_blocks is not None:
+            neutrals = blocks.transcribe_blocks(nodes, partial(transcribe_texts, vaf=NEUTRAL_VAF, vvf=NEUTRAL_VVF),
+                                                page_blocks)
+        else:
+            neutrals = transcribe_texts(texts, vaf=NEUTRAL_VAF, vvf=NEUTRAL_VVF)
+
+    left_out = []
+    for node, text, neutral in zip(nodes, texts, neutrals):
+        neutral = variants.renderable_form(neutral)
+        if neutral is not None:
+            node.replaceWith(neutral)
+        else:
+            node.replaceWith(Comment(FRAGMENT_MARK + "TEXT"))
+            left_out.append(text)
+
+    soup.body.append(Comment(FRAGMENT_MARK + "BODY"))
+
+    with metrics.stage("rewrite"):
+        for action, elem in rewrites:
+            apply_rewrite(action, elem, url_path)
+
+    with metrics.stage("serialize"):
+        html = splice_fragments(str(soup), url_path)
+    return {"texts": left_out, "parts": html.split(f"<!--{FRAGMENT_MARK}TEXT-->")}
+
+
+def render_html(page, vaf="ç", vvf="h"):
+    """
+    Render a variant of a page from its neutral form, see neutral_html()
+    :param page: neutral form of the page
+    :param vaf: vaf configuration for andaluh-py
+    :param vvf: vvf configuration for andaluh-py
+    :return: html
+    """
+    with metrics.stage("transcribe"):
+        transcriptions = transcribe_texts(page["texts"], vaf=vaf, vvf=vvf) if page["texts"] else []
+    with metrics.stage("render"):
+        parts = page["parts"]
+        html = [variants.render(parts[0], vaf, vvf)]
+        for transcription, part in zip(transcriptions, parts[1:]):
+            html.append(escape(transcription, quote=False))
+            html.append(variants.render(part, vaf, vvf))
+        return "".join(html)
+
+
+def neutral_html_cached(resp, url_path, revision):
+    """
+    Neutral form of a page through the host-wide page cache, shared by all its variants.
+    :param resp: upstream html response to a GET request
+    :param url_path: requested path
+    :param revision: upstream revision of the page
+    :return: neutral form of the page, see neutral_html(), or None if the page has no neutral form
+    """
+    url = requested_url(resp)
+    key = page_cache.key(url, revision, NEUTRAL_VAF, NEUTRAL_VVF)
+    cached = page_cache.get(key)
+    if cached is not None:
+        return json.loads(cached["identity"])
+
+    html_content = resp.content.decode("utf-8")
+    if not variants.can_be_neutral(html_content) or not variants.can_be_neutral(url_path):
+        return None
+    # Only the blocks changed since the last revision of the page are transcribed
+    page_blocks = blocks.load(url, NEUTRAL_VAF, NEUTRAL_VVF) if resp.status_code < 500 else None
+    page = neutral_html(html_content, url_path, page_blocks=page_blocks)
+    blocks.store(url, NEUTRAL_VAF, NEUTRAL_VVF, page_blocks)
+    page_cache.set(key, {"identity": json.dumps(page, ensure_ascii=False).encode("utf-8")}, path=url,
+                   variant=NEUTRAL_VAF + NEUTRAL_VVF, revision=revision, content_type="application/json")
+    return page
+
+
+def transcribe_html_encoded(resp, url_path, vaf="ç", vvf="h"):
+    """
+    Transcribe a whole html page through the host-wide page cache shared by all workers.
+    Pages are compressed once, when they are transcribed, and cached with their compressed versions.
+    :param resp: upstream html response
+    :param url_path: requested path
+    :param vaf: vaf configuration for andaluh-py
+    :param vvf: vvf configuration for andaluh-py
+    :return: dict of content encoding -> transcribed page
+    """
+    # Only GET responses are addressable by URL; form submissions are always transcribed.
+    if resp.request.method != "GET":
+        return {"identity": transcribe_html(resp.content.decode("utf-8"), url_path, vaf=vaf, vvf=vvf).encode("utf-8")}
+
+    revision = upstream_revision(resp)
+    url = requested_url(resp)
+    key = page_cache.key(url, revision, vaf, vvf)
+    validated = resp.status_code < 500
+    encoded = page_cache.get(key, validated=validated)
+    if encoded is None:
+        # Pages pre-transcribed from a dump only know their MediaWiki revision, see app.warmup
+        dump_revision = content_revision(resp.content)
+        if dump_revision is not None and dump_revision != revision:
+            encoded = page_cache.get(page_cache.key(url, dump_revision, vaf, vvf), validated=validated)
+    if encoded is None:
+        # Other variants of the page are rendered from the same neutral form
+        page = neutral_html_cached(resp, url_path, revision)
+        if page is not None:
+            content = render_html(page, vaf=vaf, vvf=vvf).encode("utf-8")
+        else:
+            page_blocks = blocks.load(url, vaf, vvf) if validated else None
+            content = transcribe_html(resp.content.decode("utf-8"), url_path, vaf=vaf, vvf=vvf,
+                                      page_blocks=page_blocks).encode("utf-8")
+            blocks.store(url, vaf, vvf, page_blocks)
+        encoded = compress_all(content)
+        # Error pages of the upstream are not kept, nor served stale in place of the page
+        if validated:
+            page_cache.set(key, encoded, path=url, variant=vaf + vvf, revision=revision,
+                           content_type=WKP_CT_HTML, headers=upstream_headers(resp), status=resp.status_code)
+    return encoded
+
+
+def transcribe_html_cached(resp, url_path, vaf="ç", vvf="h"):
+    """
+    Transcribe a whole html page through the host-wide page cache shared by all workers.
+    :param resp: upstream html response
+    :param url_path: requested path
+    :param vaf: vaf configuration for andaluh-py
+    :param vvf: vvf configuration for andaluh-py
+    :return: transcribed page as bytes
+    """
+    return transcribe_html_encoded(resp, url_path, vaf=vaf, vvf=vvf)["identity"]
+
+
+def stream_html_content(resp, url_path, key=None, revision=None, vaf="ç", vvf="h"):
+    """
+    Transcribe a whole html page while it is received.
+    :param resp: upstream html response, requested with stream=True
+    :param url_path: requested path
+    :param key: page cache key to store the transcribed page, None to skip the cache
+    :param revision: upstream revision of the page
+    :param vaf: vaf configuration for andaluh-py
+    :param vvf: vvf configuration for andaluh-py
+    :return: generator of transcribed byte chunks
+    """
+    from app.stream import STREAM_CHUNK_BYTES, transcribe_html_stream
+
+    chunks = []
+    try:
+        for chunk in transcribe_html_stream(resp.iter_content(STREAM_CHUNK_BYTES), url_path, vaf=vaf, vvf=vvf):
+            if key is not None:
+                chunks.append(chunk)
+            yield chunk
+    finally:
+        resp.close()
+
+    if key is not None and resp.status_code < 500:
+        page_cache.set(key, compress_all(b"".join(chunks)), path=requested_url(resp), variant=vaf + vvf,
+                       revision=revision, content_type=WKP_CT_HTML, headers=upstream_headers(resp),
+                       status=resp.status_code)
 
-    return str(soup)
 
+def stream_html_response(resp, url_path, user_agent, vaf="ç", vvf="h"):
+    """
+    Response with a transcribed html page, rewritten while it is received unless it is cached.
+    :param resp: upstream html response to a GET request, requested with stream=True
+    :param url_path: requested path
+    :param user_agent: client User-Agent
+    :param vaf: vaf configuration for andaluh-py
+    :param vvf: vvf configuration for andaluh-py
+    :return: Flask response
+    """
+    # The revision must be known before the body is read, so only the HTTP validators are used.
+    revision = resp.headers.get("ETag") or resp.headers.get("Last-Modified")
+    key = page_cache.key(requested_url(resp), revision, vaf, vvf) if revision else None
+    encoded = page_cache.get(key, validated=resp.status_code < 500) if key else None
+    if encoded is not None:
+        resp.close()
+        return prepared_response(PreparedContent(resp.status_code, upstream_headers(resp), encoded), user_agent,
+                                 vaf=vaf, vvf=vvf)
+
+    response = add_cache_validators(
+        Response(stream_html_content(resp, url_path, key, revision, vaf=vaf, vvf=vvf),
+                 content_type=WKP_CT_HTML, headers={"User-Agent": user_agent, "Vary": "Accept-Encoding"}),
+        resp, vaf=vaf, vvf=vvf)
+    if response.status_code == 304:
+        resp.close()
+    return response
+
+
+def passthrough(resp, accept_encoding):
+    """
+    Relay a response that is not transcribed while it is received, see app.assets
+    :param resp: upstream response to a GET request, requested with stream=True
+    :param accept_encoding: client Accept-Encoding header
+    :return: PreparedContent with the body stream
+    """
+    headers = upstream_headers(resp)
+    url = requested_url(resp)
+    if assets.is_text(resp.headers.get("Content-Type")):
+        stream = assets.relay(resp, url, headers,
+                              rewrite=partial(assets.rewrite_stream, old=WKP_CSS_STATIC, new=WKP_CSS_STATIC_GITHUB))
+    elif assets.accepts(accept_encoding, resp.headers.get("Content-Encoding")):
+        # Still compressed, as the upstream sent it
+        headers.update((name, resp.headers[name]) for name in assets.RAW_HEADERS if name in resp.headers)
+        stream = assets.relay(resp, url, headers)
+    else:
+        stream = assets.relay(resp, url, headers, decode=True)
+    return PreparedContent(resp.status_code, headers, None, stream=stream, close=resp.close)
+
+
+def prepare_upstream(target_url, headers, url_path, vaf="ç", vvf="h", accept_encoding=None):
+    """
+    Fetch a page with a GET request and transcribe it.
+    :param target_url: absolute upstream url
+    :param headers: request headers
+    :param url_path: requested path
+    :param vaf: vaf configuration for andaluh-py
+    :param vvf: vvf configuration for andaluh-py
+    :param accept_encoding: client Accept-Encoding header, for the contents relayed as they are
+    :return: PreparedContent
+    """
+    # Cached JSON responses and pages are looked up before, see stored_prepared_content()
+    api = json_api.match(target_url)
+    asset = cached_asset(target_url, accept_encoding) if api is None else None
+    if asset is not None:
+        return asset
+
+    with metrics.stage("fetch"):
+        resp = fetch('GET', target_url, headers, stream=True)
+    if resp.status_code == 304:
+        resp.close()
+        return PreparedContent(304, upstream_headers(resp), None)
+
+    content_type = resp.headers.get("Content-Type") or ""
+    if content_type != WKP_CT_HTML and (api is None or not content_type.startswith("application/json")):
+        return passthrough(resp, accept_encoding)
+
+    try:
+        if content_type == WKP_CT_HTML:
+            encoded = transcribe_html_encoded(resp, url_path, vaf=vaf, vvf=vvf)
+        else:
+            encoded = {"identity": prepare_content(resp, url_path, vaf=vaf, vvf=vvf)}
+    finally:
+        resp.close()
+    prepared = PreparedContent(resp.status_code, upstream_headers(resp), encoded)
+    if api is not None and resp.status_code == 200:
+        json_api.cache_response(api, (target_url, vaf, vvf), prepared)
+    return prepared
+
+
+def cached_asset(target_url, accept_encoding):
+    """
+    Content relayed as it is, kept in the asset cache, see app.assets
+    :param target_url: absolute upstream url, normalized as the url of the upstream responses
+    :param accept_encoding: client Accept-Encoding header
+    :return: PreparedContent with the body stream or None
+    """
+    entry = assets.cached(target_url, accept_encoding)
+    if entry is None:
+        return None
+    asset_headers, body = entry
+    return PreparedContent(200, asset_headers, None, stream=assets.read_chunks(body), close=body.close)
+
+
+def shared_prepared_content(target_url, vaf, vvf, since):
+    """
+    Page transcribed by another worker process, see app.coalesce
+    :param target_url: absolute upstream url
+    :param vaf: vaf configuration for andaluh-py
+    :param vvf: vvf configuration for andaluh-py
+    :param since: only pages transcribed at or after this timestamp are taken
+    :return: PreparedContent or None
+    """
+    entry = page_cache.latest(target_url, vaf + vvf, since)
+    if entry is None:
+        return None
+    encoded, headers, status_code, _ = entry
+    return PreparedContent(status_code, headers, encoded)
+
+
+def stored_prepared_content(target_url, vaf, vvf):
+    """
+    Cached response to a GET request, see app.revalidate
+    :param target_url: absolute upstream url, normalized as the url of the upstream responses
+    :param vaf: vaf configuration for andaluh-py
+    :param vvf: vvf configuration for andaluh-py
+    :return: (PreparedContent, freshness) or None
+    """
+    # Search-as-you-type and page previews ask for the same JSON responses again and again
+    api = json_api.match(target_url)
+    if api is not None:
+        entry = json_api.cached_response(api, (target_url, vaf, vvf))
+        if entry is None:
+            return None
+        prepared, age = entry
+        return prepared, revalidate.freshness(age, api.ttl, api.stale_ttl, api.stale_if_error_ttl)
+
+    windows = (revalidate.PAGE_FRESH_TTL, revalidate.PAGE_STALE_TTL, revalidate.PAGE_STALE_IF_ERROR_TTL)
+    now = time.time()
+    # A fresh page in the memory of this worker is served without reading the page store
+    entry = page_cache.latest(target_url, vaf + vvf, now - revalidate.max_age(*windows),
+                              memory_since=now - revalidate.PAGE_FRESH_TTL)
+    if entry is None:
+        return None
+    encoded, headers, status_code, validated = entry
+    return PreparedContent(status_code, headers, encoded), revalidate.freshness(now - validated, *windows)
+
+
+def refresh_upstream(target_url, headers, url_path, vaf="ç", vvf="h"):
+    """
+    Fetch and transcribe again a stale response for the next requests, in a background thread.
+    :param target_url: absolute upstream url
+    :param headers: request headers, without the validators of the client
+    :param url_path: requested path
+    :param vaf: vaf configuration for andaluh-py
+    :param vvf: vvf configuration for andaluh-py
+    """
+    prepared = coalesced_prepare_upstream(target_url, headers, url_path, vaf=vaf, vvf=vvf)
+    if prepared.close is not None:
+        prepared.close()
+
+
+def normalize_url(url):
+    """
+    :param url: absolute upstream url
+    :return: url with the same normalization as the url of the upstream responses, the path of the
+        page cache entries
+    """
+    return requests.Request('GET', url).prepare().url
+
+
+def coalesced_prepare_upstream(target_url, headers, url_path, vaf="ç", vvf="h", accept_encoding=None):
+    """
+    prepare_upstream() shared by the concurrent requests for the same page.
+    Relayed contents are not shared, every request streams its own.
+    :param target_url: absolute upstream url
+    :param headers: request headers
+    :param url_path: requested path
+    :param vaf: vaf configuration for andaluh-py
+    :param vvf: vvf configuration for andaluh-py
+    :param accept_encoding: client Accept-Encoding header
+    :return: PreparedContent
+    """
+    target_url = normalize_url(target_url)
+    # Conditional requests may get a 304 Not Modified, only useful to the requests with the same validators.
+    key = "\x00".join((target_url, vaf + vvf,
+                        headers.get("If-None-Match", ""), headers.get("If-Modified-Since", "")))
+    work = partial(prepare_upstream, target_url, headers, url_path, vaf=vaf, vvf=vvf, accept_encoding=accept_encoding)
+    return single_flight(key, work, partial(shared_prepared_content, target_url, vaf, vvf),
+                         shareable=lambda prepared: prepared.stream is None)
+
+
+def prepared_response(prepared, user_agent, vaf="ç", vvf="h"):
+    """
+    Response with a transcribed content, compressed as the client prefers when possible.
+    :param prepared: PreparedContent
+    :param user_agent: client User-Agent
+    :param vaf: vaf configuration for andaluh-py
+    :param vvf: vvf configuration for andaluh-py
+    :return: Flask response
+    """
+    if prepared.status_code == 304:
+        return add_cache_validators(Response(status=304), prepared, vaf=vaf, vvf=vvf)
+
+    if prepared.stream is not None:
+        response = Response(prepared.stream, status=prepared.status_code,
+                            content_type=prepared.headers.get("Content-Type"), headers={"User-Agent": user_agent})
+        for name in assets.RAW_HEADERS:
+            if name in prepared.headers:
+                response.headers[name] = prepared.headers[name]
+        # Also run when the body is not sent, e.g. on a 304 Not Modified
+        response.call_on_close(prepared.close)
+        return add_cache_validators(response, prepared, vaf=vaf, vvf=vvf)
+
+    content_type = prepared.headers.get("Content-Type")
+    headers = {"User-Agent": user_agent}
+    if content_type == WKP_CT_HTML:
+        headers["Vary"] = "Accept-Encoding"
+
+    encoding = negotiate(request.headers.get("Accept-Encoding"), prepared.encoded)
+    response = Response(prepared.encoded[encoding], content_type=content_type, headers=headers)
+    if encoding != "identity":
+        response.headers["Content-Encoding"] = encoding
+    return add_cache_validators(response, prepared, prepared.encoded["identity"], vaf=vaf, vvf=vvf)
 
-def prepare_content(resp, url_path):
+
+def stale_response(prepared, user_agent, vaf="ç", vvf="h"):
+    """
+    Response with a cached content too old to be served, but the upstream failed.
+    :param prepared: PreparedContent
+    :param user_agent: client User-Agent
+    :param vaf: vaf configuration for andaluh-py
+    :param vvf: vvf configuration for andaluh-py
+    :return: Flask response
+    """
+    metrics.incr("cached_responses_total", freshness=revalidate.STALE_IF_ERROR)
+    response = prepared_response(prepared, user_agent, vaf=vaf, vvf=vvf)
+    response.headers["Warning"] = '111 - "Revalidation Failed"'
+    return response
+
+
+def content_kind(content_type):
+    """
+    :param content_type: Content-Type header of the upstream response
+    :return: key of CACHE_CONTROL or None
+    """
+    if not content_type:
+        return None
+    if content_type == WKP_CT_HTML:
+        return "html"
+    if WKP_CT_SUMMARY_API.match(content_type):
+        return "summary"
+    if content_type.startswith("text/css"):
+        return "css"
+    return None
+
+
+def add_cache_validators(response, resp, content=None, vaf="ç", vvf="h"):
+    """
+    Set ETag, Last-Modified and Cache-Control on a response and turn it into a 304 Not Modified
+    when the client copy is still valid.
+    :param response: Flask response
+    :param resp: upstream response or PreparedContent
+    :param content: transcribed bytes, None when streamed
+    :param vaf: vaf configuration for andaluh-py
+    :param vvf: vvf configuration for andaluh-py
+    :return: Flask response
+    """
+    if request.method != "GET" or resp.status_code not in (200, 304):
+        return response
+
+    etag = output_etag(resp.headers.get("ETag"), content, vaf, vvf)
+    if etag is not None:
+        # Compressed bytes differ from the identity ones, but the representation is the same.
+        opaque, weak = etag
+        response.set_etag(opaque, weak or "Content-Encoding" in response.headers)
+    if resp.headers.get("Last-Modified"):
+        response.headers["Last-Modified"] = resp.headers["Last-Modified"]
+
+    kind = content_kind(resp.headers.get("Content-Type"))
+    # Upstream 304 responses usually come without Content-Type, and pages are the usual case.
+    if kind is None and resp.status_code == 304:
+        kind = "html"
+    cache_control = CACHE_CONTROL.get(kind) or resp.headers.get("Cache-Control")
+    if cache_control:
+        response.headers["Cache-Control"] = cache_control
+
+    return response.make_conditional(request)
+
+
+def prepare_content(resp, url_path, vaf="ç", vvf="h"):
     """
     Transcribe the content of any response from Spanish Wikipedia
     :param resp: response to process
+    :param url_path: requested path
+    :param vaf: vaf configuration for andaluh-py
+    :param vvf: vvf configuration for andaluh-py
     :return: transcribed content
     """
-    if re.match(WKP_CT_SUMMARY_API, resp.headers.get("Content-Type")):
-        content_dict = json.loads(resp.content)
-
-        for key in WKP_SUMMARY_API_KEYS_2_TRANSC:
-            if key in content_dict:
-                content_dict[key] = transcribe(content_dict[key])
-
-        content = json.dumps(content_dict, ensure_ascii=False).encode("utf-8")
-    elif resp.headers.get("Content-Type") == WKP_CT_HTML:
-        content = transcribe_html(resp.content.decode("utf-8"), url_path).encode("utf-8")
+    content_type = resp.headers.get("Content-Type") or ""
+    api = json_api.match(str(resp.url)) if content_type.startswith("application/json") else None
+    if api is not None:
+        with metrics.stage("transcribe"):
+            content = json_api.transcribe_json(resp.content, api, partial(transcribe_batch, vaf=vaf, vvf=vvf),
+                                               (vaf, vvf))
+    elif content_type == WKP_CT_HTML:
+        content = transcribe_html_cached(resp, url_path, vaf=vaf, vvf=vvf)
+    elif assets.is_text(content_type):
+        with metrics.stage("rewrite"):
+            content = resp.content.replace(WKP_CSS_STATIC, WKP_CSS_STATIC_GITHUB)
     else:
-        content = resp.content.replace(WKP_CSS_STATIC, WKP_CSS_STATIC_GITHUB)
+        content = resp.content
 
     return content
 
 
+@flask_app.before_request
+def start_request_metrics():
+    metrics.start_request()
+
+
+@flask_app.after_request
+def finish_request_metrics(response):
+    """
+    Record the request metrics and report its stages in the Server-Timing header.
+    """
+    elapsed, server_timing = metrics.finish_request()
+    if elapsed is None:
+        return response
+    response.headers["Server-Timing"] = server_timing
+    kind = content_kind(response.headers.get("Content-Type")) or "other"
+    metrics.observe("request_duration_seconds", elapsed, kind=kind)
+    metrics.incr("requests_total", method=request.method, status=str(response.status_code), kind=kind)
+    if not response.is_streamed:
+        metrics.incr("response_bytes_total", response.calculate_content_length() or 0, kind=kind)
+    metrics.flush()
+    return response
+
+
+@flask_app.route('/metrics')
+def get_metrics():
+    """
+    Metrics of every worker of the host in Prometheus text format, see app.metrics
+    """
+    if metrics.DISABLE_METRICS:
+        return Response("Metrics are disabled", status=404)
+    return Response(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+def remember_variant(response, vaf, vvf, chosen):
+    """
+    :param response: Flask response with a transcribed content
+    :param vaf: vaf of the transcription
+    :param vvf: vvf of the transcription
+    :param chosen: True if the variant was chosen in the query parameters, it is kept in cookies
+    :return: Flask response
+    """
+    response.vary.add("Cookie")
+    if chosen:
+        for name, value in variants.variant_cookies(vaf, vvf):
+            response.set_cookie(name, value, max_age=variants.VARIANT_COOKIE_MAX_AGE)
+    return response
+
+
 @flask_app.route('/', defaults={'url_path': ''})
 @flask_app.route('/robots.txt', defaults={'url_path': 'robots.txt'})
 @flask_app.route('/<path:url_path>', methods=["GET", "POST"])
@@ -198,26 +960,132 @@ def get_request(url_path):
     if url_path == 'robots.txt' and os.getenv('DISALLOW_ROBOTS'):
         return send_from_directory(flask_app.static_folder, 'robots.txt')
 
+    vaf, vvf, chosen = variants.request_variant(request.args, request.cookies)
+    priority = admission.classify(request.headers.get("User-Agent"), request.remote_addr)
+    return remember_variant(proxy_request(url_path, vaf, vvf, priority=priority), vaf, vvf, chosen)
+
+
+def proxy_request(url_path, vaf="ç", vvf="h", priority=admission.HUMAN):
+    """
+    Forward a request to Spanish Wikipedia and transcribe its response
+    :param url_path: requested path
+    :param vaf: vaf configuration for andaluh-py
+    :param vvf: vvf configuration for andaluh-py
+    :param priority: admission priority of the request, see app.admission
+    :return: Flask response
+    """
     target_url = ROOT_DOMAIN + url_path
-    http_method = requests.post if request.method == 'POST' else requests.get
+    http_method = 'POST' if request.method == 'POST' else 'GET'
 
     user_agent = request.headers.get("User-Agent")
+    headers = {"User-Agent": user_agent,
+               "Accept-Encoding": upstream_accept_encoding(request.headers.get("Accept-Encoding"))}
 
-    if request.query_string:
-        query_string_decoded = request.query_string.decode("utf-8")
-        target_url = f"{target_url}?{query_string_decoded}"
-        resp = http_method(target_url, headers={"User-Agent": user_agent})
-    elif request.json:
-        data = request.json
-        resp = http_method(target_url, json=data, headers={"User-Agent": user_agent})
-    elif request.form:
-        data = request.form.to_dict()
-        resp = http_method(target_url, data=data, headers={"User-Agent": user_agent})
-    else:
-        resp = http_method(target_url, headers={"User-Agent": user_agent})
+    # Revalidate the client copy upstream
+    if http_method == 'GET':
+        if_none_match = upstream_if_none_match(request.headers.get("If-None-Match"), vaf, vvf)
+        if if_none_match:
+            headers["If-None-Match"] = if_none_match
+        if request.headers.get("If-Modified-Since"):
+            headers["If-Modified-Since"] = request.headers["If-Modified-Since"]
+
+    # The variant parameters are ours, not forwarded upstream
+    query_string = variants.strip_variant_params(request.query_string.decode("utf-8"))
+    if query_string:
+        target_url = f"{target_url}?{query_string}"
+
+    stored = None
+    if http_method == 'GET':
+        stored_url = normalize_url(target_url)
+        stored = stored_prepared_content(stored_url, vaf, vvf)
+        if stored is not None and stored[1] in (revalidate.FRESH, revalidate.STALE):
+            prepared, freshness = stored
+            if freshness == revalidate.STALE:
+                refresh_headers = {name: headers[name] for name in ("User-Agent", "Accept-Encoding")}
+                revalidate.refresh(f"{target_url}\x00{vaf}{vvf}",
+                                   partial(refresh_upstream, target_url, refresh_headers, url_path, vaf=vaf, vvf=vvf))
+            metrics.incr("cached_responses_total", freshness=freshness)
+            return prepared_response(prepared, user_agent, vaf=vaf, vvf=vvf)
+        asset = cached_asset(stored_url, request.headers.get("Accept-Encoding")) if stored is None else None
+        if asset is not None:
+            return prepared_response(asset, user_agent, vaf=vaf, vvf=vvf)
+
+    # Cached transcriptions and assets are served to everyone above,
+    # requests going upstream wait for a slot of their priority
+    slot = admission.acquire(priority)
+    if slot is None:
+        if stored is not None:
+            return stale_response(stored[0], user_agent, vaf=vaf, vvf=vvf)
+        return Response("Too many requests, retry later", status=503,
+                        headers={"Retry-After": str(admission.ADMISSION_RETRY_AFTER)})
+    try:
+        return upstream_request(target_url, headers, url_path, query_string, stored, vaf=vaf, vvf=vvf)
+    finally:
+        admission.release(slot)
+
+
+def upstream_request(target_url, headers, url_path, query_string, stored, vaf="ç", vvf="h"):
+    """
+    Forward a request that missed the caches to Spanish Wikipedia and transcribe its response
+    :param target_url: upstream url
+    :param headers: upstream request headers
+    :param url_path: requested path
+    :param query_string: query string of the request, without the variant parameters
+    :param stored: (PreparedContent, freshness) served if the upstream fails, see stored_prepared_content()
+    :param vaf: vaf configuration for andaluh-py
+    :param vvf: vvf configuration for andaluh-py
+    :return: Flask response
+    """
+    http_method = 'POST' if request.method == 'POST' else 'GET'
+    user_agent = request.headers.get("User-Agent")
+
+    try:
+        if http_method == 'GET' and not STREAM_HTML:
+            prepared = coalesced_prepare_upstream(target_url, headers, url_path, vaf=vaf, vvf=vvf,
+                                                  accept_encoding=request.headers.get("Accept-Encoding"))
+            if prepared.status_code >= 500 and stored is not None:
+                if prepared.close is not None:
+                    prepared.close()
+                return stale_response(stored[0], user_agent, vaf=vaf, vvf=vvf)
+            return prepared_response(prepared, user_agent, vaf=vaf, vvf=vvf)
+
+        with metrics.stage("fetch"):
+            if query_string:
+                resp = fetch(http_method, target_url, headers, stream=STREAM_HTML)
+            elif request.json:
+                data = request.json
+                resp = fetch(http_method, target_url, headers, json=data, stream=STREAM_HTML)
+            elif request.form:
+                data = request.form.to_dict()
+                resp = fetch(http_method, target_url, headers, data=data, stream=STREAM_HTML)
+            else:
+                resp = fetch(http_method, target_url, headers, stream=STREAM_HTML)
+    except requests.exceptions.RequestException as e:
+        print(f"Error requesting {target_url}: {repr(e)}")
+        if stored is not None:
+            return stale_response(stored[0], user_agent, vaf=vaf, vvf=vvf)
+        if is_timeout(e):
+            return Response("Upstream timeout", status=504)
+        return Response("Upstream error", status=502)
+
+    if resp.status_code == 304:
+        resp.close()
+        return add_cache_validators(Response(status=304), resp, vaf=vaf, vvf=vvf)
+
+    if resp.status_code >= 500 and stored is not None:
+        resp.close()
+        return stale_response(stored[0], user_agent, vaf=vaf, vvf=vvf)
+
+    if http_method == 'GET' and resp.headers.get("Content-Type") == WKP_CT_HTML:
+        return stream_html_response(resp, url_path, user_agent, vaf=vaf, vvf=vvf)
+    if http_method == 'GET' and json_api.match(str(resp.url)) is None:
+        return prepared_response(passthrough(resp, request.headers.get("Accept-Encoding")), user_agent,
+                                 vaf=vaf, vvf=vvf)
 
-    content = prepare_content(resp, url_path)
-    return Response(content, content_type=resp.headers.get("Content-Type"), headers={"User-Agent": user_agent})
+    content = prepare_content(resp, url_path, vaf=vaf, vvf=vvf)
+    return add_cache_validators(
+        Response(content, content_type=resp.headers.get("Content-Type"), headers={"User-Agent": user_agent}),
+        resp, content, vaf=vaf, vvf=vvf)
 
 
 if __name__ == '__main__':
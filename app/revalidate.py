@@ -0,0 +1,97 @@
+"""
+Stale-while-revalidate serving of the cached transcriptions.
+
+A cached transcription is served without asking the upstream while it is fresh. During the stale
+window that follows it is still served at once, and a background thread of the worker fetches and
+transcribes the page again for the next requests. Past the stale window, requests wait for the
+upstream as usual, and the old transcription is only served if the upstream fails or times out.
+
+Pages use the PAGE_*_TTL windows below, each JSON API its own, see app.json_api.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from app import metrics
+
+PAGE_FRESH_TTL = float(os.getenv("PAGE_FRESH_TTL", 60))
+PAGE_STALE_TTL = float(os.getenv("PAGE_STALE_TTL", 3600))
+PAGE_STALE_IF_ERROR_TTL = float(os.getenv("PAGE_STALE_IF_ERROR_TTL", 24 * 3600))
+REFRESH_THREADS = int(os.getenv("REFRESH_THREADS", 2))
+
+FRESH = "fresh"
+STALE = "stale"
+# Only served when the upstream fails
+STALE_IF_ERROR = "stale_if_error"
+
+_executor = None
+_executor_pid = None
+_refreshing = set()
+_lock = threading.Lock()
+
+
+def max_age(fresh_ttl, stale_ttl, stale_if_error_ttl):
+    """
+    :return: seconds a transcription may still be served, see freshness()
+    """
+    return fresh_ttl + max(stale_ttl, stale_if_error_ttl)
+
+
+def freshness(age, fresh_ttl, stale_ttl, stale_if_error_ttl):
+    """
+    :param age: seconds since the transcription was stored or validated upstream
+    :param fresh_ttl: seconds it is fresh
+    :param stale_ttl: seconds it is served stale after that
+    :param stale_if_error_ttl: seconds it is served after that when the upstream fails
+    :return: FRESH, STALE, STALE_IF_ERROR or None once it is too old to be served
+    """
+    if age < fresh_ttl:
+        return FRESH
+    if age < fresh_ttl + stale_ttl:
+        return STALE
+    if age < fresh_ttl + stale_if_error_ttl:
+        return STALE_IF_ERROR
+    return None
+
+
+def get_executor():
+    """
+    Background refresh threads, one pool per worker process.
+    Threads don't survive a fork (uwsgi master -> workers), so each worker starts its own on first use.
+    :return: ThreadPoolExecutor
+    """
+    global _executor, _executor_pid, _refreshing
+    with _lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=REFRESH_THREADS)
+            _executor_pid = os.getpid()
+            _refreshing = set()
+        return _executor
+
+
+def refresh(key, work):
+    """
+    Run work() in the background, unless this worker process is already refreshing the same key.
+    :param key: string identifying the work
+    :param work: callable fetching and transcribing the page again
+    :return: True if a refresh was started
+    """
+    executor = get_executor()
+    with _lock:
+        if key in _refreshing:
+            return False
+        _refreshing.add(key)
+    executor.submit(run_refresh, key, work)
+    return True
+
+
+def run_refresh(key, work):
+    try:
+        work()
+        metrics.incr("background_refreshes_total", result="ok")
+    except Exception as e:
+        print(f"Error refreshing {key}: {repr(e)}")
+        metrics.incr("background_refreshes_total", result="error")
+    finally:
+        with _lock:
+            _refreshing.discard(key)
@@ -0,0 +1,105 @@
+"""
+Declarative rewrites of the upstream pages.
+
+Each rule is a CSS selector, made of compounds like tag#id.class joined by descendant combinators,
+and the action to apply to the matching elements. Rules are compiled once, at import, and matched
+in the same document traversal that collects the text to transcribe, so a new rule doesn't add
+another pass over the page.
+"""
+
+# Actions
+REMOVE = "remove"
+INSERT_WP_ES_LINK = "insert_wp_es_link"
+STATIC_HREF = "static_href"
+
+# (selector, action, first): with first, only the first matching element in document order, as
+# select_one() would, else every matching element.
+REWRITE_RULES = [
+    # Adding Spanish Wikipedia link to "Languages" side menu
+    ("nav#p-lang ul.vector-menu-content-list", INSERT_WP_ES_LINK, True),
+
+    # The next removals are included to comply with Wikimedia Trademark Policy.
+    # Check https://foundation.wikimedia.org/wiki/Trademark_policy
+    # Footer. Contains Wikipedia T&C's.
+    ("footer", REMOVE, True),
+    ("div.toggle-list__list ul.hlist", REMOVE, True),
+    # Wikipedia welcome and notices. Contains Wikipedia trade marks and contact information.
+    ("div.main-top", REMOVE, True),
+    ("div.cnotice", REMOVE, True),
+    ("div#siteNotice", REMOVE, True),
+    # Wikipedia personal account login and contributions sections.
+    ("nav#p-personal ul.vector-menu-content-list", REMOVE, True),
+    ("div.toggle-list__list ul#p-personal", REMOVE, True),
+
+    # The next removals are the wikipedia edit and source code buttons,
+    # which are not relevant for this proxy project.
+    ("nav#p-views li#ca-viewsource", REMOVE, True),
+    ("nav#p-views li#ca-edit", REMOVE, True),
+
+    # Redirecting static files to GitHub
+    ("link", STATIC_HREF, False),
+]
+
+
+def compile_selector(selector):
+    """
+    Compile a CSS selector made of compounds like tag#id.class joined by descendant combinators.
+    :param selector: CSS selector
+    :return: list of (tag, id, classes) tuples
+    """
+    compounds = []
+    for compound in selector.split():
+        classes = compound.split(".")
+        tag_id = classes.pop(0).split("#")
+        tag = tag_id[0] or None
+        elem_id = tag_id[1] if len(tag_id) > 1 else None
+        compounds.append((tag, elem_id, frozenset(classes)))
+    return compounds
+
+
+def compound_matches(compound, elem):
+    tag, elem_id, classes = compound
+    return (tag is None or tag == elem[0]) and (elem_id is None or elem_id == elem[1]) and classes <= elem[2]
+
+
+def selector_matches(compounds, stack):
+    """
+    :param compounds: compiled selector
+    :param stack: open elements, as (tag, id, classes), the current element last
+    :return: True if the current element matches the selector
+    """
+    if not stack or not compound_matches(compounds[-1], stack[-1]):
+        return False
+    pending = len(compounds) - 2
+    for elem in reversed(stack[:-1]):
+        if pending < 0:
+            break
+        if compound_matches(compounds[pending], elem):
+            pending -= 1
+    return pending < 0
+
+
+def index_rules(rules):
+    """
+    :param rules: list of (selector, action, first)
+    :return: dict of tag -> list of (rule index, compiled selector, action, first), None for any tag
+    """
+    index = {}
+    for i, (selector, action, first) in enumerate(rules):
+        compounds = compile_selector(selector)
+        index.setdefault(compounds[-1][0], []).append((i, compounds, action, first))
+    return index
+
+
+COMPILED_RULES = index_rules(REWRITE_RULES)
+
+
+def matching_rules(stack):
+    """
+    :param stack: open elements, as (tag, id, classes), the current element last
+    :return: list of (rule index, action, first) of the rules matching the current element, in rule order
+    """
+    candidates = COMPILED_RULES.get(stack[-1][0], ())
+    if None in COMPILED_RULES:
+        candidates = sorted(list(candidates) + COMPILED_RULES[None], key=lambda rule: rule[0])
+    return [(i, action, first) for i, compounds, action, first in candidates if selector_matches(compounds, stack)]
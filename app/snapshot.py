@@ -0,0 +1,181 @@
+"""
+Static snapshots of the most read pages, served by nginx without going through uwsgi.
+
+Exports a list of pages, transcribed to the default variant through the page cache, into a tree of
+html files with their precompressed .gz and .br versions, e.g. SNAPSHOT_DIR/wiki/Sevilla.html. nginx
+serves them to the requests without query string nor variant cookies, see flask-site-nginx.conf,
+and passes everything else to uwsgi. Each snapshot has a .json sidecar with its upstream ETag and
+timestamps: the refresh job revalidates the snapshots upstream every SNAPSHOT_CHECK_SECONDS, exports
+them again when the upstream revision changes or they are older than SNAPSHOT_TTL, and removes the
+pages the upstream no longer serves, so nginx falls back to uwsgi for them.
+
+    python -m app.snapshot export popular.txt --jobs 4
+    python -m app.snapshot refresh --interval 60
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import unquote
+
+import requests
+
+from app.cache import upstream_revision
+from app.proxy import WKP_CT_HTML, transcribe_html_encoded
+from app.upstream import ROOT_DOMAIN, fetch
+from app.warmup import read_paths, run
+
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", "/var/cache/andaluh-wiki/snapshots")
+# Snapshots are exported again after this, even if the upstream revision didn't change
+SNAPSHOT_TTL = float(os.getenv("SNAPSHOT_TTL", 24 * 3600))
+# Snapshots are revalidated upstream after this
+SNAPSHOT_CHECK_SECONDS = float(os.getenv("SNAPSHOT_CHECK_SECONDS", 300))
+
+# File suffix of each content encoding, those of the nginx gzip_static and brotli_static modules
+ENCODING_SUFFIXES = {"identity": "", "gzip": ".gz", "br": ".br"}
+PAGE_SUFFIX = ".html"
+META_SUFFIX = ".json"
+
+
+def snapshot_file(directory, url_path):
+    """
+    :param directory: snapshot directory
+    :param url_path: page path, may be url-encoded
+    :return: html file of the page snapshot, as nginx finds it from the decoded request uri, or None if
+        the page can't have one
+    """
+    if "?" in url_path:
+        return None
+    parts = unquote(url_path).strip("/").split("/")
+    if any(part in ("", ".", "..") for part in parts):
+        return None
+    return os.path.join(directory, *parts) + PAGE_SUFFIX
+
+
+def write_file(filename, content):
+    # Never half written for nginx
+    with open(filename + ".tmp", "wb") as f:
+        f.write(content)
+    os.replace(filename + ".tmp", filename)
+
+
+def remove_snapshot(filename):
+    for suffix in list(ENCODING_SUFFIXES.values()) + [META_SUFFIX]:
+        try:
+            os.remove(filename + suffix)
+        except FileNotFoundError:
+            pass
+
+
+def read_meta(filename):
+    with open(filename + META_SUFFIX, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def write_meta(filename, meta):
+    write_file(filename + META_SUFFIX, json.dumps(meta, ensure_ascii=False).encode("utf-8"))
+
+
+def export_page(url_path, directory, etag=None):
+    """
+    Fetch, transcribe and write the snapshot of a page.
+    :param url_path: page path
+    :param directory: snapshot directory
+    :param etag: upstream ETag of the current snapshot, to skip it if the upstream revision didn't change
+    :return: status message
+    """
+    filename = snapshot_file(directory, url_path)
+    if filename is None:
+        return "skipped, not a page path"
+    headers = {"Accept-Encoding": "gzip, deflate"}
+    if etag:
+        headers["If-None-Match"] = etag
+    try:
+        resp = fetch("GET", ROOT_DOMAIN + url_path, headers)
+    except requests.exceptions.RequestException as e:
+        return f"error {repr(e)}"
+
+    now = time.time()
+    if resp.status_code == 304:
+        meta = read_meta(filename)
+        meta["checked"] = now
+        write_meta(filename, meta)
+        return "not modified"
+    if resp.status_code >= 500:
+        # Kept until the upstream is back
+        return f"error upstream {resp.status_code}"
+    if resp.status_code != 200 or resp.headers.get("Content-Type") != WKP_CT_HTML:
+        remove_snapshot(filename)
+        return f"removed, upstream {resp.status_code} {resp.headers.get('Content-Type')}"
+
+    # Compressed once, as stored in the page cache
+    encoded = transcribe_html_encoded(resp, url_path)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    # The compressed versions first, nginx serves them whenever the html file exists
+    for encoding in sorted(encoded, key=lambda encoding: encoding == "identity"):
+        write_file(filename + ENCODING_SUFFIXES[encoding], encoded[encoding])
+    write_meta(filename, {"path": url_path, "etag": resp.headers.get("ETag"), "revision": upstream_revision(resp),
+                          "exported": now, "checked": now})
+    return "ok"
+
+
+def due_snapshots(directory, now):
+    """
+    :param directory: snapshot directory
+    :param now: current timestamp
+    :return: generator of (page path, ETag or None to export it again whatever its revision)
+    """
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            if not name.endswith(PAGE_SUFFIX + META_SUFFIX):
+                continue
+            try:
+                meta = read_meta(os.path.join(root, name[:-len(META_SUFFIX)]))
+            except (OSError, ValueError) as e:
+                print(f"Error reading snapshot {name}: {repr(e)}")
+                continue
+            if now - meta["exported"] >= SNAPSHOT_TTL:
+                yield meta["path"], None
+            elif now - meta["checked"] >= SNAPSHOT_CHECK_SECONDS:
+                yield meta["path"], meta["etag"]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m app.snapshot", description="Static page snapshots")
+    subparsers = parser.add_subparsers(dest="command")
+
+    export_parser = subparsers.add_parser("export", help="export the snapshots of a list of pages")
+    export_parser.add_argument("paths", help="text file, one page path per line, - for stdin")
+
+    refresh_parser = subparsers.add_parser("refresh", help="export again the expired or changed snapshots")
+    refresh_parser.add_argument("--interval", type=float, default=60, help="seconds between checks")
+    refresh_parser.add_argument("--once", action="store_true", help="check once and exit")
+
+    for subparser in (export_parser, refresh_parser):
+        subparser.add_argument("--dir", default=SNAPSHOT_DIR, help="snapshot directory")
+        subparser.add_argument("--jobs", type=int, default=os.cpu_count(), help="worker processes")
+
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.error("a command is required")
+
+    if args.command == "export":
+        jobs = ((url_path, export_page, (url_path, args.dir)) for url_path in read_paths(args.paths))
+        return 1 if run(jobs, args.jobs * 4, args.jobs) else 0
+
+    # One pool for the lifetime of the refresh job
+    with ProcessPoolExecutor(args.jobs) as executor:
+        while True:
+            jobs = ((url_path, export_page, (url_path, args.dir, etag))
+                    for url_path, etag in due_snapshots(args.dir, time.time()))
+            failed = run(jobs, args.jobs * 4, args.jobs, executor)
+            if args.once:
+                return 1 if failed else 0
+            time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,208 @@
+"""
+Streaming counterpart of app.proxy.transcribe_html.
+
+The upstream page is parsed incrementally with an event based parser and rewritten as it arrives,
+so the first bytes reach the client before the whole page is downloaded and no document tree is
+ever built. Tags are passed through as they were received and only the text is transcribed.
+"""
+import codecs
+import os
+from html import escape
+from html.parser import HTMLParser
+
+from app.proxy import (BODY_FRAGMENT, HEAD_FRAGMENT, NOT_TRANSCRIBABLE_ELEMENTS, WP_ES_LINK_FRAGMENT,
+                       WKP_HTML_STATIC_GITHUB, WKP_TITLE, transcribe, transcribe_batch)
+from app.rewrite import INSERT_WP_ES_LINK, REMOVE, REWRITE_RULES, compile_selector, selector_matches
+
+STREAM_CHUNK_BYTES = int(os.getenv("STREAM_CHUNK_BYTES", 64 * 1024))
+
+VOID_ELEMENTS = {"area", "base", "br", "col", "embed", "hr", "img", "input", "keygen", "link", "meta", "param",
+                 "source", "track", "wbr"}
+
+# Same rewrite rules as app.proxy.transcribe_html, see app.rewrite. Links are rewritten in start_element().
+REMOVED_ELEMENTS = [selector for selector, action, first in REWRITE_RULES if action == REMOVE]
+LANG_LINKS_LIST = next(selector for selector, action, first in REWRITE_RULES if action == INSERT_WP_ES_LINK)
+
+
+class StreamingTranscriber(HTMLParser):
+    """
+    Incremental html rewriter. feed() it with text and collect the rewritten html with flush().
+    """
+
+    def __init__(self, url_path, vaf="ç", vvf="h"):
+        super().__init__(convert_charrefs=True)
+        self.url_path = url_path
+        self.vaf = vaf
+        self.vvf = vvf
+        self.removals = [compile_selector(selector) for selector in REMOVED_ELEMENTS]
+        self.lang_links = compile_selector(LANG_LINKS_LIST)
+        self.lang_links_done = False
+        self.stack = []
+        self.skip_depth = None
+        self.in_body = False
+        self.in_title = False
+        self.text = []
+        self.out = []
+        self.texts = []
+
+    # Output helpers
+
+    def emit(self, html):
+        if self.skip_depth is None:
+            self.out.append(html)
+
+    def end_text(self):
+        """
+        Close the text node being received, it may have arrived in several pieces.
+        """
+        if not self.text:
+            return
+        text = "".join(self.text)
+        self.text = []
+        if self.skip_depth is not None:
+            return
+        if self.stack and self.stack[-1][0] in NOT_TRANSCRIBABLE_ELEMENTS:
+            self.out.append(text)
+        elif self.in_body and not text.isspace():
+            self.texts.append((len(self.out), text))
+            self.out.append(None)
+        else:
+            self.out.append(escape(text, quote=False))
+
+    def flush(self):
+        """
+        Transcribe the pending text nodes.
+        :return: the html rewritten since the previous flush
+        """
+        if self.texts:
+            transcriptions = transcribe_batch([text for _, text in self.texts], vaf=self.vaf, vvf=self.vvf)
+            for (position, _), transcription in zip(self.texts, transcriptions):
+                self.out[position] = escape(transcription, quote=False)
+            self.texts = []
+        html = "".join(self.out)
+        self.out = []
+        return html
+
+    # Parser events
+
+    def handle_starttag(self, tag, attrs):
+        self.end_text()
+        self.start_element(tag, attrs, self.get_starttag_text())
+        if tag not in VOID_ELEMENTS:
+            return
+        self.end_element()
+
+    def handle_startendtag(self, tag, attrs):
+        self.end_text()
+        self.start_element(tag, attrs, self.get_starttag_text())
+        self.end_element()
+
+    def start_element(self, tag, attrs, raw):
+        attributes = dict(attrs)
+        elem_id = attributes.get("id")
+        classes = frozenset((attributes.get("class") or "").split())
+        self.stack.append((tag, elem_id, classes))
+
+        for compounds in list(self.removals):
+            if selector_matches(compounds, self.stack):
+                self.removals.remove(compounds)
+                if self.skip_depth is None:
+                    self.skip_depth = len(self.stack)
+
+        if tag == "body":
+            self.in_body = True
+        elif tag == "title" and not self.in_body:
+            self.in_title = True
+        elif tag == "link" and "/static" in (attributes.get("href") or ""):
+            attributes["href"] = attributes["href"].replace("/static", WKP_HTML_STATIC_GITHUB)
+            raw = "<link" + "".join(f' {name}="{escape(value)}"' if value is not None else f" {name}"
+                                    for name, value in attributes.items()) + ">"
+
+        self.emit(raw)
+
+        # Adding Spanish Wikipedia link to "Languages" side menu
+        if not self.lang_links_done and selector_matches(self.lang_links, self.stack):
+            self.lang_links_done = True
+            self.emit(escape(self.url_path).join(WP_ES_LINK_FRAGMENT))
+
+    def end_element(self):
+        if self.skip_depth is not None and len(self.stack) == self.skip_depth:
+            self.skip_depth = None
+            self.stack.pop()
+            return True
+        self.stack.pop()
+        return False
+
+    def handle_endtag(self, tag):
+        if tag == "title" and self.in_title:
+            self.emit(escape(self.transcribe_title("".join(self.text)), quote=False))
+            self.text = []
+            self.in_title = False
+        self.end_text()
+
+        if tag == "head":
+            # Includes the Google Analytics tracking ID (if present)
+            self.emit(HEAD_FRAGMENT)
+        elif tag == "body":
+            self.emit(BODY_FRAGMENT)
+
+        if not any(elem[0] == tag for elem in self.stack):
+            self.emit(f"</{tag}>")
+            return
+        while self.stack:
+            if self.stack[-1][0] == tag:
+                was_removed = self.end_element()
+                if not was_removed:
+                    self.emit(f"</{tag}>")
+                return
+            self.end_element()
+
+    def transcribe_title(self, title):
+        if title == 'Wikipedia, la enciclopedia libre':
+            return WKP_TITLE
+        title_es = title.split(" - Wikipedia, la enciclopedia libre")[0]
+        return transcribe(title_es, vaf=self.vaf, vvf=self.vvf) + ' - ' + WKP_TITLE
+
+    def handle_data(self, data):
+        self.text.append(data)
+
+    def handle_comment(self, data):
+        self.end_text()
+        self.emit(f"<!--{data}-->")
+
+    def handle_decl(self, decl):
+        self.end_text()
+        self.emit(f"<!{decl}>")
+
+    def handle_pi(self, data):
+        self.end_text()
+        self.emit(f"<?{data}>")
+
+    def unknown_decl(self, data):
+        self.end_text()
+        self.emit(f"<![{data}]>")
+
+
+def transcribe_html_stream(chunks, url_path, vaf="ç", vvf="h"):
+    """
+    Transcribe a whole html page as it is received.
+    :param chunks: iterable of utf-8 encoded byte chunks of the upstream page
+    :param url_path: requested path
+    :param vaf: vaf configuration for andaluh-py
+    :param vvf: vvf configuration for andaluh-py
+    :return: generator of utf-8 encoded byte chunks of the transcribed page
+    """
+    parser = StreamingTranscriber(url_path, vaf=vaf, vvf=vvf)
+    decoder = codecs.getincrementaldecoder("utf-8")("replace")
+    for chunk in chunks:
+        parser.feed(decoder.decode(chunk))
+        html = parser.flush()
+        if html:
+            yield html.encode("utf-8")
+
+    parser.feed(decoder.decode(b"", final=True))
+    parser.close()
+    parser.end_text()
+    html = parser.flush()
+    if html:
+        yield html.encode("utf-8")
@@ -0,0 +1,89 @@
+import os
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError, ReadTimeoutError
+from urllib3.util.retry import Retry
+
+from app import metrics
+
+try:
+    import brotli  # noqa: F401. Lets urllib3 decode brotli encoded bodies.
+    DECODABLE_ENCODINGS = ("gzip", "deflate", "br")
+except ImportError:
+    DECODABLE_ENCODINGS = ("gzip", "deflate")
+
+# Point WKP_ROOT_DOMAIN to a local stand-in upstream to test or benchmark the proxy.
+ROOT_DOMAIN = os.getenv("WKP_ROOT_DOMAIN", "https://es.wikipedia.org/")
+UPSTREAM_POOL_SIZE = int(os.getenv("UPSTREAM_POOL_SIZE", 10))
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", 3.05))
+UPSTREAM_READ_TIMEOUT = float(os.getenv("UPSTREAM_READ_TIMEOUT", 20))
+UPSTREAM_RETRIES = int(os.getenv("UPSTREAM_RETRIES", 2))
+UPSTREAM_BACKOFF = float(os.getenv("UPSTREAM_BACKOFF", 0.3))
+
+_session = None
+_session_pid = None
+
+
+def get_session():
+    """
+    Keep-alive session to the upstream, one per worker process.
+    Sessions are not shared across a fork, so each uwsgi worker builds its own on first use.
+    :return: requests.Session
+    """
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        # Only idempotent methods are retried (urllib3 default), so form submissions are never sent twice.
+        retries = Retry(total=UPSTREAM_RETRIES, backoff_factor=UPSTREAM_BACKOFF,
+                        status_forcelist=(502, 503, 504), raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=UPSTREAM_POOL_SIZE, pool_maxsize=UPSTREAM_POOL_SIZE,
+                              max_retries=retries)
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        _session = session
+        _session_pid = os.getpid()
+    return _session
+
+
+def upstream_accept_encoding(accept_encoding):
+    """
+    Accept-Encoding to send upstream: the client preferences restricted to what we can decode.
+    :param accept_encoding: client Accept-Encoding header, may be None
+    :return: Accept-Encoding header value
+    """
+    if accept_encoding:
+        codings = [coding.split(";")[0].strip().lower() for coding in accept_encoding.split(",")]
+        accepted = [coding for coding in DECODABLE_ENCODINGS if coding in codings]
+        if accepted:
+            return ", ".join(accepted)
+    return ", ".join(DECODABLE_ENCODINGS)
+
+
+def fetch(method, url, headers, **kwargs):
+    """
+    Send a request upstream through the pooled session, with connect and read timeouts.
+    :param method: HTTP method
+    :param url: absolute upstream url
+    :param headers: request headers
+    :param kwargs: extra arguments for requests, such as json or data
+    :return: requests.Response
+    """
+    resp = get_session().request(method, url, headers=headers,
+                                 timeout=(UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_READ_TIMEOUT), **kwargs)
+    metrics.incr("upstream_responses_total", status=str(resp.status_code))
+    # Bytes on the wire, before decompression. Unknown for chunked responses.
+    if resp.headers.get("Content-Length", "").isdigit():
+        metrics.incr("upstream_bytes_total", int(resp.headers["Content-Length"]))
+    return resp
+
+
+def is_timeout(exc):
+    """
+    :param exc: exception raised by fetch()
+    :return: True if the upstream timed out, also when the timeout was wrapped by the retries
+    """
+    if isinstance(exc, requests.exceptions.Timeout):
+        return True
+    reason = getattr(exc.args[0], "reason", None) if exc.args else None
+    return isinstance(reason, (ConnectTimeoutError, ReadTimeoutError))
@@ -0,0 +1,166 @@
+"""
+Variant-neutral transcriptions.
+
+vaf and vvf only choose the letters written for the /s/ /θ/ and /x/ sounds, so a text is transcribed
+once with placeholder letters, its neutral form, and every variant is rendered from it by replacing
+those letters. The placeholders are Greek letters with case, unknown to the andaluh-py rules. A
+rule can still depend on the actual letter: the consonant clusters and word endings around it and
+the exception words written with ç. The neutral forms showing those contexts are not renderable,
+their texts are transcribed again for each variant.
+
+Clients choose their variant with the andaluh_vaf and andaluh_vvf query parameters, remembered in
+cookies of the same names.
+"""
+import itertools
+import re
+from urllib.parse import quote, unquote
+
+from andaluh import defs, lib
+
+VAF_VALUES = ("ç", "z", "s", "h")
+VVF_VALUES = ("h", "j")
+DEFAULT_VAF = "ç"
+DEFAULT_VVF = "h"
+VARIANT_PARAMS = ("andaluh_vaf", "andaluh_vvf")
+VARIANT_COOKIE_MAX_AGE = 365 * 24 * 3600
+
+# Greek stigma and sampi
+NEUTRAL_VAF = "ϛ"
+NEUTRAL_VVF = "ϡ"
+NEUTRAL_LETTERS = NEUTRAL_VAF + NEUTRAL_VAF.upper() + NEUTRAL_VVF + NEUTRAL_VVF.upper()
+
+VOWELS = "aeiouáéíóúâêîôûàèìòùü"
+VOWELS += VOWELS.upper()
+# First letters of the consonant clusters of andaluh.lib.digraph_rules and l_rules
+CLUSTER_CONSONANTS = "bcdfgjlpstxz"
+CLUSTER_CONSONANTS += CLUSTER_CONSONANTS.upper()
+# Placeholders between vowels, or after a word start or a consonant starting no cluster, are only
+# matched by the rules as any letter. vaf placeholders may come in pairs, for /ks/ between vowels.
+RENDERABLE_LETTER = re.compile(
+    rf"(?<![{CLUSTER_CONSONANTS}{NEUTRAL_VVF}{NEUTRAL_VVF.upper()}])"
+    rf"(?:[{NEUTRAL_VAF}{NEUTRAL_VAF.upper()}]{{1,2}}|[{NEUTRAL_VVF}{NEUTRAL_VVF.upper()}])(?=[{VOWELS}])")
+NEUTRAL_LETTER = re.compile(rf"[{NEUTRAL_LETTERS}]")
+# andaluh.lib.word_interaction_rules rotates a word ending l before any variant letter
+INTERACTION = re.compile(rf"\b(\w*?)(l)(\s)([{NEUTRAL_LETTERS}])", re.IGNORECASE)
+# Each rotation consumes the first letter of the next word, which can't be rotated in turn
+ROTATION_CONSONANTS = "bcçdfghjklmnñpqstvwxyz" + NEUTRAL_LETTERS
+CONSUMED_ROTATION = re.compile(rf"[lL]\s[{NEUTRAL_LETTERS}]\w*[rR]\s[{ROTATION_CONSONANTS}]|"
+                               rf"[rR]\s[{ROTATION_CONSONANTS}]\w*[lL]\s[{NEUTRAL_LETTERS}]", re.IGNORECASE)
+NEUTRAL_WORD = re.compile(rf"\w*[{NEUTRAL_LETTERS}]\w*")
+
+# Rules applied from the stage of each exception table on, see andaluh.lib.epa()
+EXCEPTION_STAGES = [
+    (defs.WORDEND_D_INTERVOWEL_RULES_EXCEPT, [lib.word_ending_rules, lib.digraph_rules, lib.exception_rules,
+                                              lib.word_interaction_rules]),
+    (defs.WORDEND_D_RULES_EXCEPT, [lib.word_ending_rules, lib.digraph_rules, lib.exception_rules,
+                                   lib.word_interaction_rules]),
+    (defs.WORDEND_S_RULES_EXCEPT, [lib.word_ending_rules, lib.digraph_rules, lib.exception_rules,
+                                   lib.word_interaction_rules]),
+    (defs.WORDEND_CONST_RULES_EXCEPT, [lib.word_ending_rules, lib.digraph_rules, lib.exception_rules,
+                                       lib.word_interaction_rules]),
+    (defs.ENDING_RULES_EXCEPTION, [lib.exception_rules, lib.word_interaction_rules]),
+]
+
+
+def neutral_exception_words():
+    """
+    Neutral forms of the exception words whose ç or h may come from vaf or vvf. The exception only
+    applies when the word is transcribed with those letters, so these words are not renderable.
+    :return: set of lowercase words
+    """
+    placeholders = {"ç": NEUTRAL_VAF, "h": NEUTRAL_VVF}
+    words = set()
+    for exceptions, rules in EXCEPTION_STAGES:
+        for word in exceptions:
+            positions = [i for i, char in enumerate(word) if char in placeholders]
+            for count in range(1, len(positions) + 1):
+                for replaced in itertools.combinations(positions, count):
+                    neutral = "".join(placeholders[char] if i in replaced else char for i, char in enumerate(word))
+                    for rule in rules:
+                        neutral = rule(neutral)
+                    words.add(neutral.lower())
+    return words
+
+
+NEUTRAL_EXCEPTION_WORDS = neutral_exception_words()
+_render_tables = {}
+
+
+def is_variant(vaf, vvf):
+    return vaf in VAF_VALUES and vvf in VVF_VALUES
+
+
+def request_variant(params, cookies):
+    """
+    Variant chosen by the client, in the query parameters or else in the cookies.
+    :param params: query parameters, as {name: value}
+    :param cookies: request cookies, as {name: value}
+    :return: (vaf, vvf, True if chosen in the query parameters)
+    """
+    vaf_param, vvf_param = VARIANT_PARAMS
+    cookies = {name: unquote(cookies.get(name) or "") for name in VARIANT_PARAMS}
+    if params.get(vaf_param) or params.get(vvf_param):
+        vaf = params.get(vaf_param) or cookies.get(vaf_param) or DEFAULT_VAF
+        vvf = params.get(vvf_param) or cookies.get(vvf_param) or DEFAULT_VVF
+        from_params = True
+    else:
+        vaf = cookies.get(vaf_param) or DEFAULT_VAF
+        vvf = cookies.get(vvf_param) or DEFAULT_VVF
+        from_params = False
+    if not is_variant(vaf, vvf):
+        return DEFAULT_VAF, DEFAULT_VVF, False
+    return vaf, vvf, from_params
+
+
+def variant_cookies(vaf, vvf):
+    """
+    :return: list of (cookie name, value) remembering the variant, the values are url-encoded
+    """
+    return [(name, quote(value)) for name, value in zip(VARIANT_PARAMS, (vaf, vvf))]
+
+
+def strip_variant_params(query_string):
+    """
+    :param query_string: raw query string, without the leading ?
+    :return: the query string without the variant parameters, which are not forwarded upstream
+    """
+    return "&".join(param for param in query_string.split("&")
+                    if param and param.split("=", 1)[0] not in VARIANT_PARAMS)
+
+
+def can_be_neutral(text):
+    """
+    :return: False if the text has the placeholder letters, which could not be told apart
+    """
+    return NEUTRAL_LETTER.search(text) is None
+
+
+def renderable_form(neutral):
+    """
+    :param neutral: neutral form of a text, transcribed by andaluh-py with NEUTRAL_VAF and NEUTRAL_VVF
+    :return: the neutral form to render(), giving the same transcription as andaluh-py for every
+        variant, or None if there is none
+    """
+    letters = sum(map(len, NEUTRAL_LETTER.findall(neutral)))
+    if not letters:
+        return neutral
+    if sum(map(len, RENDERABLE_LETTER.findall(neutral))) != letters or CONSUMED_ROTATION.search(neutral):
+        return None
+    if any(word.lower() in NEUTRAL_EXCEPTION_WORDS for word in NEUTRAL_WORD.findall(neutral)):
+        return None
+    return INTERACTION.sub(lambda match: match.group(1) + ("r" if match.group(2) == "l" else "R") +
+                           match.group(3) + match.group(4), neutral)
+
+
+def render(neutral, vaf, vvf):
+    """
+    :param neutral: neutral form of a text
+    :param vaf: vaf configuration for andaluh-py
+    :param vvf: vvf configuration for andaluh-py
+    :return: transcription of the text for the variant
+    """
+    table = _render_tables.get((vaf, vvf))
+    if table is None:
+        table = _render_tables[(vaf, vvf)] = {ord(NEUTRAL_VAF): vaf, ord(NEUTRAL_VAF.upper()): vaf.upper(),
+                                              ord(NEUTRAL_VVF): vvf, ord(NEUTRAL_VVF.upper()): vvf.upper()}
+    return neutral.translate(table)
@@ -0,0 +1,196 @@
+"""
+Offline warm-up of the page cache.
+
+Pre-transcribes a list of articles, fetched from the upstream, or a local dump of rendered
+Wikipedia pages into a page cache store (see app.cache). Point PAGE_CACHE_PATH to the store, or
+PAGE_CACHE_SEED to copy it into an empty page cache when the serving processes start:
+
+    python -m app.warmup paths popular.txt --cache warmup.sqlite3 --jobs 4 --resume
+    python -m app.warmup dump ./eswiki-html --cache warmup.sqlite3
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import requests
+
+from app.cache import content_revision, page_cache
+from app.compression import compress_all
+from app.proxy import WKP_CT_HTML, normalize_url, transcribe_html, transcribe_html_encoded
+from app.upstream import ROOT_DOMAIN, fetch
+
+WKP_PAGE_NAME = re.compile(rb'"wgPageName":"((?:[^"\\]|\\.)*)"')
+DUMP_EXTENSIONS = (".html", ".htm")
+
+
+def read_paths(filename):
+    """
+    :param filename: text file with one page path per line, "-" for stdin
+    :return: generator of page paths without the leading slash
+    """
+    lines = sys.stdin if filename == "-" else open(filename, encoding="utf-8")
+    with lines:
+        for line in lines:
+            url_path = line.strip().lstrip("/")
+            if url_path and not url_path.startswith("#"):
+                yield url_path
+
+
+def read_dump(directory):
+    """
+    :param directory: directory with rendered pages, one html file per page
+    :return: generator of (page path, filename), without reading the pages
+    """
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            if name.endswith(DUMP_EXTENSIONS):
+                filename = os.path.join(root, name)
+                yield dump_path(filename, directory), filename
+
+
+def dump_path(filename, directory):
+    """
+    Page path of a dumped page, from its MediaWiki page name or else from its filename.
+    :param filename: dumped page
+    :param directory: dump directory
+    :return: page path without the leading slash
+    """
+    with open(filename, "rb") as f:
+        page_name = WKP_PAGE_NAME.search(f.read(64 * 1024))
+    if page_name is not None:
+        return "wiki/" + json.loads(b'"' + page_name.group(1) + b'"')
+    name = os.path.splitext(os.path.relpath(filename, directory))[0].replace(os.sep, "/")
+    return name if name.startswith("wiki/") else "wiki/" + name
+
+
+def warm_path(url_path):
+    """
+    Fetch and transcribe a page into the page cache.
+    :param url_path: page path
+    :return: status message
+    """
+    try:
+        resp = fetch("GET", ROOT_DOMAIN + url_path, {"Accept-Encoding": "gzip, deflate"})
+    except requests.exceptions.RequestException as e:
+        return f"error {repr(e)}"
+    if resp.status_code != 200 or resp.headers.get("Content-Type") != WKP_CT_HTML:
+        return f"skipped, upstream {resp.status_code} {resp.headers.get('Content-Type')}"
+    transcribe_html_encoded(resp, url_path)
+    return "ok"
+
+
+def warm_dump_page(url_path, filename):
+    """
+    Transcribe a dumped page into the page cache, keyed by its MediaWiki revision.
+    :param url_path: page path
+    :param filename: dumped page
+    :return: status message
+    """
+    with open(filename, "rb") as f:
+        content = f.read()
+    revision = content_revision(content) or "sha1:" + hashlib.sha1(content).hexdigest()
+    url = normalize_url(ROOT_DOMAIN + url_path)
+    key = page_cache.key(url, revision, "ç", "h")
+    if page_cache.get(key) is not None:
+        return "cached"
+    encoded = compress_all(transcribe_html(content.decode("utf-8"), url_path).encode("utf-8"))
+    page_cache.set(key, encoded, path=url, variant="çh", revision=revision, content_type=WKP_CT_HTML,
+                   headers={"Content-Type": WKP_CT_HTML})
+    return "ok"
+
+
+def resume_job(url_path, func, args):
+    """
+    Run a task unless its page is already in the page cache, checked in the pool process: the parent
+    never opens a connection the forked processes would inherit.
+    :param url_path: page path
+    :param func: task function
+    :param args: task arguments
+    :return: status message
+    """
+    if page_cache.latest(normalize_url(ROOT_DOMAIN + url_path), "çh", 0) is not None:
+        return "cached"
+    return func(*args)
+
+
+def run(jobs, tasks, workers, executor=None):
+    """
+    Run the tasks on a process pool, with a bounded number of them in flight.
+    :param jobs: iterable of (page path, function, arguments)
+    :param tasks: max tasks in flight
+    :param workers: pool processes
+    :param executor: ProcessPoolExecutor to reuse, e.g. over the runs of a loop, else one is started for this run
+    :return: number of failed tasks
+    """
+    if executor is None:
+        with ProcessPoolExecutor(workers) as executor:
+            return run(jobs, tasks, workers, executor)
+
+    done = failed = 0
+    start = time.time()
+    pending = {}
+    jobs = iter(jobs)
+    while True:
+        for url_path, func, args in jobs:
+            pending[executor.submit(func, *args)] = url_path
+            if len(pending) >= tasks:
+                break
+        if not pending:
+            break
+        finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in finished:
+            url_path = pending.pop(future)
+            try:
+                status = future.result()
+            except Exception as e:
+                status = f"error {repr(e)}"
+            failed += status.startswith("error")
+            done += 1
+            print(f"[{done}, {done / (time.time() - start):.1f}/s] {url_path}: {status}", flush=True)
+    return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m app.warmup", description="Page cache warm-up")
+    subparsers = parser.add_subparsers(dest="command")
+
+    paths_parser = subparsers.add_parser("paths", help="fetch and transcribe a list of pages")
+    paths_parser.add_argument("paths", help="text file, one page path per line, - for stdin")
+
+    dump_parser = subparsers.add_parser("dump", help="transcribe a directory of rendered pages")
+    dump_parser.add_argument("directory", help="directory with one html file per page")
+
+    for subparser in (paths_parser, dump_parser):
+        subparser.add_argument("--cache", default=page_cache.path, help="page cache store to fill")
+        subparser.add_argument("--max-bytes", type=int, default=page_cache.max_bytes, help="store byte budget")
+        subparser.add_argument("--jobs", type=int, default=os.cpu_count(), help="worker processes")
+        subparser.add_argument("--resume", action="store_true", help="skip the pages already in the store")
+
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.error("a command is required")
+
+    # Inherited by the forked pool processes
+    page_cache.path = args.cache
+    page_cache.max_bytes = args.max_bytes
+    page_cache.seed = None
+
+    if args.command == "paths":
+        jobs = ((url_path, warm_path, (url_path,)) for url_path in read_paths(args.paths))
+    else:
+        jobs = ((url_path, warm_dump_page, (url_path, filename)) for url_path, filename in read_dump(args.directory))
+    if args.resume:
+        jobs = ((url_path, resume_job, (url_path, func, args)) for url_path, func, args in jobs)
+
+    failed = run(jobs, args.jobs * 4, args.jobs)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
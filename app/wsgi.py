@@ -1,4 +1,8 @@
+from app.preload import preload
 from app.proxy import flask_app as app
 
+# Imported by the uwsgi master before it forks the workers, which share the warmed-up memory
+preload()
+
 if __name__ == "__main__":
     app.run()
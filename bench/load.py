@@ -0,0 +1,391 @@
+"""
+End-to-end load tests of the proxy served by uwsgi through app.wsgi, against bench.mock_upstream.
+
+A mix of article pages, summaries, stylesheets, images and form submissions is sent at increasing
+concurrency levels. Each level reports throughput, latency percentiles, error rate and the peak memory
+of every uwsgi worker, the data to size uwsgi processes/cheaper and nginx worker_connections.
+
+    python -m bench.load run --processes 4 --concurrency 1,8,32,64 --duration 30 --output before.json
+    python -m bench.load compare before.json after.json
+
+Worker memory is read from /proc, so it is only reported on Linux.
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+# Share of the requests of each kind
+TRAFFIC_MIX = [("article", 55), ("summary", 15), ("css", 10), ("image", 15), ("post", 5)]
+CSS_PATH = "w/load.php?lang=es&modules=site.styles&only=styles&skin=vector"
+IMAGES = 200
+# Article popularity follows a Zipf law of this exponent
+ZIPF_EXPONENT = 1.1
+REQUEST_TIMEOUT = 60
+RSS_SAMPLE_SECONDS = 0.5
+READY_TIMEOUT = 60
+# As a browser: the User-Agent of requests is classified as a crawler by app.admission
+USER_AGENT = "Mozilla/5.0 (X11; Linux x86_64; rv:115.0) Gecko/20100101 Firefox/115.0"
+
+
+class Traffic:
+    """
+    Random requests of the TRAFFIC_MIX, over a set of articles with a long tail of rarely read ones.
+    """
+
+    def __init__(self, pages, seed):
+        self.titles = [f"Artículo_{i}" for i in range(pages)]
+        self.title_weights = list(itertools.accumulate(1 / (rank + 1) ** ZIPF_EXPONENT for rank in range(pages)))
+        self.kinds = [kind for kind, _ in TRAFFIC_MIX]
+        self.kind_weights = list(itertools.accumulate(weight for _, weight in TRAFFIC_MIX))
+        self.seed = seed
+
+    def generator(self, index):
+        """
+        :param index: index of the client thread, each one gets its own reproducible sequence
+        :return: function returning (kind, method, path, form data)
+        """
+        rng = random.Random(f"{self.seed}:{index}")
+
+        def next_request():
+            kind = rng.choices(self.kinds, cum_weights=self.kind_weights)[0]
+            title = rng.choices(self.titles, cum_weights=self.title_weights)[0]
+            if kind == "article":
+                return kind, "GET", "wiki/" + title, None
+            if kind == "summary":
+                return kind, "GET", "api/rest_v1/page/summary/" + title, None
+            if kind == "css":
+                return kind, "GET", CSS_PATH, None
+            if kind == "image":
+                return kind, "GET", f"w/images/{rng.randrange(IMAGES)}.png", None
+            return kind, "POST", "w/index.php", {"search": title.replace("_", " ")}
+
+        return next_request
+
+
+def percentile(values, fraction):
+    """
+    :param values: sorted list
+    :param fraction: 0.5 for the median
+    :return: nearest-rank percentile, None for no values
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(fraction * len(values))) - 1))]
+
+
+def summarize(samples, elapsed):
+    """
+    :param samples: list of (kind, seconds, error, shed)
+    :param elapsed: duration of the level in seconds
+    :return: dict of throughput, latency percentiles in ms, error rate and rate of requests shed
+    """
+    latencies = sorted(seconds * 1000 for _, seconds, _, _ in samples)
+    errors = sum(error for _, _, error, _ in samples)
+    shed = sum(shed for _, _, _, shed in samples)
+    return {
+        "requests": len(samples),
+        "throughput": round(len(samples) / elapsed, 1) if elapsed else 0,
+        "p50_ms": round(percentile(latencies, 0.5) or 0, 1),
+        "p95_ms": round(percentile(latencies, 0.95) or 0, 1),
+        "p99_ms": round(percentile(latencies, 0.99) or 0, 1),
+        "error_rate": round(errors / len(samples), 4) if samples else 0,
+        "shed_rate": round(shed / len(samples), 4) if samples else 0,
+    }
+
+
+def child_pids(pid):
+    """
+    :param pid: process id
+    :return: ids of its child processes, the uwsgi workers of a master
+    """
+    children = []
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/stat") as f:
+                # The command name may hold spaces, the parent id is the second field after it
+                if int(f.read().rsplit(")", 1)[1].split()[1]) == pid:
+                    children.append(int(name))
+        except (OSError, IndexError, ValueError):
+            continue
+    return children
+
+
+def rss_mib(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+class RssSampler(threading.Thread):
+    """
+    Peak resident memory of the workers of a uwsgi master while a level runs.
+    """
+
+    def __init__(self, master_pid):
+        super().__init__(daemon=True)
+        self.master_pid = master_pid
+        self.peaks = {}
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            for pid in child_pids(self.master_pid):
+                rss = rss_mib(pid)
+                if rss is not None:
+                    self.peaks[pid] = max(self.peaks.get(pid, 0), rss)
+            self.stopped.wait(RSS_SAMPLE_SECONDS)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        return {str(pid): round(rss, 1) for pid, rss in sorted(self.peaks.items())}
+
+
+def client(target, next_request, deadline, samples):
+    """
+    Send requests one after the other until the deadline.
+    :param target: proxy root url
+    :param next_request: see Traffic.generator()
+    :param deadline: time.perf_counter() value to stop at
+    :param samples: list receiving (kind, seconds, error, shed by admission control)
+    """
+    session = requests.Session()
+    while time.perf_counter() < deadline:
+        kind, method, path, data = next_request()
+        start = time.perf_counter()
+        try:
+            resp = session.request(method, target + path, data=data, timeout=REQUEST_TIMEOUT,
+                                   headers={"Accept-Encoding": "gzip, br", "User-Agent": USER_AGENT})
+            # The body is read as a browser would
+            len(resp.content)
+            error = resp.status_code >= 500
+            shed = resp.status_code == 503 and "Retry-After" in resp.headers
+        except requests.exceptions.RequestException:
+            error = True
+            shed = False
+        samples.append((kind, time.perf_counter() - start, error, shed))
+
+
+def run_level(target, traffic, concurrency, duration, master_pid=None):
+    """
+    :param target: proxy root url
+    :param traffic: Traffic
+    :param concurrency: concurrent clients
+    :param duration: seconds
+    :param master_pid: uwsgi master process id, to sample the memory of its workers
+    :return: level report
+    """
+    samples = []
+    sampler = RssSampler(master_pid) if master_pid else None
+    if sampler:
+        sampler.start()
+    start = time.perf_counter()
+    deadline = start + duration
+    threads = [threading.Thread(target=client, args=(target, traffic.generator(i), deadline, samples))
+               for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    report = {"concurrency": concurrency, **summarize(samples, elapsed)}
+    report["kinds"] = {kind: summarize([sample for sample in samples if sample[0] == kind], elapsed)
+                       for kind, _ in TRAFFIC_MIX}
+    if sampler:
+        report["worker_rss_mib"] = sampler.stop()
+        report["total_rss_mib"] = round(sum(report["worker_rss_mib"].values()), 1)
+    return report
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_ready(url, process):
+    """
+    Wait until a server answers any HTTP request.
+    """
+    deadline = time.time() + READY_TIMEOUT
+    while time.time() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"{url} exited with status {process.returncode}")
+        try:
+            requests.get(url, timeout=2)
+            return
+        except requests.exceptions.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} not ready after {READY_TIMEOUT} seconds")
+
+
+def start_upstream(args):
+    port = free_port()
+    process = subprocess.Popen([sys.executable, "-m", "bench.mock_upstream", "--port", str(port),
+                                "--latency", str(args.latency), "--jitter", str(args.jitter)])
+    url = f"http://127.0.0.1:{port}/"
+    wait_ready(url, process)
+    return process, url
+
+
+def start_proxy(args, upstream, workdir):
+    """
+    Serve app.wsgi with uwsgi, as uwsgi.ini does behind nginx, with a page cache of its own.
+    :return: (uwsgi master process, proxy root url)
+    """
+    port = free_port()
+    # Every load test client is a single heavy one, that admission control would throttle
+    env = dict(os.environ, WKP_ROOT_DOMAIN=upstream, PAGE_CACHE_PATH=os.path.join(workdir, "cache.sqlite3"),
+               METRICS_DIR=os.path.join(workdir, "metrics"), DISABLE_ADMISSION_CONTROL="1")
+    command = [args.uwsgi, "--http-socket", f"127.0.0.1:{port}", "--module", "app.wsgi", "--callable", "app",
+               "--master", "--processes", str(args.processes), "--enable-threads", "--buffer-size", "32768",
+               "--die-on-term", "--disable-logging"]
+    if args.cheaper:
+        command += ["--cheaper", str(args.cheaper)]
+    command += args.uwsgi_arg or []
+    process = subprocess.Popen(command, env=env)
+    url = f"http://127.0.0.1:{port}/"
+    wait_ready(url + "robots.txt", process)
+    return process, url
+
+
+def stop(process):
+    if process is not None and process.poll() is None:
+        process.terminate()
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def print_level(report):
+    rss = f"{report['total_rss_mib']:>10}" if "total_rss_mib" in report else f"{'':>10}"
+    print(f"{report['concurrency']:>6} {report['requests']:>9} {report['throughput']:>9} {report['p50_ms']:>9} "
+          f"{report['p95_ms']:>9} {report['p99_ms']:>9} {report['error_rate'] * 100:>7.2f}% {rss}", flush=True)
+
+
+def run(args):
+    upstream_process = proxy_process = None
+    workdir = tempfile.mkdtemp(prefix="andaluh-wiki-load-")
+    try:
+        upstream = args.upstream
+        if upstream is None:
+            upstream_process, upstream = start_upstream(args)
+        target = args.target.rstrip("/") + "/" if args.target else None
+        if target is None:
+            proxy_process, target = start_proxy(args, upstream, workdir)
+        master_pid = proxy_process.pid if proxy_process is not None else args.master_pid
+        traffic = Traffic(args.pages, args.seed)
+
+        if args.warmup:
+            run_level(target, traffic, max(args.concurrency), args.warmup)
+
+        print(f"{'conc':>6} {'requests':>9} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} "
+              f"{'errors':>8} {'RSS MiB':>10}")
+        levels = []
+        for concurrency in args.concurrency:
+            report = run_level(target, traffic, concurrency, args.duration, master_pid)
+            print_level(report)
+            levels.append(report)
+    finally:
+        stop(proxy_process)
+        stop(upstream_process)
+
+    if args.output:
+        config = {name: getattr(args, name) for name in ("processes", "cheaper", "duration", "latency", "jitter",
+                                                           "pages", "seed", "uwsgi_arg")}
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"config": config, "python": platform.python_version(), "machine": platform.platform(),
+                       "time": time.strftime("%Y-%m-%d %H:%M:%S"), "levels": levels}, f, indent=2)
+        print(f"Results saved to {args.output}")
+    if any(level["shed_rate"] for level in levels):
+        # The latencies are those of the 503 responses, not of the proxy
+        print("Requests shed by the admission control of the proxy, disable it with DISABLE_ADMISSION_CONTROL=1")
+        return 1
+    return 1 if any(level["error_rate"] > args.max_error_rate for level in levels) else 0
+
+
+def change(before, after):
+    if not before:
+        return ""
+    return f"{(after / before - 1) * 100:+.0f}%"
+
+
+def compare(args):
+    with open(args.before, encoding="utf-8") as f:
+        before = json.load(f)
+    with open(args.after, encoding="utf-8") as f:
+        after = json.load(f)
+    for name in sorted(set(before["config"]) | set(after["config"])):
+        if before["config"].get(name) != after["config"].get(name):
+            print(f"{name}: {before['config'].get(name)} -> {after['config'].get(name)}")
+
+    after_levels = {level["concurrency"]: level for level in after["levels"]}
+    print(f"{'conc':>6} {'metric':<14} {'before':>10} {'after':>10} {'change':>8}")
+    for level in before["levels"]:
+        other = after_levels.get(level["concurrency"])
+        if other is None:
+            continue
+        for metric in ("throughput", "p50_ms", "p95_ms", "p99_ms", "error_rate", "total_rss_mib"):
+            if metric in level and metric in other:
+                print(f"{level['concurrency']:>6} {metric:<14} {level[metric]:>10} {other[metric]:>10} "
+                      f"{change(level[metric], other[metric]):>8}")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m bench.load", description="End-to-end load tests")
+    subparsers = parser.add_subparsers(dest="command")
+
+    run_parser = subparsers.add_parser("run", help="load test the proxy at increasing concurrency levels")
+    run_parser.add_argument("--concurrency", type=lambda value: [int(level) for level in value.split(",")],
+                            default=[1, 8, 32, 64], help="comma separated concurrent clients of each level")
+    run_parser.add_argument("--duration", type=float, default=30, help="seconds of each level")
+    run_parser.add_argument("--warmup", type=float, default=10, help="seconds of unreported load first, 0 for none")
+    run_parser.add_argument("--processes", type=int, default=4, help="uwsgi worker processes")
+    run_parser.add_argument("--cheaper", type=int, default=0, help="uwsgi cheaper workers, 0 for none")
+    run_parser.add_argument("--uwsgi", default="uwsgi", help="uwsgi executable")
+    run_parser.add_argument("--uwsgi-arg", action="append", help="extra uwsgi argument, may be repeated")
+    run_parser.add_argument("--latency", type=float, default=80, help="mean upstream delay in ms")
+    run_parser.add_argument("--jitter", type=float, default=40, help="maximum deviation of the upstream delay in ms")
+    run_parser.add_argument("--pages", type=int, default=5000, help="distinct articles requested")
+    run_parser.add_argument("--seed", type=int, default=0, help="seed of the request sequences")
+    run_parser.add_argument("--upstream", help="use this upstream instead of starting bench.mock_upstream")
+    run_parser.add_argument("--target", help="load test this proxy root url instead of starting uwsgi")
+    run_parser.add_argument("--master-pid", type=int, help="uwsgi master of --target, to report worker memory")
+    run_parser.add_argument("--max-error-rate", type=float, default=0.01, help="exit status 1 above it")
+    run_parser.add_argument("--output", help="save the results to this JSON file")
+
+    compare_parser = subparsers.add_parser("compare", help="compare the results of two runs")
+    compare_parser.add_argument("before", help="results of the first run")
+    compare_parser.add_argument("after", help="results of the second run")
+
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        return run(args)
+    if args.command == "compare":
+        return compare(args)
+    parser.error("a command is required")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
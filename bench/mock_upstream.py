@@ -0,0 +1,121 @@
+"""
+Local stand-in for es.wikipedia replaying the recorded responses of bench/fixtures, for load tests.
+
+Every article path is answered with one of the recorded pages, summaries, stylesheets and form
+submissions with theirs, and images with generated bytes. Each response is delayed by the configured
+upstream latency plus a random jitter.
+
+    python -m bench.mock_upstream --port 8900 --latency 80 --jitter 40
+"""
+import argparse
+import hashlib
+import random
+import sys
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import unquote, urlsplit
+
+from bench.suite import load_fixture, load_manifest
+
+# Recorded page answering an article path, by the hash of the path
+ARTICLE_FIXTURES = ["article"] * 6 + ["stub"] * 3 + ["list"]
+IMAGE_BYTES = 20 * 1024
+CACHE_CONTROL_STATIC = "public, max-age=2592000"
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class Fixtures:
+    """
+    Recorded responses by fixture name, as (content type, body).
+    """
+
+    def __init__(self):
+        self.responses = {fixture["name"]: (fixture["content_type"], load_fixture(fixture))
+                          for fixture in load_manifest()}
+        # Incompressible, like the usual jpeg and png images
+        self.image = random.Random(0).getrandbits(IMAGE_BYTES * 8).to_bytes(IMAGE_BYTES, "big")
+
+    def article(self, path):
+        digest = zlib.crc32(path.encode("utf-8"))
+        return self.responses[ARTICLE_FIXTURES[digest % len(ARTICLE_FIXTURES)]]
+
+
+def make_handler(fixtures, latency, jitter):
+    """
+    :param fixtures: Fixtures
+    :param latency: mean delay of the responses in seconds
+    :param jitter: maximum deviation of the delay from the mean in seconds
+    :return: request handler class
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            self.reply(self.route())
+
+        def do_POST(self):
+            # Form submissions, such as the search box, get a page back
+            self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            self.reply(fixtures.responses["stub"])
+
+        def route(self):
+            path = unquote(urlsplit(self.path).path)
+            if path.startswith("/api/rest_v1/page/summary/"):
+                return fixtures.responses["summary"]
+            if path.startswith("/w/load.php"):
+                return fixtures.responses["css"]
+            if path.startswith("/static/images/") or path.startswith("/w/images/"):
+                return "image/png", fixtures.image
+            if path in ("/", "/wiki/Wikipedia:Portada"):
+                return fixtures.responses["main_page"]
+            if path.startswith("/wiki/"):
+                return fixtures.article(path)
+            return None
+
+        def reply(self, response):
+            time.sleep(max(0.0, latency + random.uniform(-jitter, jitter)))
+            if response is None:
+                self.send_error(404)
+                return
+            content_type, body = response
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            if content_type.startswith("text/html"):
+                # A single revision of every page
+                self.send_header("ETag", '"' + hashlib.sha1(self.path.encode("utf-8")).hexdigest() + '"')
+            else:
+                self.send_header("Cache-Control", CACHE_CONTROL_STATIC)
+            self.end_headers()
+            self.wfile.write(body)
+
+    return Handler
+
+
+def serve(port, latency, jitter):
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(Fixtures(), latency, jitter))
+    print(f"Mock upstream on http://127.0.0.1:{port}/", flush=True)
+    server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m bench.mock_upstream", description="Mock es.wikipedia")
+    parser.add_argument("--port", type=int, default=8900, help="listening port")
+    parser.add_argument("--latency", type=float, default=80, help="mean response delay in ms")
+    parser.add_argument("--jitter", type=float, default=40, help="maximum deviation of the delay in ms")
+    args = parser.parse_args(argv)
+    serve(args.port, args.latency / 1000, args.jitter / 1000)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,69 @@
+"""
+Time of the page traversals of transcribe_html: the previous separate passes, one text walk, a
+select_one() per rewrite rule and a findAll('link'), against the single walk of app.proxy.walk_page.
+Transcription itself is left out, it is the same in both cases.
+
+    python -m bench.rewrite page.html [page.html ...] [--repeat 20]
+"""
+import argparse
+import sys
+import time
+
+from bs4 import BeautifulSoup, Comment
+from bs4.element import NavigableString
+
+from app.proxy import NOT_TRANSCRIBABLE_ELEMENTS, walk_page
+from app.rewrite import REWRITE_RULES
+
+
+def multi_pass(soup):
+    nodes = []
+    pending = [soup.body]
+    while pending:
+        elem = pending.pop()
+        if elem.name in NOT_TRANSCRIBABLE_ELEMENTS:
+            continue
+        if isinstance(elem, NavigableString):
+            if not isinstance(elem, Comment) and not elem.isspace():
+                nodes.append(elem)
+        elif hasattr(elem, "contents"):
+            pending.extend(reversed(elem.contents))
+    matches = [soup.select_one(selector) for selector, action, first in REWRITE_RULES if first]
+    links = soup.find_all('link')
+    return nodes, matches, links
+
+
+def best_time(func, soup, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(soup)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m bench.rewrite", description=__doc__.strip().splitlines()[0])
+    parser.add_argument("pages", nargs="+", help="saved Wikipedia pages")
+    parser.add_argument("--repeat", type=int, default=20, help="runs per page, the best one is reported")
+    args = parser.parse_args(argv)
+
+    total_before = total_after = 0
+    for filename in args.pages:
+        with open(filename, encoding="utf-8") as f:
+            soup = BeautifulSoup(f.read(), "lxml")
+        before = best_time(multi_pass, soup, args.repeat)
+        after = best_time(walk_page, soup, args.repeat)
+        total_before += before
+        total_after += after
+        print(f"{filename}: {before * 1000:.2f} ms -> {after * 1000:.2f} ms, "
+              f"{(before - after) * 1000:.2f} ms saved")
+    count = len(args.pages)
+    print(f"mean per article: {total_before / count * 1000:.2f} ms -> {total_after / count * 1000:.2f} ms, "
+          f"{(total_before - total_after) / count * 1000:.2f} ms saved")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
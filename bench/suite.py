@@ -0,0 +1,290 @@
+"""
+Per-stage benchmarks of the transcription hot path on recorded es.wikipedia responses.
+
+Reports time, peak traced memory and allocated memory blocks of transcribe, the text node
+transcription, transcribe_html and prepare_content for every fixture of bench/fixtures, and
+compares them with a saved baseline. Runs offline, the shared page cache is disabled.
+
+The startup stages time, in fresh interpreters, the import of app.wsgi and the first prepare_content
+after it, with and without the warm-up of app.preload. Their peak memory is the maximum resident size.
+
+    python -m bench.suite run [--save] [--baseline bench/baseline.json] [--threshold 0.25]
+    python -m bench.suite record
+"""
+import argparse
+import gzip
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from bs4 import BeautifulSoup
+
+from app import proxy
+from app.cache import page_cache
+from app.memcache import fragment_cache
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
+MANIFEST = os.path.join(FIXTURES_DIR, "manifest.json")
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+# Characters of page text passed to transcribe()
+TRANSCRIBE_SAMPLE_CHARS = 4000
+# Pseudo fixture name of the startup stages, for --fixture
+STARTUP = "startup"
+# Fixture of the first request after startup
+STARTUP_FIXTURE = "article"
+# Run in a fresh interpreter: imports the app as uwsgi does, then prepares the first response
+STARTUP_SCRIPT = """
+import json, resource, sys, time
+start = time.perf_counter()
+import app.wsgi
+imported = time.perf_counter()
+import_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+from app import proxy
+from bench.suite import FixtureResponse, load_fixture, load_manifest
+fixture = next(fixture for fixture in load_manifest() if fixture["name"] == sys.argv[1])
+response = FixtureResponse(load_fixture(fixture), fixture["content_type"], proxy.ROOT_DOMAIN + fixture["path"])
+first = time.perf_counter()
+proxy.prepare_content(response, fixture["path"])
+done = time.perf_counter()
+print(json.dumps({"import": [imported - start, import_rss],
+                  "first_request": [done - first, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss]}))
+"""
+
+
+class FixtureResponse:
+    """
+    Recorded upstream response, with the attributes of requests.Response used by prepare_content.
+    """
+
+    class Request:
+        method = "GET"
+
+    def __init__(self, content, content_type, url):
+        self.content = content
+        self.headers = {"Content-Type": content_type}
+        self.url = url
+        self.status_code = 200
+        self.request = self.Request()
+
+
+def load_manifest():
+    with open(MANIFEST, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def load_fixture(fixture):
+    with gzip.open(os.path.join(FIXTURES_DIR, fixture["file"]), "rb") as f:
+        return f.read()
+
+
+def transcribe_nodes(soup):
+    nodes, _ = proxy.walk_page(soup)
+    proxy.transcribe_nodes(nodes, vaf="ç", vvf="h")
+
+
+def stages(fixture, content):
+    """
+    :param fixture: manifest entry
+    :param content: recorded response body
+    :return: list of (stage name, setup, function). setup() returns the arguments of function, untimed.
+    """
+    response = FixtureResponse(content, fixture["content_type"], proxy.ROOT_DOMAIN + fixture["path"])
+    result = []
+    kind = proxy.content_kind(fixture["content_type"])
+    if kind == "html":
+        html = content.decode("utf-8")
+        soup = BeautifulSoup(html, "lxml")
+        sample = " ".join(soup.body.stripped_strings)[:TRANSCRIBE_SAMPLE_CHARS]
+        result.append(("transcribe", lambda: (sample,), proxy.transcribe))
+        result.append(("transcribe_nodes", lambda: (BeautifulSoup(html, "lxml"),), transcribe_nodes))
+        result.append(("transcribe_html", lambda: (html, fixture["path"]), proxy.transcribe_html))
+    elif kind == "summary":
+        extract = json.loads(content)["extract"]
+        result.append(("transcribe", lambda: (extract,), proxy.transcribe))
+    result.append(("prepare_content", lambda: (response, fixture["path"]), proxy.prepare_content))
+    return result
+
+
+def measure(setup, func, repeat):
+    """
+    Time the function with cold fragment caches, after an untimed warm-up run.
+    :return: dict with the median and best time in ms, the traced memory peak in KiB and the number of
+        memory blocks allocated and not freed by a single run
+    """
+    func(*setup())
+    times = []
+    for _ in range(repeat):
+        args = setup()
+        fragment_cache.clear()
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+
+    args = setup()
+    fragment_cache.clear()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, "filename"))
+
+    return {
+        "time_ms": round(statistics.median(times) * 1000, 3),
+        "best_ms": round(min(times) * 1000, 3),
+        "peak_kib": round(peak / 1024, 1),
+        "alloc_blocks": blocks,
+    }
+
+
+def measure_startup(repeat):
+    """
+    Time the startup of fresh interpreters, without and with the warm-up of app.preload.
+    :return: dict of stage name -> result, as measure()
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    results = {}
+    for suffix, preload in (("", False), ("_preload", True)):
+        env = dict(os.environ, PAGE_CACHE_MAX_BYTES="0", DISABLE_METRICS="1")
+        env.pop("DISABLE_PRELOAD", None)
+        if not preload:
+            env["DISABLE_PRELOAD"] = "1"
+        runs = []
+        for _ in range(repeat):
+            output = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT, STARTUP_FIXTURE], cwd=root, env=env,
+                                    stdout=subprocess.PIPE, check=True).stdout
+            # The warm-up reports its timings on the first lines
+            runs.append(json.loads(output.decode("utf-8").strip().splitlines()[-1]))
+        for phase in ("import", "first_request"):
+            times = [run[phase][0] for run in runs]
+            results[f"{STARTUP}/{phase}{suffix}"] = {
+                "time_ms": round(statistics.median(times) * 1000, 3),
+                "best_ms": round(min(times) * 1000, 3),
+                # ru_maxrss is in KiB on Linux
+                "peak_kib": round(max(run[phase][1] for run in runs), 1),
+                "alloc_blocks": 0,
+            }
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    :return: list of regression messages, best time and peak memory over the baseline by more than threshold
+    """
+    regressions = []
+    for key, result in results.items():
+        base = baseline.get(key)
+        if base is None:
+            continue
+        # The best time is the least noisy one
+        for metric in ("best_ms", "peak_kib"):
+            if base[metric] and result[metric] > base[metric] * (1 + threshold):
+                regressions.append(f"{key} {metric}: {base[metric]} -> {result[metric]} "
+                                   f"(+{(result[metric] / base[metric] - 1) * 100:.0f}%)")
+    return regressions
+
+
+def run(args):
+    # Measure the transcription, not the host-wide page cache
+    page_cache.max_bytes = 0
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+    elif not args.save:
+        # Nothing to compare with is not a pass
+        print(f"No baseline at {args.baseline}, save one with --save")
+        return 2
+
+    results = {}
+    print(f"{'stage':<34} {'median ms':>10} {'best ms':>10} {'peak KiB':>10} {'blocks':>8} {'vs base':>8}")
+    for fixture in load_manifest():
+        if args.fixture and fixture["name"] not in args.fixture:
+            continue
+        content = load_fixture(fixture)
+        for stage, setup, func in stages(fixture, content):
+            key = f"{fixture['name']}/{stage}"
+            results[key] = measure(setup, func, args.repeat)
+            print_result(key, results[key], baseline.get(key))
+    if not args.fixture or STARTUP in args.fixture:
+        for key, result in measure_startup(args.repeat).items():
+            results[key] = result
+            print_result(key, result, baseline.get(key))
+
+    if args.save:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({"python": platform.python_version(), "machine": platform.platform(), "results": results},
+                      f, indent=2, sort_keys=True)
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+
+    regressions = compare(results, baseline, args.threshold)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+
+def print_result(key, result, base):
+    change = f"{(result['best_ms'] / base['best_ms'] - 1) * 100:+.0f}%" if base and base["best_ms"] else ""
+    print(f"{key:<34} {result['time_ms']:>10} {result['best_ms']:>10} {result['peak_kib']:>10} "
+          f"{result['alloc_blocks']:>8} {change:>8}", flush=True)
+
+
+def record(args):
+    from app.upstream import fetch
+
+    manifest = load_manifest()
+    for fixture in manifest:
+        if args.fixture and fixture["name"] not in args.fixture:
+            continue
+        url = args.root + fixture["path"]
+        resp = fetch("GET", url, {"User-Agent": "andaluh-wiki benchmark recorder"})
+        if resp.status_code != 200:
+            print(f"{fixture['name']}: {url} returned {resp.status_code}, not recorded")
+            continue
+        with gzip.GzipFile(os.path.join(FIXTURES_DIR, fixture["file"]), "wb", mtime=0) as f:
+            f.write(resp.content)
+        fixture["content_type"] = resp.headers.get("Content-Type", fixture["content_type"])
+        fixture["source"] = f"{url} recorded {time.strftime('%Y-%m-%d')}"
+        print(f"{fixture['name']}: {len(resp.content)} bytes from {url}")
+
+    with open(MANIFEST, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, ensure_ascii=False)
+        f.write("\n")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m bench.suite", description="Transcription benchmarks")
+    subparsers = parser.add_subparsers(dest="command")
+
+    run_parser = subparsers.add_parser("run", help="run the benchmarks and compare them with the baseline")
+    run_parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="baseline file")
+    run_parser.add_argument("--save", action="store_true", help="save the results as the new baseline")
+    run_parser.add_argument("--threshold", type=float, default=0.25, help="allowed regression, 0.25 is 25%%")
+    run_parser.add_argument("--repeat", type=int, default=3, help="timed runs per stage")
+
+    record_parser = subparsers.add_parser("record", help="record the fixtures again from es.wikipedia")
+    record_parser.add_argument("--root", default="https://es.wikipedia.org/", help="upstream root url")
+
+    for subparser in (run_parser, record_parser):
+        subparser.add_argument("--fixture", action="append",
+                               help=f"only this fixture, or {STARTUP} for the startup stages, may be repeated")
+
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        return run(args)
+    if args.command == "record":
+        return record(args)
+    parser.error("a command is required")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
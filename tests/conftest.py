@@ -0,0 +1,18 @@
+import pytest
+from bs4 import BeautifulSoup
+
+from app import proxy
+from bench.suite import load_fixture, load_manifest
+
+
+@pytest.fixture(scope="session")
+def texts():
+    """
+    :return: text nodes of the recorded pages of bench/fixtures
+    """
+    texts = []
+    for fixture in load_manifest():
+        if proxy.content_kind(fixture["content_type"]) == "html":
+            soup = BeautifulSoup(load_fixture(fixture).decode("utf-8"), "lxml")
+            texts.extend(str(node) for node in proxy.walk_page(soup)[0])
+    return texts
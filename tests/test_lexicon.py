@@ -0,0 +1,30 @@
+"""
+Transcriptions through an EPA lexicon are byte for byte those of the andaluh-py rule engine.
+"""
+import andaluh
+import pytest
+
+from app import lexicon, proxy
+
+VARIANTS = [("ç", "h"), ("s", "j")]
+
+
+@pytest.fixture(scope="module")
+def lexicon_dir(tmp_path_factory, texts):
+    directory = tmp_path_factory.mktemp("lexicon")
+    words = sorted({word for text in texts for word in lexicon.WORD_RE.findall(text)})
+    # Some words are left out, for the words missing from the lexicon
+    words_file = directory / "words.txt"
+    words_file.write_text("\n".join(word for i, word in enumerate(words) if i % 10), encoding="utf-8")
+    variants = ",".join(f"{vaf}:{vvf}" for vaf, vvf in VARIANTS)
+    assert lexicon.main(["build", str(words_file), "--output", str(directory), "--variants", variants]) == 0
+    return str(directory)
+
+
+@pytest.mark.parametrize("vaf,vvf", VARIANTS)
+def test_transcribe_batch_matches_rule_engine(monkeypatch, lexicon_dir, texts, vaf, vvf):
+    monkeypatch.setattr(lexicon, "LEXICON_DIR", lexicon_dir)
+    assert proxy.get_lexicon(vaf, vvf) is not None
+
+    expected = [andaluh.epa(text, vaf=vaf, vvf=vvf, escape_links=True) for text in texts]
+    assert proxy.transcribe_batch(texts, vaf=vaf, vvf=vvf) == expected
@@ -0,0 +1,44 @@
+"""
+Pages rendered to a variant from their neutral form are byte for byte those andaluh-py transcribes to the variant.
+"""
+import itertools
+
+import andaluh
+import pytest
+
+from app import lexicon, variants
+
+VARIANTS = list(itertools.product(variants.VAF_VALUES, variants.VVF_VALUES))
+# Final /l/ before the placeholder letters, rotated to /r/ whatever the variant, and a few without them
+PHRASES = ["el zapato", "al jardín", "el chico", "mal hecho", "el cielo", "los hijos", "el xilófono", "El Gigante",
+           "del cerdo", "el gitano", "Al cero", "el jefe y el general", "mil cisnes", "el hielo", "el sur",
+           "Cádiz y Jerez"]
+
+
+def neutral_form(text):
+    """
+    :return: renderable neutral form of the text, as prepared by proxy.neutral_html, or None if it has none
+    """
+    return variants.renderable_form(andaluh.epa(text, vaf=variants.NEUTRAL_VAF, vvf=variants.NEUTRAL_VVF,
+                                                escape_links=True))
+
+
+@pytest.fixture(scope="module")
+def corpus(texts):
+    """
+    :return: list of (text, renderable neutral form) of the phrases, words and text nodes of bench/fixtures
+    """
+    texts = sorted(set(texts))
+    words = sorted({word for text in texts for word in lexicon.WORD_RE.findall(text)})
+    neutrals = [(text, neutral_form(text)) for text in PHRASES + words + texts]
+    return [(text, neutral) for text, neutral in neutrals if neutral is not None]
+
+
+def test_phrases_are_renderable():
+    assert [phrase for phrase in PHRASES if neutral_form(phrase) is None] == []
+
+
+@pytest.mark.parametrize("vaf,vvf", VARIANTS)
+def test_render_matches_rule_engine(corpus, vaf, vvf):
+    rendered = [variants.render(neutral, vaf, vvf) for _, neutral in corpus]
+    assert rendered == [andaluh.epa(text, vaf=vaf, vvf=vvf, escape_links=True) for text, _ in corpus]